@@ -28,6 +28,7 @@
 
 
 import os
+import sys
 import pathlib
 import requests
 import pickle
@@ -43,6 +44,18 @@ import random
 import shutil
 from statistics import median
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from p_values import get_null_p_values
+from consensus_null import get_null_distribution_cpds, get_null_dist_median_scores
+from result_cache import ResultCache
+
+##the null distribution and its median scores are cached on disk, keyed by their inputs, arguments and the
+##source of consensus_null and of the correlation helpers it calls, re-running the notebook with the same inputs reuses them
+result_cache = ResultCache('result_cache', helper_modules=('moa_scores', 'correlation'))
+get_null_distribution_cpds = result_cache(get_null_distribution_cpds)
+get_null_dist_median_scores = result_cache(get_null_dist_median_scores)
+
 
 # #### - Load in the datasets required, 
 # - They were generated from the `L1000_moa_median_scores_calculation.notebook`
@@ -200,60 +213,6 @@ len(df_moa_cpds['moa_size'].unique())
 len(moa_sizes_dict)
 
 
-# In[19]:
-
-
-def check_similar_cpds(cpds, moa_dict):
-    """This function checks if two compounds are found in the same moa"""
-    
-    for x in range(len(cpds)):
-        for y in range(x+1, len(cpds)):
-            for kys in moa_dict:
-                if all(i in moa_dict[kys] for i in [cpds[x], cpds[y]]):
-                    return True
-    return False
-
-
-# In[20]:
-
-
-def get_random_cpds(all_cpds, moa_size, moa_cpds, all_moa_cpds):
-    """
-    This function return a list of random cpds that are not of the same moas 
-    or found in the current moa cpd's list
-    """
-    while (True):
-        random_cpds = random.sample(all_cpds, moa_size)
-        if not (any(cpds in moa_cpds for cpds in random_cpds) & (check_similar_cpds(random_cpds, all_moa_cpds))):
-            break
-    return random_cpds
-
-
-# In[21]:
-
-
-def get_null_distribution_cpds(moa_size_dict, cpds_list, all_moa_dict, rand_num = 1000):
-    
-    """
-    This function returns a null distribution dictionary, with MOA_SIZEs as the keys and 
-    1000 lists of randomly selected compounds combinations as the values for each moa_size class
-    """
-    null_distribution_moa = {}
-    for size in moa_size_dict:
-        moa_cpds = moa_size_dict[size]
-        moa_cpds_list = []
-        for idx in range(rand_num):
-            start_again = True
-            while (start_again):
-                rand_cpds = get_random_cpds(cpds_list, size, moa_cpds, all_moa_dict)
-                if rand_cpds not in moa_cpds_list:
-                    start_again = False
-            moa_cpds_list.append(rand_cpds)
-        null_distribution_moa[size] = moa_cpds_list
-    
-    return null_distribution_moa
-
-
 # In[22]:
 
 
@@ -319,92 +278,22 @@ duplicates_cpds_list = assert_null_distribution(null_distribution_moa)
 duplicates_cpds_list ##no duplicate found
 
 
-# In[29]:
-
-
-def calc_null_dist_median_scores(data_moa, dose_num, moa_cpds_list):
-    """
-    This function calculate the median of the correlation 
-    values for each of the list in the 1000 lists of 
-    random compounds combination for each MOA
-    """
-    df_cpd_agg = get_cpd_agg(data_moa, dose_num)
-    median_corr_list = []
-    for list_of_cpds in moa_cpds_list:
-        df_cpds = df_cpd_agg.loc[list_of_cpds]
-        cpds_corr = df_cpds.T.corr(method = 'spearman').values
-        median_corr_val = median(list(cpds_corr[np.triu_indices(len(cpds_corr), k = 1)]))
-        median_corr_list.append(median_corr_val)
-    return median_corr_list
-
-
-# In[30]:
-
-
-def get_null_dist_median_scores(null_distribution_moa, df_moa):
-    """ 
-    This function calculate the median correlation scores for all 
-    1000 lists of randomly combined compounds for each moa_size class 
-    across all doses (1-6)
-    """
-    null_distribution_medians = {}
-    for key in null_distribution_moa:
-        median_score_list = []
-        for num in range(1,7):
-            moa_size_median_scores = calc_null_dist_median_scores(df_moa, num, null_distribution_moa[key])
-            median_score_list.append(moa_size_median_scores)
-        null_distribution_medians[key] = median_score_list
-    return null_distribution_medians
-
-
 # **A P value can be computed nonparametrically by evaluating the probability of random compounds of different MOAs having greater median similarity value than compounds of the same MOAs.**
 
 # In[31]:
 
 
-null_distribution_medians = get_null_dist_median_scores(null_distribution_moa, df_lvl5)
-
-
-# In[32]:
-
-
-def get_p_value(median_scores_list, df_moa_values, dose_name, moa_name):
-    """
-    This function calculate the p-value from the 
-    null_distribution median scores for each MOA
-    """
-    actual_med = df_moa_values.loc[moa_name, dose_name]
-    p_value = np.sum(median_scores_list >= actual_med) / len(median_scores_list)
-    return p_value
-
-
-# In[33]:
-
-
-def get_moa_p_vals(null_dist_median, df_moa_values):
-    """
-    This function returns a dict, with MOAs as the keys and the MOA's 
-    p-values for each dose (1-6) as the values
-    """
-    null_p_vals = {}
-    df_moa_values = df_moa_values.set_index('moa').rename_axis(None, axis=0)
-    for key in null_dist_median:
-        df_moa_size = df_moa_values[df_moa_values['moa_size'] == key]
-        for moa in df_moa_size.index:
-            dose_p_values = []
-            for num in range(1,7):
-                dose_name = 'dose_' + str(num)
-                moa_p_value = get_p_value(null_dist_median[key][num-1], df_moa_size, dose_name, moa)
-                dose_p_values.append(moa_p_value)
-            null_p_vals[moa] = dose_p_values
-    sorted_null_p_vals = {key:value for key, value in sorted(null_p_vals.items(), key=lambda item: item[0])}
-    return sorted_null_p_vals
+##the compound correlation matrix of each dose is computed once and shared by all moa_size classes,
+##doses are processed in parallel and the run time of each dose is printed
+df_cpd_aggs = [get_cpd_agg(df_lvl5, num) for num in range(1,7)]
+null_distribution_medians = get_null_dist_median_scores(null_distribution_moa, df_cpd_aggs, verbose = True)
 
 
 # In[34]:
 
 
-null_p_vals = get_moa_p_vals(null_distribution_medians, df_moa_vals)
+null_p_vals = get_null_p_values(null_distribution_medians, range(1,7), 
+                                df_moa_vals.set_index('moa').rename_axis(None, axis=0), 'moa_size')
 
 
 # In[35]:
@@ -39,6 +39,7 @@
 
 
 import os
+import sys
 import pathlib
 import pandas as pd
 import numpy as np
@@ -56,6 +57,11 @@ from io import BytesIO
 from urllib.request import urlopen
 from zipfile import ZipFile
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from moa_scores import get_dose_median_score
+from dose_executor import run_per_dose
+
 
 # In[2]:
 
@@ -221,45 +227,6 @@ df_no_moa['Metadata_broad_sample'].unique().tolist()
 # | ~10 | 6 |
 # | ~20 | 7 |
 
-# In[12]:
-
-
-def get_median_score(moa_list, df_dose, df_cpd_agg):
-    
-    """
-    Get the correlation values between compounds of each MOA, 
-    then calculate the median of these correlation values 
-    and assign it as the "median score" of the MOA.
-    
-    params: 
-    moa_list: list of distinct moas for a particular dose
-    df_dose: merged consensus and moa dataframe of a partcular dose
-    df_dose_corr: merged consensus and moa dataframe of compound correlations of a particular dose
-
-    Returns:
-    moa_median_score: Dict with moa as the keys, and their median scores as the values
-    moa_cpds: Dict with moa as the keys, and the list of moa for each moa as the values
-    
-    """
-    
-    moa_cpds = {}
-    moa_median_score = {}
-    for moa in moa_list:
-        cpds = df_dose['pert_iname'][df_dose['moa'] == moa].unique().tolist()
-        moa_cpds[moa] = cpds
-        ##taking correlation btw cpds for each MOA
-        df_cpds = df_cpd_agg.loc[cpds]
-        cpds_corr = df_cpds.T.corr(method = 'spearman').values
-        if len(cpds_corr) == 1:
-            median_val = 1
-        else:
-            median_val = median(list(cpds_corr[np.triu_indices(len(cpds_corr), k = 1)]))
-
-        moa_median_score[moa] = median_val
-        
-    return moa_median_score, moa_cpds
-
-
 # In[13]:
 
 
@@ -307,15 +274,19 @@ def get_moa_medianscores(df_moa):
     """
     dose_list = list(set(df_moa['Metadata_dose_recode'].unique().tolist()))[1:]
     
+    dose_inputs = {}
     for dose in dose_list:
         df_dose = df_moa[df_moa['Metadata_dose_recode'] == dose].copy()
         df_cpd_agg = df_dose.groupby(['pert_iname']).agg(['mean'])
         df_cpd_agg.columns  = df_cpd_agg.columns.droplevel(1)
         df_cpd_agg.rename_axis(None, axis=0, inplace = True)
         df_cpd_agg.drop(['Metadata_mmoles_per_liter', 'Metadata_dose_recode'], axis = 1, inplace = True)
-        dose_moa_list = df_dose['moa'].unique().tolist()
-        #get the median of the corr values of the cpds for each MOA
-        dose_moa_med_score, dose_moa_cpds = get_median_score(dose_moa_list, df_dose, df_cpd_agg)
+        dose_inputs[dose] = (df_cpd_agg.values.astype('float64'), df_cpd_agg.index.values, df_dose[['moa', 'pert_iname']])
+    #get the median of the corr values of the cpds for each MOA, all doses in parallel
+    dose_results, dose_timings = run_per_dose(get_dose_median_score, dose_inputs, verbose = True)
+    
+    for dose in dose_list:
+        dose_moa_med_score, dose_moa_cpds = dose_results[dose]
         #check if all moa in the df_moa is present in the dose_moa
         dose_moa_med_score, dose_moa_cpds = check_moa(dose_moa_med_score, dose_moa_cpds, df_moa)
         sorted_moa_med_score = {key:value for key, value in sorted(dose_moa_med_score.items(), key=lambda item: item[0])}
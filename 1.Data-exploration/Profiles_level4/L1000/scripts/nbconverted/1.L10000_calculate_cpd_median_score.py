@@ -27,6 +27,7 @@
 
 
 import os
+import sys
 import pathlib
 import requests
 import pickle
@@ -45,6 +46,12 @@ from io import BytesIO
 from urllib.request import urlopen
 from zipfile import ZipFile
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from incremental_scores import update_cpd_medianscores, patch_median_scores_csv
+from gctx_reader import read_gctx_ids, read_gctx_columns, get_sig_id
+from correlation import spearman_corr
+
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
@@ -71,24 +78,30 @@ pertinfo_file = '../aligned_moa_CP_L1000.csv'
 # In[4]:
 
 
-def construct_lvl4_data(data_dir, level4_dir, pertinfo_file):
+def construct_lvl4_data(data_dir, level4_dir, pertinfo_file, chunk_size = 1000):
     """
     This function returns L1000 Level-4 Data that is aligned with 
-    the important metadata information to compute compound's median scores
+    the important metadata information to compute compound's median scores.
+    The metadata is read first, then only the replicates found in it are read 
+    from the GCTX file, chunk_size replicates (signatures) at a time
     """
     
-    lvl4_data = parse(os.path.join(data_dir, level4_dir))
-    lvl4_data = lvl4_data.data_df.rename_axis(None).T
-    lvl4_data = lvl4_data.rename_axis(None).reset_index()
-    lvl4_data.rename(columns={"index": "replicate_id"}, inplace = True)
     df_metalvl_5 = pd.read_csv(os.path.join(data_dir, 'col_meta_level_5_REP.A_A549_only_n9482.txt'), delimiter = "\t")
-    lvl4_data['sig_id'] = lvl4_data['replicate_id'].apply(lambda x: ''.join(re.sub('(24H.+(\_|\.)[A-Z0-9]+.)\:', '24H:', x)))
     df_meta_features = df_metalvl_5[['sig_id', 'pert_id', 'pert_idose', 'det_plate', 'det_well']].copy()
     df_meta_features['dose'] = df_meta_features['pert_idose'].map({'-666' : 0, '0.04 uM' : 1, '0.12 uM' : 2, '0.37 uM' : 3,
                                                                    '1.11 uM' : 4, '3.33 uM' : 5, '10 uM' : 6, '20 uM' : 7})
     df_pertinfo = pd.read_csv(pertinfo_file)
     df_pertinfo.rename(columns={"broad_id": "pert_id"}, inplace = True)
     df_meta_features = pd.merge(df_meta_features, df_pertinfo, on=['pert_id'], how = 'left')
+    
+    ##only the replicates with a signature in the metadata are read from the GCTX file
+    gctx_path = os.path.join(data_dir, level4_dir)
+    replicate_ids = read_gctx_ids(gctx_path)
+    replicate_ids = replicate_ids[get_sig_id(replicate_ids).isin(df_meta_features['sig_id']).values]
+    lvl4_data = pd.concat(read_gctx_columns(gctx_path, replicate_ids, chunk_size))
+    lvl4_data = lvl4_data.rename_axis(None).reset_index()
+    lvl4_data.rename(columns={"index": "replicate_id"}, inplace = True)
+    lvl4_data['sig_id'] = get_sig_id(lvl4_data['replicate_id']).values
     lvl4_data = pd.merge(lvl4_data, df_meta_features, on='sig_id')
     
     return lvl4_data
@@ -138,7 +151,9 @@ def feature_selection(df_data):
     
     df_data_genes = df_data.drop(['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose', 
                                   'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well'], axis = 1).copy()
-    df_data_corr = df_data_genes.corr(method = 'spearman')
+    ##rank-based Spearman kernel, in float64 so that the 0.9 threshold keeps the same genes
+    df_data_corr = pd.DataFrame(spearman_corr(df_data_genes.values.T, dtype='float64'), 
+                                index = df_data_genes.columns, columns = df_data_genes.columns)
     drop_cols = []
     n_cols = len(df_data_corr.columns)
     for i in range(n_cols):
@@ -165,75 +180,22 @@ df_level4 = feature_selection(df_level4)
 df_level4.shape
 
 
-# In[13]:
-
-
-def get_median_score(cpds_list, df):
-    """
-    This function calculates the median score for each compound based on its replicates
-    """
-    
-    cpds_median_score = {}
-    for cpd in cpds_list:
-        cpd_replicates = df[df['pert_iname'] == cpd].copy()
-        cpd_replicates.drop(['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose', 
-                             'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well'], axis = 1, inplace = True)
-        cpd_replicates_corr = cpd_replicates.astype('float64').T.corr(method = 'spearman').values
-        if len(cpd_replicates_corr) == 1:
-            median_val = 1
-        else:
-            median_val = median(list(cpd_replicates_corr[np.triu_indices(len(cpd_replicates_corr), k = 1)]))
-        
-        cpds_median_score[cpd] = median_val
-        
-    return cpds_median_score
-
-
-# In[14]:
-
-
-def check_compounds(cpd_med_score, df):
-    """
-    Check if all distinct compounds in the Level-4 dataframe are present 
-    in the cpd_med_score dictionary, if not add the compounds as keys to the dictionary 
-    and give them a null value.
-    """
-    cpd_list = df['pert_iname'].unique().tolist()
-    cpd_keys = cpd_med_score.keys()
-    for cpd in cpd_list:
-        if cpd not in cpd_keys:
-            cpd_med_score[cpd] = np.nan
-            
-    return cpd_med_score
-
-
 # In[15]:
 
 
-def get_cpd_medianscores(df):
-    
-    """This function computes median scores for all compounds found in the Level-4 dataframe PER DOSE (1-6)"""
-    
-    dose_list = list(set(df['dose'].unique().tolist()))[1:7]
-    
-    for dose in dose_list:
-        df_dose = df[df['dose'] == dose].copy()
-        cpds_list = df_dose['pert_iname'].unique().tolist()
-        cpds_median_score = get_median_score(cpds_list, df_dose)
-        cpds_median_score = check_compounds(cpds_median_score, df)
-        sorted_med_score = {key:value for key, value in sorted(cpds_median_score.items(), key=lambda item: item[0])}
-        if dose == 1:
-            df_cpd_med_score = pd.DataFrame.from_dict(sorted_med_score, orient='index', columns = ['dose_1'])
-        else:
-            df_cpd_med_score['dose_' + str(dose)] = sorted_med_score.values()
-            
-    return df_cpd_med_score
+metadata_cols = ['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose', 
+                 'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well']
 
 
 # In[16]:
 
 
-df_cpd_med_score = get_cpd_medianscores(df_level4)
+##the replicate correlations of every (compound, dose) are saved in the state file, so that only the compounds
+##with new or changed replicates (e.g. new plates) are recomputed; delete the state file to recompute everything.
+##replicates are identified by their plate, well, compound and dose
+df_cpd_med_score, updated_cpds = update_cpd_medianscores(
+    df_level4, 'dose', ['det_plate', 'det_well', 'pert_iname', 'dose'], metadata_cols, 
+    os.path.join('L1000_lvl4_cpd_replicate_datasets', 'cpd_median_scores_state.pickle'))
 
 
 # In[17]:
@@ -323,8 +285,9 @@ def save_to_csv(df, path, file_name, compress=None):
 # In[26]:
 
 
-save_to_csv(df_cpd_med_score.reset_index().rename({'index':'cpd'}, axis = 1), 
-            'L1000_lvl4_cpd_replicate_datasets', 'cpd_replicate_median_scores.csv')
+##only the rows of the updated compounds are rewritten
+patch_median_scores_csv(df_cpd_med_score, updated_cpds, 
+                        'L1000_lvl4_cpd_replicate_datasets', 'cpd_replicate_median_scores.csv')
 
 
 # In[27]:
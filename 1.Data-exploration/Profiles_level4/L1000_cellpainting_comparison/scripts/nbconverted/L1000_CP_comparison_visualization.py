@@ -84,9 +84,9 @@ def reproducible_dose(df, df_med):
     each compound has across all doses, (out of the 6 doses based on p-values)
     """
     df_new = df.set_index('cpd').rename_axis(None, axis=0).drop(['no_of_replicates'], axis = 1).copy()
-    cpd_values = {cpd:sum(df_new.loc[cpd] <= 0.05) for cpd in df_new.index}
-    df['No_of_reproducible_doses'] = cpd_values.values()
-    df_med['No_of_reproducible_doses'] = cpd_values.values()
+    cpd_values = (df_new <= 0.05).sum(axis = 1).values
+    df['No_of_reproducible_doses'] = cpd_values
+    df_med['No_of_reproducible_doses'] = cpd_values
     
     return df, df_med
 
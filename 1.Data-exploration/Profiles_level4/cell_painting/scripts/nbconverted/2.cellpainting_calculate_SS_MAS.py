@@ -22,6 +22,7 @@
 
 
 import os
+import sys
 import pickle
 import argparse
 import pandas as pd
@@ -36,6 +37,11 @@ import math
 from math import sqrt
 import pickle
 from statistics import median
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from level4_cache import read_level4_csv
+from signature_strength import compute_SS_activity_score, get_dmso_activity_percentile
+
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
@@ -50,8 +56,8 @@ cp_level4_path = "cellpainting_lvl4_cpd_replicate_datasets"
 # In[3]:
 
 
-df_level4 = pd.read_csv(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+df_level4 = read_level4_csv(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                            compression='gzip',low_memory = False)
 df_cpd_med_scores = pd.read_csv(os.path.join(cp_level4_path, 'cpd_replicate_median_scores.csv'))
 
 
@@ -75,74 +81,17 @@ metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_rec
 n_cp_feats = df_level4.drop(metadata_cols, axis=1).shape[1]
 
 
-# In[7]:
-
-
-def compute_signature_strength(cpds_list, df, metadata_cols = metadata_cols):
-    """Computes signature strength for each compound based on its replicates"""
-    cpds_SS = {}
-    
-    for cpd in cpds_list:
-        cpd_replicates = df[df['pert_iname'] == cpd].copy()
-        cpd_replicates.drop(metadata_cols, axis = 1, inplace = True)
-        cpd_replicates = cpd_replicates * sqrt(cpd_replicates.shape[0])
-        df_cpd_reps = abs(cpd_replicates.T)
-        ldmk_genes_gtr_2 = df_cpd_reps[df_cpd_reps >= 2.0].stack().count()
-        ss_norm = ldmk_genes_gtr_2/len(df_cpd_reps.columns)
-        cpds_SS[cpd] = ss_norm
-            
-    return cpds_SS
-
-
-# In[8]:
-
-
-def compute_mas(cpds_SS, cpds_median_score, dose, num_feats):
-    """Computes Morphological Activity Score (MAS) for each compound based on its replicates"""
-    cpds_MAS = {}
-    for cpd in cpds_SS:
-        cpds_MAS[cpd] = sqrt((max(cpds_median_score[cpd][dose-1],0) * cpds_SS[cpd])/num_feats)
-    
-    return cpds_MAS
-
-
-# In[9]:
-
-
-def compute_SS_MAS(df, cpds_median_score, num_cp_feats = n_cp_feats):
-    """
-    Computes both Morphological Activity Score (MAS) and 
-    signature strength for each compound based on its replicates
-    """
-    dose_list = list(set(df['Metadata_dose_recode'].unique().tolist()))[1:7]
-    
-    for dose in dose_list:
-        df_dose = df[df['Metadata_dose_recode'] == dose].copy()
-        cpds_ss = compute_signature_strength(list(cpds_median_score.keys()), df_dose)
-        cpds_mas = compute_mas(cpds_ss, cpds_median_score, dose, num_cp_feats)
-        sorted_ss = {key:value for key, value in sorted(cpds_ss.items(), key=lambda item: item[0])}
-        sorted_mas = {key:value for key, value in sorted(cpds_mas.items(), key=lambda item: item[0])}
-        if dose == 1:
-            df_cpd_ss = pd.DataFrame.from_dict(sorted_ss, orient='index', columns = ['dose_1'])
-            df_cpd_mas = pd.DataFrame.from_dict(sorted_mas, orient='index', columns = ['dose_1'])
-        else:
-            df_cpd_ss['dose_' + str(dose)] = sorted_ss.values()
-            df_cpd_mas['dose_' + str(dose)] = sorted_mas.values()
-            
-    return df_cpd_ss, df_cpd_mas
-
-
 # In[10]:
 
 
 df_med_scores = df_cpd_med_scores.set_index('cpd').rename_axis(None, axis=0).drop(['no_of_replicates'], axis = 1)
-cpd_med_scores = df_med_scores.T.to_dict('list')
 
 
 # In[11]:
 
 
-df_ss_score, df_mas_score = compute_SS_MAS(df_level4, cpd_med_scores)
+df_ss_score, df_mas_score = compute_SS_activity_score(df_level4, df_med_scores, 'Metadata_dose_recode',
+                                                      metadata_cols, n_cp_feats)
 
 
 # In[12]:
@@ -261,63 +210,8 @@ len(df_dmso['Metadata_Plate'].unique())
 # In[25]:
 
 
-def compute_dmso_SS_median_score(df):
-    """
-    This function computes the signature strength (SS) and 
-    median correlation replicate score for DMSO per plate
-    """
-    dmso_median_scores = {}
-    dmso_ss_scores = {}
-    
-    for plate in df['Metadata_Plate'].unique():
-        plt_replicates = df[df['Metadata_Plate'] == plate].copy()
-        plt_replicates.drop(['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 
-                             'Metadata_broad_id', 'Metadata_moa', 'broad_id', 'pert_iname', 'moa', 
-                             'Metadata_Plate', 'Metadata_Well', 'replicate_name'], axis = 1, inplace = True)
-        plt_rep_corr = plt_replicates.astype('float64').T.corr(method = 'spearman').values
-        median_score = median(list(plt_rep_corr[np.triu_indices(len(plt_rep_corr), k = 1)]))
-        dmso_median_scores[plate] = median_score
-        
-        ##signature strength --ss
-        plt_replicates = plt_replicates * sqrt(plt_replicates.shape[0])
-        df_plt_reps = abs(plt_replicates.T)
-        cp_feats_gtr_2 = df_plt_reps[df_plt_reps >= 2.0].stack().count()
-        ss_norm = cp_feats_gtr_2/len(df_plt_reps.columns)
-        dmso_ss_scores[plate] = ss_norm
-        
-    return dmso_median_scores, dmso_ss_scores
-
-
-# In[26]:
-
-
-dmso_median_scores, dmso_ss_scores = compute_dmso_SS_median_score(df_dmso)
-
-
-# In[27]:
-
-
-def compute_dmso_MAS(dmso_median, dmso_ss, num_feats = n_cp_feats):
-    """
-    This function computes Morphological Activity Score (MAS) 
-    per plate for only DMSO replicates
-    """
-    dmso_mas_scores = {}
-    for plate in dmso_median:
-        dmso_mas_scores[plate] = sqrt((abs(dmso_median[plate]) * dmso_ss[plate])/num_feats) 
-    return dmso_mas_scores
-
-
-# In[28]:
-
-
-dmso_mas_scores = compute_dmso_MAS(dmso_median_scores, dmso_ss_scores)
-
-
-# In[29]:
-
-
-dmso_95pct = np.percentile(list(dmso_mas_scores.values()),95)
+##activity score of the DMSO replicates of every plate (with more than one DMSO replicate)
+dmso_95pct = get_dmso_activity_percentile(df_dmso, 'Metadata_Plate', metadata_cols, n_cp_feats)
 
 
 # In[30]:
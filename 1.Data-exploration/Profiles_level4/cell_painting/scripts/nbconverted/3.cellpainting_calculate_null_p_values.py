@@ -28,6 +28,7 @@
 
 
 import os
+import sys
 import pathlib
 import pandas as pd
 import numpy as np
@@ -38,6 +39,12 @@ import random
 from scipy import stats
 import pickle
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from feature_store import open_feature_store
+from null_pipeline import run_null_pipeline
+from null_sampler import get_duplicate_lists
+from p_values import get_null_p_values
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -55,8 +62,14 @@ cp_level4_path = "cellpainting_lvl4_cpd_replicate_datasets"
 # In[3]:
 
 
-df_level4 = pd.read_csv(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 
+                 'Metadata_Plate', 'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 
+                 'broad_id', 'pert_iname', 'moa', 'replicate_name']
+##features are kept in a memory-mapped store, df_level4 only holds the metadata
+feature_store = open_feature_store(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                                   'Metadata_dose_recode', 'replicate_name', metadata_cols, 
+                                   compression='gzip',low_memory = False)
+df_level4 = feature_store.metadata
 df_cpd_med_scores = pd.read_csv(os.path.join(cp_level4_path, 'cpd_replicate_median_scores.csv'))
 
 
@@ -153,75 +166,19 @@ cpd_replicate_class_dict = get_replicates_classes_per_dose(df_cpd_med_scores, df
 cpd_replicate_class_dict.keys()
 
 
-# In[12]:
-
-
-def check_similar_replicates(replicates, dose, cpd_dict):
-    """This function checks if two replicates are of the same compounds"""
-    
-    for x in range(len(replicates)):
-        for y in range(x+1, len(replicates)):
-            for kys in cpd_dict:
-                if all(i in cpd_dict[kys][dose-1] for i in [replicates[x], replicates[y]]):
-                    return True
-    return False
-
-
-# In[13]:
-
-
-def get_random_replicates(all_replicates, no_of_replicates, dose, replicates_ids, cpd_replicate_dict):
-    """
-    This function return a list of random replicates that are not of the same compounds
-    or found in the current cpd's size list
-    """
-    while (True):
-        random_replicates = random.sample(all_replicates, no_of_replicates)
-        if not (any(rep in replicates_ids for rep in random_replicates) & 
-                (check_similar_replicates(random_replicates, dose, cpd_replicate_dict))):
-            break
-    return random_replicates
-
-
-# In[14]:
-
-
-def get_null_distribution_replicates(cpd_replicate_class_dict, dose_list, replicates_lists, 
-                                     cpd_replicate_dict, rand_num = 1000):
-    
-    """
-    This function returns a null distribution dictionary, with no_of_replicates(replicate class) 
-    as the keys and 1000 lists of randomly selected replicate combinations as the values
-    for each no_of_replicates class per DOSE(1-6)
-    """
-    random.seed(1903)
-    null_distribution_reps = {}
-    for dose in dose_list:
-        for replicate_class in cpd_replicate_class_dict:
-            replicates_ids = cpd_replicate_class_dict[replicate_class][dose-1]
-            replicate_list = []
-            for idx in range(rand_num):
-                start_again = True
-                while (start_again):
-                    rand_cpds = get_random_replicates(replicates_lists[dose-1], replicate_class, dose, 
-                                                      replicates_ids, cpd_replicate_dict)
-                    if rand_cpds not in replicate_list:
-                        start_again = False
-                replicate_list.append(rand_cpds)
-            if replicate_class not in null_distribution_reps:
-                null_distribution_reps[replicate_class] = [replicate_list]
-            else:
-                null_distribution_reps[replicate_class] += [replicate_list]
-    
-    return null_distribution_reps
-
-
 # In[15]:
 
 
 dose_list = list(set(df_level4['Metadata_dose_recode'].unique().tolist()))[1:7]
-null_distribution_replicates = get_null_distribution_replicates(cpd_replicate_class_dict, dose_list, 
-                                                                replicates_in_all, cpds_replicates)
+rand_num = 1000 ##increase (e.g. to 100000) for a finer p-value resolution
+null_shard_dir = os.path.join(cp_level4_path, 'null_distribution_shards')
+
+##each (dose, replicate class) is computed in parallel and checkpointed to null_shard_dir,
+##re-running this cell skips the ones that are already computed
+null_distribution_replicates, null_distribution_medians = run_null_pipeline(
+    feature_store, cpd_replicate_class_dict, dose_list, cpds_replicates, 
+    'Metadata_dose_recode', 'replicate_name', metadata_cols, null_shard_dir, 
+    rand_num = rand_num, seed = 1903)
 
 
 # In[16]:
@@ -252,36 +209,11 @@ with open(os.path.join(cp_level4_path, 'null_distribution.pickle'), 'rb') as han
     null_distribution_replicates = pickle.load(handle)
 
 
-# In[19]:
-
-
-def assert_null_distribution(null_distribution_reps, dose_list):
-    
-    """
-    This function assert that each of the list in the 1000 lists of random replicate 
-    combination (per dose) for each no_of_replicate class are distinct with no duplicates
-    """
-    duplicates_reps = {}
-    for dose in dose_list:
-        for keys in null_distribution_reps:
-            null_dist = null_distribution_reps[keys][dose-1]
-            for reps in null_dist:
-                dup_reps = []
-                new_list = list(filter(lambda x: x != reps, null_dist))
-                if (len(new_list) != len(null_dist) - 1):
-                    dup_reps.append(reps)
-            if dup_reps:
-                if keys not in duplicates_reps:
-                    duplicates_reps[keys] = [dup_reps]
-                else:
-                    duplicates_reps[keys] += [dup_reps]
-    return duplicates_reps
-
-
 # In[20]:
 
 
-duplicate_replicates = assert_null_distribution(null_distribution_replicates, dose_list)
+##every (dose, replicate class) is checked at once, also for large null distributions (rand_num)
+duplicate_replicates = get_duplicate_lists(null_distribution_replicates, dose_list)
 
 
 # In[21]:
@@ -290,55 +222,6 @@ duplicate_replicates = assert_null_distribution(null_distribution_replicates, do
 duplicate_replicates ##no duplicates
 
 
-# In[22]:
-
-
-def calc_null_dist_median_scores(df, dose_num, replicate_lists):
-    """
-    This function calculate the median of the correlation 
-    values for each list in the 1000 lists of random replicate 
-    combination for each no_of_replicate class per dose
-    """
-    df_dose = df[df['Metadata_dose_recode'] == dose_num].copy()
-    df_dose = df_dose.set_index('replicate_name').rename_axis(None, axis=0)
-    df_dose.drop(['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 
-                  'Metadata_Plate', 'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 
-                  'broad_id', 'pert_iname', 'moa'], 
-                 axis = 1, inplace = True)
-    median_corr_list = []
-    for rep_list in replicate_lists:
-        df_reps = df_dose.loc[rep_list].copy()
-        reps_corr = df_reps.astype('float64').T.corr(method = 'spearman').values
-        median_corr_val = median(list(reps_corr[np.triu_indices(len(reps_corr), k = 1)]))
-        median_corr_list.append(median_corr_val)
-    return median_corr_list
-
-
-# In[23]:
-
-
-def get_null_dist_median_scores(null_distribution_cpds, dose_list, df):
-    """ 
-    This function calculate the median correlation scores for all 
-    1000 lists of randomly combined compounds for each no_of_replicate class 
-    across all doses (1-6)
-    """
-    null_distribution_medians = {}
-    for key in null_distribution_cpds:
-        median_score_list = []
-        for dose in dose_list:
-            replicate_median_scores = calc_null_dist_median_scores(df, dose, null_distribution_cpds[key][dose-1])
-            median_score_list.append(replicate_median_scores)
-        null_distribution_medians[key] = median_score_list
-    return null_distribution_medians
-
-
-# In[24]:
-
-
-null_distribution_medians = get_null_dist_median_scores(null_distribution_replicates, dose_list, df_level4)
-
-
 # In[25]:
 
 
@@ -373,45 +256,10 @@ save_to_pickle(dose_null_medians, cp_level4_path, 'null_dist_medians_per_dose.pi
 
 # **A P value can be computed nonparametrically by evaluating the probability of random replicates of different compounds having median similarity value greater than replicates of the same compounds.**
 
-# In[28]:
-
-
-def get_p_value(median_scores_list, df, dose_name, cpd_name):
-    """
-    This function calculate the p-value from the 
-    null_distribution median scores for each compound
-    """
-    actual_med = df.loc[cpd_name, dose_name]
-    p_value = np.sum(median_scores_list >= actual_med) / len(median_scores_list)
-    return p_value
-
-
-# In[29]:
-
-
-def get_moa_p_vals(null_dist_median, dose_list, df_med_values):
-    """
-    This function returns a dict, with compounds as the keys and the compound's 
-    p-values for each dose (1-6) as the values
-    """
-    null_p_vals = {}
-    for key in null_dist_median:
-        df_replicate_class = df_med_values[df_med_values['no_of_replicates'] == key]
-        for cpd in df_replicate_class.index:
-            dose_p_values = []
-            for num in dose_list:
-                dose_name = 'dose_' + str(num)
-                cpd_p_value = get_p_value(null_dist_median[key][num-1], df_replicate_class, dose_name, cpd)
-                dose_p_values.append(cpd_p_value)
-            null_p_vals[cpd] = dose_p_values
-    sorted_null_p_vals = {key:value for key, value in sorted(null_p_vals.items(), key=lambda item: item[0])}
-    return sorted_null_p_vals
-
-
 # In[30]:
 
 
-null_p_vals = get_moa_p_vals(null_distribution_medians, dose_list, df_cpd_med_scores)
+null_p_vals = get_null_p_values(null_distribution_medians, dose_list, df_cpd_med_scores, 'no_of_replicates')
 
 
 # In[31]:
@@ -13,6 +13,7 @@
 
 import re
 import os
+import sys
 import pathlib
 import pandas as pd
 import numpy as np
@@ -23,6 +24,11 @@ import pickle
 sns.set_style("darkgrid")
 sns.set_context("talk")
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from feature_store import open_feature_store
+from correlation import rank_standardize, spearman_corr
+
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
@@ -52,8 +58,12 @@ df_null_p_vals = pd.read_csv(os.path.join(cp_level4_path, 'cpd_replicate_p_value
 # In[5]:
 
 
-df_level4 = pd.read_csv(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 
+                 'Metadata_Plate', 'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 
+                 'broad_id', 'pert_iname', 'moa', 'replicate_name']
+feature_store = open_feature_store(os.path.join(cp_level4_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                                   'Metadata_dose_recode', 'replicate_name', metadata_cols, 
+                                   compression='gzip',low_memory = False)
 
 with open(os.path.join(cp_level4_path, 'null_distribution.pickle'), 'rb') as handle:
     null_distribution_replicates = pickle.load(handle)
@@ -205,19 +215,15 @@ plot_median_score_distribution(df_medians_p_vals, "Median score distribution acr
 # In[17]:
 
 
-def get_replicate_score(cpds_list, df):
+def get_replicate_score(cpds_list, feature_store, dose):
     
     """
     This function computes the spearman replicate correlation scores 
-    between replicates for all compounds
+    between replicates for all compounds, from zero-copy views of the feature store
     """
     cpds_replicate_score = []
     for cpd in cpds_list:
-        cpd_replicates = df[df['pert_iname'] == cpd].copy()
-        cpd_replicates.drop(['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 'Metadata_Plate', 
-                             'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 'broad_id', 
-                             'pert_iname', 'moa', 'replicate_name'], axis = 1, inplace = True)
-        cpd_replicates_corr = cpd_replicates.astype('float64').T.corr(method = 'spearman').values
+        cpd_replicates_corr = spearman_corr(feature_store.get_cpd_features(dose, cpd))
         cpds_replicate_score += list(cpd_replicates_corr[np.triu_indices(len(cpd_replicates_corr), k = 1)])
     return cpds_replicate_score
 
@@ -225,20 +231,19 @@ def get_replicate_score(cpds_list, df):
 # In[18]:
 
 
-def get_true_replicate_score(df, df_lvl4):
+def get_true_replicate_score(df, feature_store):
     
     """This function gets the true spearman percentile correlation scores for all compounds across all doses (1-6)"""
     
-    dose_list = list(set(df_lvl4['Metadata_dose_recode'].unique().tolist()))[1:7]
+    dose_list = feature_store.doses[1:7]
     cpd_sizes =  df['no_of_replicates'].unique().tolist()
     df = df.set_index('cpd').rename_axis(None, axis=0)
     true_replicates = {}
     for dose in dose_list:
         rep_list = []
-        df_dose = df_lvl4[df_lvl4['Metadata_dose_recode'] == dose].copy()
         for keys in cpd_sizes:
             cpds_keys = df[df['no_of_replicates'] == keys].index
-            replicates_vals = get_replicate_score(cpds_keys, df_dose)
+            replicates_vals = get_replicate_score(cpds_keys, feature_store, dose)
             rep_list += replicates_vals
         true_replicates[dose] = rep_list
     return true_replicates
@@ -247,24 +252,20 @@ def get_true_replicate_score(df, df_lvl4):
 # In[19]:
 
 
-true_replicates = get_true_replicate_score(df_cpd_median_scores, df_level4)
+true_replicates = get_true_replicate_score(df_cpd_median_scores, feature_store)
 
 
 # In[20]:
 
 
-def get_random_replicate_score(random_rep_list, df):
+def get_random_replicate_score(random_rep_list, ranked, rep_index):
     
     """This function computes the spearman correlation scores between random replicates"""
     
-    df_dose_ = df.set_index('replicate_name').rename_axis(None, axis=0)
-    df_dose_.drop(['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 'Metadata_Plate', 
-                   'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 
-                   'broad_id', 'pert_iname', 'moa'], axis = 1, inplace = True)
     rep_corr_list = []
     for rep_list in random_rep_list:
-        df_reps = df_dose_.loc[rep_list].copy()
-        reps_corr = df_reps.astype('float64').T.corr(method = 'spearman').values
+        reps = ranked[rep_index.get_indexer(rep_list)]
+        reps_corr = reps @ reps.T
         rep_corr_list += list(reps_corr[np.triu_indices(len(reps_corr), k = 1)])
     return rep_corr_list
 
@@ -272,7 +273,7 @@ def get_random_replicate_score(random_rep_list, df):
 # In[21]:
 
 
-def get_rand_replicate_corr(df_lvl4, null_dist):
+def get_rand_replicate_corr(feature_store, null_dist):
     """
     This function gets spearman correlation values 
     between randomly selected replicates across all doses (1-6)
@@ -281,14 +282,15 @@ def get_rand_replicate_corr(df_lvl4, null_dist):
     all the correlation scores between randomly selected replicates 
     as the values
     """
-    dose_list = list(set(df_lvl4['Metadata_dose_recode'].unique().tolist()))[1:7]
+    dose_list = feature_store.doses[1:7]
     random_replicates = {}
     for dose in dose_list:
         rep_list = []
-        df_dose = df_lvl4[df_lvl4['Metadata_dose_recode'] == dose].copy()
+        ranked = rank_standardize(feature_store.get_dose_features(dose), dtype='float32')
+        rep_index = pd.Index(feature_store.get_dose_metadata(dose)['replicate_name'].values)
         for key in null_dist:
             rand_rep_list = null_dist[key][dose-1]
-            rep_list += get_random_replicate_score(rand_rep_list, df_dose)
+            rep_list += get_random_replicate_score(rand_rep_list, ranked, rep_index)
         random_replicates[dose] = rep_list
     return random_replicates
 
@@ -296,7 +298,7 @@ def get_rand_replicate_corr(df_lvl4, null_dist):
 # In[22]:
 
 
-random_replicates = get_rand_replicate_corr(df_level4, null_distribution_replicates)
+random_replicates = get_rand_replicate_corr(feature_store, null_distribution_replicates)
 
 
 # In[23]:
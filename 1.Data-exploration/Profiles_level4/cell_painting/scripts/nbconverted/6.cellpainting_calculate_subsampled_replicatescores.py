@@ -9,6 +9,7 @@
 
 
 import os
+import sys
 import pathlib
 import pandas as pd
 import numpy as np
@@ -23,6 +24,11 @@ sns.set_style("darkgrid")
 from scipy import stats
 import pickle
 
+##custom modules required
+sys.path.append('../../exploration_helpers')
+from replicate_scores import get_cpd_medianscores
+from profile_ingestion import read_profiles, recode_dose, feature_selection
+
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
@@ -61,56 +67,13 @@ pertinfo_file = '../aligned_moa_CP_L1000.csv'
 # In[6]:
 
 
-df_level4 = pd.read_csv(spherized_profile_link, compression='gzip',low_memory = False)
-
-
-# In[7]:
-
-
-def recode_dose(dose_value):
-    """This function recode the doses in Level-4 data to 8 distinct dose classes"""
-    
-    doses = [0.04,0.12,0.37,1.11,3.33,10.0,20.0,25.0]
-    for x in range(len(doses)-1):
-        if (dose_value > 0.0) & (dose_value <= 0.04):
-            dose_value = 0.04
-        elif doses[x] <= round(dose_value,2) < doses[x+1]:
-            dose_value = doses[x]
-    return dose_value
+df_level4 = read_profiles(spherized_profile_link, compression='gzip', low_memory = False)
 
 
 # In[8]:
 
 
-df_level4['Metadata_dose_recode'] = df_level4['Metadata_mmoles_per_liter'].apply(recode_dose)
-
-
-# In[9]:
-
-
-def feature_selection(df_lvl4): 
-    """
-    Perform feature selection by dropping columns with null values 
-    (greater than 384 i.e. equivalent to one plate worth of cell profiles) 
-    and highly correlated values from the data.
-    """
-    metadata_columns = [x for x in df_lvl4.columns if (x.startswith("Metadata_"))]
-    df_lvl4_metadata = df_lvl4[metadata_columns].copy()
-    df_lvl4_features = df_lvl4.drop(metadata_columns, axis = 1)
-    null_cols = [col for col in df_lvl4_features.columns if df_lvl4_features[col].isnull().sum() > 384]
-    df_lvl4_features.drop(null_cols, axis = 1, inplace=True)
-    ##feature selection was done already..prior to getting the spherized data!!
-    ###df_lvl4_features = feature_select(df_lvl4_features, operation=["correlation_threshold", "variance_threshold"])
-    
-    for col in df_lvl4_features.columns:
-        if df_lvl4_features[col].isnull().sum():
-            df_lvl4_features[col].fillna(value=df_lvl4_features[col].mean(), inplace = True)
-            
-    df_meta_info = df_lvl4_metadata[['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_Plate', 'Metadata_Well',
-                                     'Metadata_broad_id', 'Metadata_moa', 'Metadata_dose_recode']].copy()
-    df_lvl4_new = pd.concat([df_meta_info, df_lvl4_features], axis=1)
-    
-    return df_lvl4_new
+df_level4['Metadata_dose_recode'] = recode_dose(df_level4['Metadata_mmoles_per_liter'])
 
 
 # In[10]:
@@ -153,70 +116,12 @@ df_level4_new, df_level4_no_cpds = merge_dataframe(df_level4_new, pertinfo_file)
 df_level4_no_cpds['Metadata_broad_sample'].unique().tolist()
 
 
-# In[14]:
-
-
-def get_median_score(cpds_list, df):
-    """
-    This function calculates the median score for each compound based on its replicates
-    """
-    
-    cpds_median_score = {}
-    for cpd in cpds_list:
-        cpd_replicates = df[df['pert_iname'] == cpd].copy()
-        cpd_replicates.drop(['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 'Metadata_Plate',
-                             'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 'broad_id', 
-                             'pert_iname', 'moa', 'replicate_name'], axis = 1, inplace = True)
-        cpd_replicates_corr = cpd_replicates.astype('float64').T.corr(method = 'spearman').values
-        if len(cpd_replicates_corr) == 1:
-            median_val = 1
-        else:
-            median_val = median(list(cpd_replicates_corr[np.triu_indices(len(cpd_replicates_corr), k = 1)]))
-        
-        cpds_median_score[cpd] = median_val
-        
-    return cpds_median_score
-
-
-# In[15]:
-
-
-def check_compounds(cpd_med_score, df):
-    """
-    Check if all distinct compounds in the Level-4 dataframe are present 
-    in the cpd_med_score dictionary, if not add the compounds as keys to the dictionary 
-    and give them a null value.
-    """
-    cpd_list = df['pert_iname'].unique().tolist()
-    cpd_keys = cpd_med_score.keys()
-    for cpd in cpd_list:
-        if cpd not in cpd_keys:
-            cpd_med_score[cpd] = np.nan
-            
-    return cpd_med_score
-
-
 # In[16]:
 
 
-def get_cpd_medianscores(df):
-    
-    """This function computes median scores for all compounds found in the Level-4 dataframe PER DOSE (1-6)"""
-    
-    dose_list = list(set(df['Metadata_dose_recode'].unique().tolist()))[1:7]
-    
-    for dose in dose_list:
-        df_dose = df[df['Metadata_dose_recode'] == dose].copy()
-        cpds_list = df_dose['pert_iname'].unique().tolist()
-        cpds_median_score = get_median_score(cpds_list, df_dose)
-        cpds_median_score = check_compounds(cpds_median_score, df)
-        sorted_med_score = {key:value for key, value in sorted(cpds_median_score.items(), key=lambda item: item[0])}
-        if dose == 1:
-            df_cpd_med_score = pd.DataFrame.from_dict(sorted_med_score, orient='index', columns = ['dose_1'])
-        else:
-            df_cpd_med_score['dose_' + str(dose)] = sorted_med_score.values()
-            
-    return df_cpd_med_score
+metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode', 'Metadata_Plate',
+                 'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa', 'broad_id', 
+                 'pert_iname', 'moa', 'replicate_name']
 
 
 # In[17]:
@@ -252,7 +157,7 @@ df_level4_new_subsample.shape
 # In[21]:
 
 
-df_cpd_med_score = get_cpd_medianscores(df_level4_new_subsample)
+df_cpd_med_score = get_cpd_medianscores(df_level4_new_subsample, 'Metadata_dose_recode', metadata_cols)
 df_cpd_med_score.head(10)
 
 
@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+from moa_scores import get_cpd_corr
+from dose_executor import run_per_dose
+
+def get_moa_share_matrix(cpds, all_moa_dict):
+    """
+    Build a boolean compound x compound matrix that is True where two compounds are found in the same moa
+
+    params:
+    cpds: numpy array of compounds
+    all_moa_dict: Dict with moa as the keys, and the list of compounds for each moa as the values
+
+    Returns:
+    share_moa: 2D boolean numpy array, in the same order as cpds
+    """
+    cpd_index = pd.Index(cpds)
+    moa_membership = np.zeros((len(all_moa_dict), len(cpds)), dtype=np.int64)
+    for moa_idx, moa in enumerate(all_moa_dict):
+        cpd_idx = cpd_index.get_indexer(all_moa_dict[moa])
+        moa_membership[moa_idx, cpd_idx[cpd_idx >= 0]] = 1
+    return (moa_membership.T @ moa_membership) > 0
+
+def draw_random_cpds(n_cpds, moa_size, in_moa_size, share_moa, rand_num, rng, max_draws=100, batch_size=1000):
+    """
+    This function returns rand_num distinct arrays of random compound positions, with the same constraint
+    as get_random_cpds: a set is rejected only if it has a compound of the current moa_size class AND two
+    of its compounds are found in the same moa. Sets are drawn as integer arrays, a batch at a time
+    (moa_size distinct compounds per set, drawn uniformly with random keys), and checked all at once.
+
+    params:
+    n_cpds: number of compounds to draw from
+    moa_size: number of compounds in each set
+    in_moa_size: boolean numpy array, True for the compounds of the current moa_size class
+    share_moa: boolean compound x compound matrix (output of get_moa_share_matrix)
+    rand_num: number of distinct sets to draw
+    rng: numpy random Generator
+    max_draws: maximum number of batches to draw, as a multiple of the batches needed for rand_num sets
+    batch_size: number of sets drawn at once
+
+    Returns:
+    rand_cpds_list: integer numpy array of shape (rand_num, moa_size)
+    """
+    if moa_size > n_cpds:
+        raise ValueError(f"Cannot draw {moa_size} distinct compounds from {n_cpds} compounds")
+    upper_idx = np.triu_indices(moa_size, k = 1)
+    rand_cpds_list = []
+    seen_cpds = set()
+    for _ in range(max_draws * int(np.ceil(rand_num / batch_size))):
+        rand_cpds = np.argpartition(rng.random((batch_size, n_cpds)), moa_size - 1, axis = 1)[:, :moa_size]
+        similar_cpds = share_moa[rand_cpds[:, upper_idx[0]], rand_cpds[:, upper_idx[1]]].any(axis = 1)
+        rejected = in_moa_size[rand_cpds].any(axis = 1) & similar_cpds
+        for cpds in rand_cpds[~rejected]:
+            cpds_key = tuple(sorted(cpds.tolist()))
+            if cpds_key not in seen_cpds:
+                seen_cpds.add(cpds_key)
+                rand_cpds_list.append(cpds)
+                if len(rand_cpds_list) == rand_num:
+                    return np.array(rand_cpds_list)
+    raise ValueError(f"Could not draw {rand_num} distinct lists of {moa_size} compounds")
+
+def get_null_distribution_cpds(moa_size_dict, cpds_list, all_moa_dict, rand_num = 1000, seed = 1903):
+
+    """
+    This function returns the null distribution dictionary, with moa_sizes as the keys and
+    1000 lists of randomly selected compounds combinations as the values for each moa_size class.
+    Every moa_size class gets its own random generator seeded with (seed, moa_size), so the
+    null distribution is reproducible.
+
+    params:
+    moa_size_dict: Dict with moa_size as the keys, and all compounds of moas with that size as the values
+    cpds_list: list of compounds to draw from (e.g. compounds found in all doses)
+    all_moa_dict: Dict with moa as the keys, and the list of compounds for each moa as the values
+    rand_num: number of random compound lists per moa_size
+    seed: random seed
+
+    Returns:
+    null_distribution_moa: Dict with moa_size as the keys, and rand_num lists of compounds as the values
+    """
+    cpds = np.array(sorted(cpds_list), dtype=object)
+    share_moa = get_moa_share_matrix(cpds, all_moa_dict)
+    null_distribution_moa = {}
+    for size in moa_size_dict:
+        in_moa_size = pd.Index(cpds).isin(moa_size_dict[size])
+        rng = np.random.default_rng([seed, int(size)])
+        rand_cpds = draw_random_cpds(len(cpds), int(size), in_moa_size, share_moa, rand_num, rng)
+        null_distribution_moa[size] = cpds[rand_cpds].tolist()
+    return null_distribution_moa
+
+def calc_null_dist_median_scores(cpds_corr, cpd_index, moa_cpds_list):
+    """
+    This function calculate the median of the correlation values for each of the list in the
+    1000 lists of random compounds combination for a moa_size, by gathering the upper-triangle
+    entries of all lists at once from the compound x compound correlation matrix of the dose.
+
+    params:
+    cpds_corr: compound x compound correlation matrix of the dose (output of get_cpd_corr)
+    cpd_index: pandas Index that maps compounds to the rows/columns of cpds_corr
+    moa_cpds_list: list of lists of random compounds, all lists with the same length
+
+    Returns:
+    median_corr_list: list of median correlation values, one for each list of compounds
+    """
+    cpd_rows = cpd_index.get_indexer(np.asarray(moa_cpds_list).ravel()).reshape(len(moa_cpds_list), -1)
+    if (cpd_rows < 0).any():
+        raise KeyError("Some compounds in the null distribution are not found in the dose")
+    upper_idx = np.triu_indices(cpd_rows.shape[1], k = 1)
+    cpds_corr_vals = cpds_corr[cpd_rows[:, upper_idx[0]], cpd_rows[:, upper_idx[1]]]
+    return np.median(cpds_corr_vals, axis = 1).tolist()
+
+def get_dose_null_medians(dose, cpd_agg_values, cpds, null_distribution_moa):
+    """
+    Calculate the median correlation scores of the random compound lists of every
+    moa_size class in a dose, from the aggregated compound signatures of the dose
+    """
+    cpds_corr = get_cpd_corr(pd.DataFrame(cpd_agg_values, index = cpds))
+    cpd_index = pd.Index(cpds)
+    return {key:calc_null_dist_median_scores(cpds_corr, cpd_index, null_distribution_moa[key])
+            for key in null_distribution_moa}
+
+def get_null_dist_median_scores(null_distribution_moa, df_cpd_aggs, n_jobs=None, verbose=False):
+    """
+    This function calculate the median correlation scores for all
+    1000 lists of randomly combined compounds for each moa_size class
+    across all doses (1-6). The compound correlation matrix of each dose is
+    computed once and shared by all moa_size classes, doses are processed
+    in parallel (see run_per_dose).
+
+    params:
+    null_distribution_moa: Dict with moa_size as the keys, and the lists of random compounds as the values
+    df_cpd_aggs: list of the aggregated compound dataframes (compounds as the index, only feature columns)
+    of every dose (1-6), in dose order
+    n_jobs: number of worker processes, defaults to the number of CPUs; 1 runs in the current process
+    verbose: If True, prints the run time of each dose
+
+    Returns:
+    null_distribution_medians: Dict with moa_size as the keys, and the median scores per dose as the values
+    """
+    dose_inputs = {dose:(df_cpd_agg.values.astype('float64'), df_cpd_agg.index.values)
+                   for dose, df_cpd_agg in enumerate(df_cpd_aggs, start = 1)}
+    dose_medians, _ = run_per_dose(get_dose_null_medians, dose_inputs, (null_distribution_moa,), n_jobs, verbose)
+    null_distribution_medians = {key:[dose_medians[dose][key] for dose in dose_inputs] for key in null_distribution_moa}
+    return null_distribution_medians
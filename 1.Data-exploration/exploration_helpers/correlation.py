@@ -0,0 +1,83 @@
+import numpy as np
+from scipy.stats import rankdata
+
+def rank_standardize(values, dtype='float64'):
+    """
+    This function rank-transforms every row (replicate profile) of a 2D array, using average ranks
+    for ties, then centers and scales each row to unit length. The dot product of two standardized
+    rows is then exactly the Spearman correlation between the two replicates.
+
+    Args:
+            values: 2D numpy array - replicates as rows and features as columns.
+            dtype: dtype of the returned array, ranks are always standardized in float64 first.
+
+    Returns:
+            ranked: 2D numpy array with the same shape as values.
+    """
+    ranked = rankdata(values, axis=1)
+    ranked -= ranked.mean(axis=1, keepdims=True)
+    norms = np.sqrt(np.einsum('ij,ij->i', ranked, ranked))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ranked /= norms[:, None]
+    return ranked.astype(dtype, copy=False)
+
+def _iter_ranked_blocks(ranked, ranked_other, block_size):
+    """Row blocks of the product of two rank-standardized arrays"""
+    for start in range(0, len(ranked), block_size):
+        rows = slice(start, min(start + block_size, len(ranked)))
+        yield rows, ranked[rows] @ ranked_other.T
+
+def iter_spearman_blocks(values, other=None, dtype='float32', block_size=4096):
+    """
+    This function computes the Spearman correlation matrix between the rows of values (and the rows of
+    other, if given) block by block, for matrices too large to hold the full result in memory. The rows
+    are rank-transformed only once, every block is a single matrix product.
+
+    Args:
+            values: 2D numpy array - profiles as rows and features as columns.
+            other: optional 2D numpy array with the same number of columns, default (None) correlates
+            values with itself.
+            dtype: 'float32' (default) or 'float64', dtype of the ranks and of the matrix products;
+            float32 halves the memory and doubles the GEMM throughput of the large matrices this mode is
+            for, but its rounding changes the correlation values in the 7th digit, pass 'float64' for
+            values that are published.
+            block_size: number of rows of values in each block.
+
+    Returns:
+            Generator of (rows, block) tuples, where rows is the slice of the rows of values in the block
+            and block the correlation values between these rows and all rows of other (or values).
+    """
+    ranked = rank_standardize(values, dtype)
+    ranked_other = ranked if other is None else rank_standardize(other, dtype)
+    return _iter_ranked_blocks(ranked, ranked_other, block_size)
+
+def spearman_corr(values, other=None, dtype='float64', block_size=None, out=None):
+    """
+    This function computes the Spearman correlation matrix between the rows of values (and the rows of
+    other, if given), the same values as pandas DataFrame.corr(method='spearman') on the transposed data
+    for profiles without missing values. Rows are rank-transformed (average ranks for ties) and
+    standardized once, and the correlation matrix is a single multithreaded BLAS matrix product.
+
+    Args:
+            values: 2D numpy array - profiles as rows and features as columns.
+            other: optional 2D numpy array with the same number of columns, default (None) correlates
+            values with itself.
+            dtype: 'float64' (default) or 'float32', an explicit opt-in for values that are not
+            published, e.g. plots (see iter_spearman_blocks).
+            block_size: if given, the matrix is computed block_size rows at a time into out.
+            out: optional preallocated array (e.g. a np.memmap) of shape (rows of values, rows of other)
+            the matrix is written to, one block at a time.
+
+    Returns:
+            corr: 2D numpy array of the Spearman correlation values.
+    """
+    ranked = rank_standardize(values, dtype)
+    ranked_other = ranked if other is None else rank_standardize(other, dtype)
+    if (block_size is None) and (out is None):
+        return ranked @ ranked_other.T
+
+    if out is None:
+        out = np.empty((len(ranked), len(ranked_other)), dtype=dtype)
+    for rows, block in _iter_ranked_blocks(ranked, ranked_other, block_size or 4096):
+        out[rows] = block
+    return out
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import warnings
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+def share_dose_input(dose_input, shared_blocks):
+    """
+    This function copies a numeric numpy array to a new shared memory block (appended to shared_blocks)
+    and returns its spec, other inputs (e.g. lists, object arrays) are returned as they are and pickled.
+    """
+    if isinstance(dose_input, np.ndarray) and not dose_input.dtype.hasobject:
+        shm = shared_memory.SharedMemory(create=True, size=max(dose_input.nbytes, 1))
+        shared_blocks.append(shm)
+        np.ndarray(dose_input.shape, dtype=dose_input.dtype, buffer=shm.buf)[...] = dose_input
+        return ('shared', shm.name, dose_input.shape, dose_input.dtype.str)
+    return ('value', dose_input)
+
+def attach_shared_block(name):
+    """
+    This function attaches to an existing shared memory block, the block is owned (and unlinked) by the
+    parent process. Older Pythons have no track argument, forked and spawned workers then share the
+    resource tracker of the parent, which already tracks the block.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def limit_blas_threads(n_threads):
+    """
+    Pool initializer that caps the BLAS/OpenMP threads of a worker process, so that the workers together
+    use about as many threads as there are CPUs instead of n_jobs times that many. Environment variables
+    such as OMP_NUM_THREADS have no effect here, the BLAS library is already loaded when the initializer runs.
+    """
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+
+def get_dose_context(dose_func):
+    """
+    This function returns the multiprocessing context of the dose workers, or None if the doses have to
+    run in the current process. Functions imported from a module run in spawned workers, like the training
+    workers of the MOA models, which is safe on every platform. Functions defined in a notebook (or in the
+    __main__ script) cannot be pickled to spawned workers, they run in forked workers on Linux only: the
+    workers only call numpy/scipy code, OpenBLAS shuts its thread pool down around a fork, and the
+    exploration notebooks start no other threads (e.g. torch) before the fork. On macOS fork is unsafe
+    with the Accelerate BLAS and Windows has no fork, so such functions run in the current process there.
+    """
+    if getattr(dose_func, '__module__', '__main__') != '__main__':
+        return multiprocessing.get_context('spawn')
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    return None
+
+def run_dose_task(task):
+    """
+    This function runs dose_func on the inputs of one dose, shared arrays are read-only zero-copy views
+    of the shared memory blocks. Returns the dose, the result and the run time in seconds.
+    """
+    dose, dose_func, input_specs, func_args = task
+    attached = []
+    dose_inputs = []
+    for spec in input_specs:
+        if spec[0] == 'shared':
+            shm = attach_shared_block(spec[1])
+            attached.append(shm)
+            dose_inputs.append(np.ndarray(spec[2], dtype=np.dtype(spec[3]), buffer=shm.buf))
+            dose_inputs[-1].flags.writeable = False
+        else:
+            dose_inputs.append(spec[1])
+    try:
+        start = time.perf_counter()
+        result = dose_func(dose, *dose_inputs, *func_args)
+        elapsed = time.perf_counter() - start
+    finally:
+        ##views of the shared blocks have to be released before the blocks are closed
+        dose_inputs.clear()
+        for shm in attached:
+            shm.close()
+    return dose, result, elapsed
+
+def run_per_dose(dose_func, dose_inputs, func_args=(), n_jobs=None, verbose=False):
+    """
+    This function runs dose_func for every dose in a pool of worker processes instead of one dose after
+    another, i.e. the "for dose in dose_list" loops of the exploration notebooks. The numeric arrays of each
+    dose (e.g. the features of its replicates) are copied once to shared memory, and workers read them
+    as zero-copy views instead of receiving a pickled copy.
+
+    Args:
+            dose_func: function called as dose_func(dose, *dose_inputs[dose], *func_args), it must be defined
+            at module level (or in the notebook) and must not return views of its input arrays.
+            dose_inputs: dictionary with doses as the keys and a tuple of inputs of the dose as the values,
+            numeric numpy arrays are shared, other inputs are pickled to the worker.
+            func_args: tuple of extra arguments passed to dose_func for every dose.
+            n_jobs: number of worker processes, defaults to the number of CPUs (at most one per dose);
+            1 runs all doses in the current process. Workers are spawned, or forked for functions defined
+            in a notebook, which only run in worker processes on Linux (see get_dose_context). Each worker
+            is limited to cpu_count // n_jobs BLAS threads if threadpoolctl is installed.
+            verbose: If True, prints the run time of each dose.
+
+    Returns:
+            dose_results: dictionary with doses as the keys (in the order of dose_inputs) and the output of
+            dose_func as the values.
+            dose_timings: dictionary with doses as the keys and the run time (in seconds) of each dose.
+    """
+    dose_list = list(dose_inputs)
+    n_cpus = os.cpu_count() or 1
+    n_jobs = min(n_jobs or n_cpus, max(len(dose_list), 1))
+    context = get_dose_context(dose_func) if n_jobs > 1 else None
+    if (n_jobs > 1) and (context is None):
+        warnings.warn(f'{dose_func.__name__} is defined in a notebook and can only run in forked workers on '
+                      'Linux, the doses run in the current process')
+        n_jobs = 1
+    dose_results = {}
+    dose_timings = {}
+    if n_jobs == 1:
+        for dose in dose_list:
+            start = time.perf_counter()
+            dose_results[dose] = dose_func(dose, *dose_inputs[dose], *func_args)
+            dose_timings[dose] = time.perf_counter() - start
+            if verbose:
+                print(f'dose {dose}: {dose_timings[dose]:.2f}s')
+        return dose_results, dose_timings
+
+    shared_blocks = []
+    try:
+        tasks = [(dose, dose_func, [share_dose_input(dose_input, shared_blocks) for dose_input in dose_inputs[dose]],
+                  tuple(func_args)) for dose in dose_list]
+        blas_threads = max(n_cpus // n_jobs, 1)
+        with context.Pool(n_jobs, limit_blas_threads, (blas_threads,)) as pool:
+            ##imap returns the results in dose order, whatever order the doses finish in
+            for dose, result, elapsed in pool.imap(run_dose_task, tasks):
+                dose_results[dose] = result
+                dose_timings[dose] = elapsed
+                if verbose:
+                    print(f'dose {dose}: {elapsed:.2f}s')
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+    return dose_results, dose_timings
@@ -0,0 +1,174 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from level4_cache import get_source_checksum, read_level4_csv
+
+def build_feature_store(df, store_dir, dose_col, replicate_col, metadata_cols, cpd_col='pert_iname',
+                        dtype='float64', source_checksum=None, chunk_size=10000):
+    """
+    This function saves the features of a Level-4 dataframe as a single contiguous .npy file, with the
+    replicates sorted by (dose, compound, replicate), together with the sorted metadata and an index of
+    the row range of every dose and every (dose, compound) in the file.
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns.
+            store_dir: Directory where the store is saved.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns in df.
+            cpd_col: A string that indicates the compound name column.
+            dtype: dtype of the saved features, 'float64' (default) keeps the csv values, so the Spearman
+            ranks computed from the store are those of the csv file. 'float32' halves the store, but
+            rounds the features and can change the rank order of near-tied values.
+            source_checksum: checksum of the source csv file, saved in the index to detect a stale store.
+            chunk_size: number of rows written to the .npy file at once.
+
+    Output:
+            features.npy, metadata.parquet and index.json in store_dir
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    order = np.lexsort((df[replicate_col].astype(str).values, df[cpd_col].astype(str).values, df[dose_col].values))
+    df_meta = df[metadata_cols].iloc[order].reset_index(drop=True)
+    feature_cols = [col for col in df.columns if col not in metadata_cols]
+
+    tmp_path = os.path.join(store_dir, f'features.npy.{os.getpid()}.tmp')
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(len(df), len(feature_cols)))
+    df_feats = df[feature_cols]
+    for start in range(0, len(df), chunk_size):
+        features[start:start + chunk_size] = df_feats.iloc[order[start:start + chunk_size]].values
+    features.flush()
+    del features
+    os.replace(tmp_path, os.path.join(store_dir, 'features.npy'))
+    df_meta.to_parquet(os.path.join(store_dir, 'metadata.parquet'), index=False)
+
+    ##row ranges of every dose and (dose, compound), rows of a group are contiguous after sorting
+    dose_ranges = {}
+    cpd_ranges = {}
+    doses, cpds = df_meta[dose_col].values, df_meta[cpd_col].astype(str).values
+    dose_codes, cpd_codes = pd.factorize(doses)[0], pd.factorize(cpds)[0]
+    changes = np.flatnonzero((dose_codes[1:] != dose_codes[:-1]) | (cpd_codes[1:] != cpd_codes[:-1])) + 1
+    bounds = np.concatenate(([0], changes, [len(df_meta)])).tolist() if len(df_meta) else [0]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        dose_key, cpd = str(doses[start]), cpds[start]
+        dose_ranges[dose_key] = [dose_ranges.get(dose_key, [start])[0], stop]
+        cpd_ranges.setdefault(dose_key, {})[cpd] = [start, stop]
+
+    index = {'dose_col': dose_col, 'cpd_col': cpd_col, 'replicate_col': replicate_col, 'dtype': dtype,
+             'source_checksum': source_checksum, 'metadata_cols': list(metadata_cols), 'feature_cols': feature_cols,
+             'doses': sorted(df_meta[dose_col].unique().tolist()),
+             'dose_ranges': dose_ranges, 'cpd_ranges': cpd_ranges}
+    with open(os.path.join(store_dir, 'index.json'), 'w') as handle:
+        json.dump(index, handle)
+
+class Level4FeatureStore:
+    """
+    Read-only view of a feature store saved by build_feature_store. The features are memory-mapped, so
+    dose and compound slices are zero-copy views of the file, and row ranges are dictionary lookups.
+    Worker processes receive the store by its path (see __reduce__), not a copy of the features.
+
+    Args:
+            store_dir: Directory where the store was saved.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'index.json')) as handle:
+            self.index = json.load(handle)
+        self.features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='r')
+        self.metadata = pd.read_parquet(os.path.join(store_dir, 'metadata.parquet'))
+        self.feature_cols = self.index['feature_cols']
+        self.doses = self.index['doses']
+
+    def __reduce__(self):
+        return (Level4FeatureStore, (self.store_dir,))
+
+    def get_dose_rows(self, dose):
+        """Row range (slice) of all replicates of a dose"""
+        start, stop = self.index['dose_ranges'].get(str(dose), [0, 0])
+        return slice(start, stop)
+
+    def get_cpd_rows(self, dose, cpd):
+        """Row range (slice) of the replicates of a compound in a dose, empty if there are none"""
+        start, stop = self.index['cpd_ranges'].get(str(dose), {}).get(cpd, [0, 0])
+        return slice(start, stop)
+
+    def get_dose_features(self, dose):
+        """Zero-copy view of the features of all replicates of a dose"""
+        return self.features[self.get_dose_rows(dose)]
+
+    def get_cpd_features(self, dose, cpd):
+        """Zero-copy view of the features of the replicates of a compound in a dose"""
+        return self.features[self.get_cpd_rows(dose, cpd)]
+
+    def get_dose_metadata(self, dose):
+        """Metadata of all replicates of a dose, in the same order as get_dose_features"""
+        return self.metadata.iloc[self.get_dose_rows(dose)]
+
+def get_dose_replicates(df, dose, dose_col, metadata_cols):
+    """
+    This function returns the metadata and the float64 features of all replicates of a dose, from a Level-4
+    dataframe or from a Level4FeatureStore, whose dose features are zero-copy views of the memory-mapped
+    store instead of copies.
+    """
+    if isinstance(df, Level4FeatureStore):
+        return df.get_dose_metadata(dose), np.asarray(df.get_dose_features(dose), dtype='float64')
+    df_dose = df[df[dose_col] == dose]
+    return df_dose, df_dose.drop(metadata_cols, axis = 1).values.astype('float64')
+
+def is_store_valid(store_dir, index, dose_col, replicate_col, metadata_cols, cpd_col, dtype, checksum):
+    """
+    This function checks that a saved store was built from the same csv file with the same dtype, the same
+    column layout (dose, compound and replicate columns, metadata and feature columns) and that its files
+    hold the rows and features listed in its index.
+    """
+    expected = {'source_checksum': checksum, 'dtype': dtype, 'dose_col': dose_col, 'cpd_col': cpd_col,
+                'replicate_col': replicate_col, 'metadata_cols': list(metadata_cols)}
+    if any(index.get(key) != value for key, value in expected.items()):
+        return False
+    try:
+        features = np.load(os.path.join(store_dir, 'features.npy'), mmap_mode='r')
+        ##the row count is read from the parquet footer, reading no columns returns an empty dataframe
+        num_rows = pq.ParquetFile(os.path.join(store_dir, 'metadata.parquet')).metadata.num_rows
+    except (OSError, ValueError):
+        return False
+    dose_stops = [stop for _, stop in index['dose_ranges'].values()]
+    return ((features.shape == (num_rows, len(index['feature_cols']))) and (str(features.dtype) == dtype)
+            and (max(dose_stops, default=0) == num_rows))
+
+def open_feature_store(file_path, dose_col, replicate_col, metadata_cols, store_dir=None, cpd_col='pert_iname',
+                       dtype='float64', **read_csv_kwargs):
+    """
+    This function opens the feature store of a Level-4 csv file, the store is (re)built from the csv file
+    if it does not exist yet, if the csv file, the dtype or the column layout changed since it was built,
+    or if its files do not match its index (see is_store_valid).
+
+    Args:
+            file_path: path of the Level-4 csv file.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns in the csv file.
+            store_dir: Directory of the store, defaults to a <file name>_store folder next to the csv file.
+            cpd_col: A string that indicates the compound name column.
+            dtype: dtype of the saved features, 'float64' (default) or 'float32' (see build_feature_store).
+            read_csv_kwargs: keyword arguments passed to read_level4_csv e.g. compression='gzip'.
+
+    Returns:
+            feature_store: Level4FeatureStore
+    """
+    if store_dir is None:
+        store_dir = os.path.join(os.path.dirname(file_path), os.path.basename(file_path).split('.')[0] + '_store')
+    os.makedirs(store_dir, exist_ok=True)
+    checksum = get_source_checksum(file_path, store_dir)
+    index_path = os.path.join(store_dir, 'index.json')
+    if os.path.exists(index_path):
+        with open(index_path) as handle:
+            index = json.load(handle)
+        if is_store_valid(store_dir, index, dose_col, replicate_col, metadata_cols, cpd_col, dtype, checksum):
+            return Level4FeatureStore(store_dir)
+        os.remove(index_path)
+
+    df = read_level4_csv(file_path, **read_csv_kwargs)
+    build_feature_store(df, store_dir, dose_col, replicate_col, metadata_cols, cpd_col, dtype, checksum)
+    del df
+    return Level4FeatureStore(store_dir)
@@ -0,0 +1,43 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+##HDF5 nodes of the GCTX format, the data matrix is saved as (columns x rows) i.e. one signature per HDF5 row
+GCTX_DATA_NODE = '/0/DATA/0/matrix'
+GCTX_ROW_ID_NODE = '/0/META/ROW/id'
+GCTX_COL_ID_NODE = '/0/META/COL/id'
+
+def read_gctx_ids(gctx_path, id_node=GCTX_COL_ID_NODE):
+    """This function returns the row (gene) or column (signature) ids of a GCTX file, without reading the data"""
+    with h5py.File(gctx_path, 'r') as gctx_file:
+        ids = gctx_file[id_node][()]
+    return pd.Index(ids.astype('str'))
+
+def read_gctx_columns(gctx_path, cids=None, chunk_size=1000):
+    """
+    This function reads the data of a GCTX file by column (signature) chunks, so that only the requested
+    signatures are read from disk and at most chunk_size signatures are decoded at once.
+
+    Args:
+            gctx_path: path of the GCTX file.
+            cids: list of the column (signature) ids to read, default (None) reads all columns.
+            chunk_size: number of columns read from the HDF5 file at once.
+
+    Returns:
+            Generator of pandas dataframes (float32), with the signatures as the index and the row (gene) ids
+            as the columns, in the order the signatures are saved in the file.
+    """
+    with h5py.File(gctx_path, 'r') as gctx_file:
+        rids = pd.Index(gctx_file[GCTX_ROW_ID_NODE][()].astype('str'))
+        all_cids = pd.Index(gctx_file[GCTX_COL_ID_NODE][()].astype('str'))
+        cidx = np.arange(len(all_cids)) if cids is None else np.flatnonzero(all_cids.isin(cids))
+        data_dset = gctx_file[GCTX_DATA_NODE]
+        for start in range(0, len(cidx), chunk_size):
+            chunk_idx = cidx[start:start + chunk_size]
+            ##h5py reads a list of increasing indices along the first axis without reading the rows in between
+            chunk_data = data_dset[chunk_idx.tolist(), :].astype(np.float32)
+            yield pd.DataFrame(chunk_data, index=all_cids[chunk_idx], columns=rids)
+
+def get_sig_id(replicate_ids):
+    """This function maps L1000 Level-4 replicate ids to the sig_id of their Level-5 signature"""
+    return pd.Series(replicate_ids).str.replace(r'(24H.+(\_|\.)[A-Z0-9]+.)\:', '24H:', regex=True)
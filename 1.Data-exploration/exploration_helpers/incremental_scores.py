@@ -0,0 +1,143 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from correlation import rank_standardize
+
+def get_row_hashes(values):
+    """This function returns a fingerprint of every row (replicate profile) of a 2D array"""
+    values = np.ascontiguousarray(values)
+    return [hashlib.blake2b(row.tobytes(), digest_size=16).hexdigest() for row in values]
+
+def load_median_state(state_path):
+    """This function loads the saved (compound, dose) correlation state, or an empty state if there is none"""
+    if not os.path.exists(state_path):
+        return {'feature_cols': None, 'id_cols': None, 'groups': {}}
+    with open(state_path, 'rb') as handle:
+        return pickle.load(handle)
+
+def save_median_state(state, state_path):
+    """This function saves the (compound, dose) correlation state, through a temporary file"""
+    state_dir = os.path.dirname(state_path)
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+    tmp_path = state_path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, state_path)
+
+def get_group_median(corr):
+    """Median of the pairwise correlation values of a group: 1 for a single replicate, NaN for none"""
+    if len(corr) == 0:
+        return np.nan
+    if len(corr) == 1:
+        return 1
+    return np.median(corr[np.triu_indices(len(corr), k = 1)])
+
+def update_cpd_medianscores(df, dose_col, id_cols, metadata_cols, state_path, cpd_col='pert_iname'):
+    """
+    This function computes the same median scores as get_cpd_medianscores, but incrementally: the pairwise
+    replicate correlation matrix of every (compound, dose) group is saved in state_path, keyed by a stable
+    id of every replicate (e.g. its plate, well, compound and dose, not its position in the dataframe),
+    together with a fingerprint of each replicate profile. On the next run, only the groups with new
+    or changed replicates are recomputed, groups that only lost replicates are updated by dropping rows and
+    columns of their saved matrix, and all other groups are reused as they are.
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns, features should have
+            no missing values.
+            dose_col: A string that indicates the dose number column.
+            id_cols: A list of the metadata columns that identify a replicate across runs, e.g. its plate,
+            well, compound and dose columns, a ValueError is raised if two replicates have the same id.
+            metadata_cols: A list of all non-feature columns in df.
+            state_path: Path of the pickle file with the saved correlation state, created if it does not
+            exist; every group is recomputed if the feature or id columns changed since it was saved.
+            cpd_col: A string that indicates the compound name column.
+
+    Returns:
+            df_cpd_med_score: pandas dataframe with compounds (sorted) as the index and the median scores
+            for each dose (dose_1 - dose_6) as the columns, compounds without replicates in a dose are
+            given a null value.
+            updated_cpds: sorted list of the compounds with at least one recomputed, updated or removed group.
+    """
+    dose_list = sorted(df[dose_col].dropna().unique().tolist())[1:7]
+    df_doses = df[df[dose_col].isin(dose_list) & df[cpd_col].notnull()].reset_index(drop=True)
+    all_cpds = sorted(df[cpd_col].dropna().unique().tolist())
+    feature_cols = [col for col in df.columns if col not in metadata_cols]
+    id_cols = list(id_cols)
+    duplicated = df_doses.duplicated(subset=id_cols, keep=False)
+    if duplicated.any():
+        dup_ids = df_doses.loc[duplicated, id_cols].drop_duplicates().head(5).values.tolist()
+        raise ValueError(f"{duplicated.sum()} replicates do not have a unique id ({', '.join(id_cols)}), e.g. {dup_ids}")
+    features = df_doses[feature_cols].values.astype('float64')
+    row_hashes = get_row_hashes(features)
+    rep_ids = list(zip(*[df_doses[col].values.tolist() for col in id_cols]))
+
+    state = load_median_state(state_path)
+    same_columns = (state['feature_cols'] == feature_cols) and (state.get('id_cols') == id_cols)
+    old_groups = state['groups'] if same_columns else {}
+    new_groups = {}
+    recompute = {}
+    for key, rows in df_doses.groupby([cpd_col, dose_col], sort=False).indices.items():
+        replicates = [(rep_ids[row], row_hashes[row]) for row in rows]
+        old = old_groups.get(key)
+        if (old is not None) and (old['replicates'] == replicates):
+            new_groups[key] = old
+            continue
+        ##replicate ids are unique, so every saved replicate has a single position in the saved matrix
+        old_pos = {} if old is None else {rep:pos for pos, rep in enumerate(old['replicates'])}
+        if (old is not None) and all(rep in old_pos for rep in replicates):
+            pos = [old_pos[rep] for rep in replicates]
+            corr = old['corr'][np.ix_(pos, pos)]
+            new_groups[key] = {'replicates': replicates, 'corr': corr, 'median': get_group_median(corr)}
+        else:
+            recompute[key] = (replicates, rows)
+
+    ##rank transform the replicates of the recomputed groups only
+    if recompute:
+        recompute_rows = np.concatenate([rows for _, rows in recompute.values()])
+        ranked = rank_standardize(features[recompute_rows])
+        start = 0
+        for key, (replicates, rows) in recompute.items():
+            group_ranked = ranked[start:start + len(rows)]
+            start += len(rows)
+            corr = group_ranked @ group_ranked.T
+            new_groups[key] = {'replicates': replicates, 'corr': corr, 'median': get_group_median(corr)}
+
+    changed_keys = set(recompute) | {key for key in new_groups if new_groups[key] is not old_groups.get(key)}
+    changed_keys |= set(old_groups) - set(new_groups)
+    updated_cpds = sorted({cpd for cpd, _ in changed_keys})
+    save_median_state({'feature_cols': feature_cols, 'id_cols': id_cols, 'groups': new_groups}, state_path)
+
+    df_cpd_med_score = pd.DataFrame(np.nan, index = all_cpds, columns = ['dose_' + str(dose) for dose in dose_list])
+    for (cpd, dose), group in new_groups.items():
+        df_cpd_med_score.loc[cpd, 'dose_' + str(dose)] = group['median']
+    return df_cpd_med_score, updated_cpds
+
+def patch_median_scores_csv(df_cpd_med_score, updated_cpds, path, file_name):
+    """
+    This function replaces the rows of the updated compounds in a saved median scores csv file (with the
+    compounds in a 'cpd' column) by their rows in df_cpd_med_score, the other rows are left as they are.
+    The csv file is written from scratch if it does not exist yet.
+
+    Args:
+            df_cpd_med_score: pandas dataframe with compounds as the index, as it would be saved in full.
+            updated_cpds: list of compounds to patch (output of update_cpd_medianscores), compounds missing
+            from df_cpd_med_score are removed from the csv file.
+            path: Directory of the csv file.
+            file_name: csv file name.
+    """
+    file_path = os.path.join(path, file_name)
+    df_patched = df_cpd_med_score.reset_index().rename({'index':'cpd'}, axis = 1)
+    if os.path.exists(file_path):
+        df_saved = pd.read_csv(file_path)
+        df_patched = pd.concat([df_saved[~df_saved['cpd'].isin(updated_cpds)],
+                                df_patched[df_patched['cpd'].isin(updated_cpds)]])
+        df_patched = df_patched.sort_values('cpd').reset_index(drop=True)
+
+    if not os.path.exists(path):
+        os.mkdir(path)
+    tmp_path = file_path + f'.{os.getpid()}.tmp'
+    df_patched.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, file_path)
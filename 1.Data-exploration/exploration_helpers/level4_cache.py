@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import glob
+import hashlib
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import pyarrow.ipc as ipc
+
+CACHE_FORMATS = ['parquet', 'feather']
+
+def get_file_checksum(file_path, chunk_size=2**24):
+    """This function returns the sha256 checksum of a file, the file is read in chunks of chunk_size bytes"""
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_source_checksum(file_path, cache_dir):
+    """
+    This function returns the checksum of a source csv file. Checksums are saved in a manifest in cache_dir
+    together with the size and modification time of the file, so an unchanged file is not hashed again.
+    """
+    manifest_path = os.path.join(cache_dir, 'checksums.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+
+    file_stat = os.stat(file_path)
+    file_key = os.path.abspath(file_path)
+    entry = manifest.get(file_key)
+    if (entry is not None) and (entry['size'] == file_stat.st_size) and (entry['mtime_ns'] == file_stat.st_mtime_ns):
+        return entry['checksum']
+
+    checksum = get_file_checksum(file_path)
+    manifest[file_key] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns, 'checksum': checksum}
+    tmp_path = manifest_path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as handle:
+        json.dump(manifest, handle, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return checksum
+
+def get_cache_path(file_path, cache_dir, checksum, float32, cache_format, read_csv_kwargs):
+    """
+    Path of the cached copy of a source csv file: <file name>.<source checksum>.<options key>.<format>,
+    where the options key covers the float32 option and the read_csv arguments used to parse the file.
+    """
+    file_name = re.sub(r'(\.csv)?(\.gz)?$', '', os.path.basename(file_path))
+    options = json.dumps({'float32': float32, 'read_csv': read_csv_kwargs}, sort_keys=True, default=str)
+    options_key = hashlib.sha256(options.encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, f'{file_name}.{checksum[:16]}.{options_key}.{cache_format}')
+
+def build_level4_cache(file_path, cache_path, float32=False, cache_format='parquet', **read_csv_kwargs):
+    """
+    This function parses a source csv file once and saves it as a Parquet/Feather file in cache_path,
+    with float64 columns downcast to float32 if float32 is True. Caches of older versions of the same source
+    file (i.e. with a different checksum) are removed.
+    """
+    df = pd.read_csv(file_path, **read_csv_kwargs)
+    if float32:
+        float_cols = df.select_dtypes(include='float64').columns
+        df[float_cols] = df[float_cols].astype(np.float32)
+
+    cache_dir, cache_name = os.path.split(cache_path)
+    file_name, checksum = cache_name.rsplit('.', 3)[:2]
+    for cache_ext in CACHE_FORMATS:
+        for old_cache in glob.glob(os.path.join(cache_dir, f'{glob.escape(file_name)}.*.*.{cache_ext}')):
+            if os.path.basename(old_cache).rsplit('.', 3)[1] != checksum:
+                os.remove(old_cache)
+
+    ##write to a temporary file first, so that a crash never leaves a truncated cache behind
+    tmp_path = cache_path + f'.{os.getpid()}.tmp'
+    if cache_format == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, cache_path)
+
+def get_cache_columns(cache_path, cache_format='parquet'):
+    """This function returns the column names of a cached file, without reading its data"""
+    if cache_format == 'parquet':
+        return pq.read_schema(cache_path).names
+    with ipc.open_file(cache_path) as reader:
+        return reader.schema.names
+
+def read_level4_csv(file_path, usecols=None, projection=None, metadata_cols=None, float32=False, cache_dir=None,
+                    cache_format='parquet', **read_csv_kwargs):
+    """
+    This function is a drop-in replacement of pd.read_csv for the (wide) Level-4 replicate csv files. The first
+    call parses the csv file and saves it as a typed Parquet/Feather cache keyed by the checksum of the source
+    file; later calls read the cache instead, and only the requested columns are read from disk.
+
+    Args:
+            file_path: path of the source csv file.
+            usecols: list of column names to read, default (None) reads all columns.
+            projection: None, 'metadata' (only metadata_cols) or 'features' (all columns except metadata_cols).
+            metadata_cols: A list of all non-feature columns, required when projection is given.
+            float32: If True, float columns are cached and returned as float32 instead of float64.
+            cache_dir: Directory where the cached files are saved, defaults to a level4_cache folder next to
+            the source file.
+            cache_format: 'parquet' or 'feather'.
+            read_csv_kwargs: keyword arguments passed to pd.read_csv when the cache is built,
+            e.g. compression='gzip', low_memory=False.
+
+    Returns:
+            df: pandas dataframe, same as the one returned by pd.read_csv (restricted to the requested columns).
+    """
+    if cache_format not in CACHE_FORMATS:
+        raise ValueError(f"cache_format must be one of {CACHE_FORMATS}, got {cache_format!r}")
+    if (projection is not None) and (metadata_cols is None):
+        raise ValueError("metadata_cols is required to read the 'metadata' or 'features' projection")
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_path), 'level4_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    checksum = get_source_checksum(file_path, cache_dir)
+    cache_path = get_cache_path(file_path, cache_dir, checksum, float32, cache_format, read_csv_kwargs)
+    if not os.path.exists(cache_path):
+        build_level4_cache(file_path, cache_path, float32, cache_format, **read_csv_kwargs)
+
+    columns = usecols
+    if projection is not None:
+        all_columns = usecols if usecols is not None else get_cache_columns(cache_path, cache_format)
+        if projection == 'metadata':
+            columns = [col for col in all_columns if col in metadata_cols]
+        elif projection == 'features':
+            columns = [col for col in all_columns if col not in metadata_cols]
+        else:
+            raise ValueError(f"projection must be None, 'metadata' or 'features', got {projection!r}")
+
+    if cache_format == 'parquet':
+        df = pd.read_parquet(cache_path, columns=columns)
+    else:
+        df = pd.read_feather(cache_path, columns=columns)
+    return df
@@ -0,0 +1,233 @@
+import os
+import time
+import argparse
+import pandas as pd
+import numpy as np
+from feature_store import open_feature_store
+from replicate_scores import get_cpd_medianscores
+from signature_strength import compute_SS_activity_score, get_dmso_activity_percentile
+from null_pipeline import ASSAY_COLUMNS, run_null_pipeline, get_cpds_replicates, get_replicates_classes_per_dose
+from null_pipeline import get_null_medians_per_dose, save_to_pickle
+from p_values import get_null_p_values
+
+ASSAY_OUTPUTS = {
+    'cp': {
+        'plate_col': 'Metadata_Plate',
+        'activity_col': 'MAS',
+        'all_scores_file': 'cp_all_scores.csv',
+        'dmso_file': 'CP_dmso_95_percentile_MAS.pickle',
+        'cpd_summary_file': 'median_score_per_compound_CellPainting.tsv.gz',
+    },
+    'L1000': {
+        'plate_col': 'det_plate',
+        'activity_col': 'TAS',
+        'all_scores_file': 'L1000_all_scores.csv',
+        'dmso_file': 'L1000_dmso_95_percentile_TAS.pickle',
+        'cpd_summary_file': 'median_score_per_compound_L1000.tsv.gz',
+    },
+}
+
+DOSE_NAMES = {'dose_1': '0.04 uM', 'dose_2': '0.12 uM', 'dose_3': '0.37 uM',
+              'dose_4': '1.11 uM', 'dose_5': '3.33 uM', 'dose_6': '10 uM'}
+
+def get_cpd_dataframe(feature_store, cpd, cpd_col='pert_iname'):
+    """
+    This function returns the Level-4 dataframe (metadata and feature columns) of the replicates of a compound
+    (e.g. DMSO) in a feature store, only the features of these replicates are read from the store
+    """
+    rows = np.flatnonzero((feature_store.metadata[cpd_col] == cpd).values)
+    df_features = pd.DataFrame(feature_store.features[rows], columns=feature_store.feature_cols,
+                               index=feature_store.metadata.index[rows])
+    return pd.concat([feature_store.metadata.iloc[rows], df_features], axis=1)
+
+def drop_cpds_with_null(df_med_scores):
+    """
+    This function drops the compounds with median scores of 1 or null values in any of the doses (1-6),
+    as the median score notebooks do
+    """
+    with_null = ((df_med_scores == 1) | df_med_scores.isnull()).any(axis = 1)
+    return df_med_scores[~with_null].copy()
+
+def get_no_of_replicates(df_med_scores, df_meta, dose_list, dose_col, cpd_col='pert_iname'):
+    """
+    This function returns the number of replicates of every compound (index of df_med_scores), i.e. its
+    number of replicates in all doses (1-6) divided by the number of doses, as the median score notebooks do
+    """
+    df_doses = df_meta[df_meta[dose_col].isin(dose_list)]
+    cpd_no_of_reps = df_doses[cpd_col].value_counts().reindex(df_med_scores.index, fill_value=0)
+    return (cpd_no_of_reps // len(dose_list)).values
+
+def run_level4_pipeline(feature_store, dose_col, replicate_col, metadata_cols, plate_col, cpd_col='pert_iname',
+                        rand_num = 1000, seed = 1903, shard_dir = None, n_jobs = None, verbose = False):
+    """
+    This function runs the data stages of the Level-4 notebooks 1-3 back to back, with the same helpers
+    the notebooks call: the compound median scores (get_cpd_medianscores), the signature strength and
+    activity score (compute_SS_activity_score, get_dmso_activity_percentile), the null distribution
+    (run_null_pipeline) and the p-values (get_null_p_values). The stages read the features of each dose as
+    views of the memory-mapped feature store (see get_dose_replicates) instead of a dataframe of the whole
+    feature block, the dose stages share their feature blocks with the worker processes through shared
+    memory (see run_per_dose and run_null_pipeline), and every intermediate table is handed to the next
+    stage in memory instead of through csv/pickle files.
+
+    Args:
+            feature_store: Level4FeatureStore of the Level-4 replicates.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns.
+            plate_col: A string that indicates the plate column, for the DMSO activity scores.
+            cpd_col: A string that indicates the compound name column.
+            rand_num: number of random replicate lists per replicate class and dose.
+            seed: random seed.
+            shard_dir: Directory where the null distribution cells are checkpointed, default (None) keeps
+            them in memory only.
+            n_jobs: number of worker processes, defaults to the number of CPUs; 1 runs in the current process.
+            verbose: If True, prints the run time of each stage.
+
+    Returns:
+            level4_results: dictionary with the outputs of every stage: median_scores (with no_of_replicates),
+            signature_strength, activity_score, dmso_95_percentile, null_distribution,
+            null_distribution_medians, null_medians_per_dose and p_values (with no_of_replicates).
+    """
+    df_meta = feature_store.metadata
+    dose_list = sorted(df_meta[dose_col].dropna().unique().tolist())[1:7]
+    num_feats = len(feature_store.feature_cols)
+
+    ##stage 1 - median scores of the compounds
+    start = time.perf_counter()
+    df_med_scores = get_cpd_medianscores(feature_store, dose_col, metadata_cols, cpd_col, n_jobs = n_jobs)
+    df_med_scores = drop_cpds_with_null(df_med_scores)
+    df_med_scores['no_of_replicates'] = get_no_of_replicates(df_med_scores, df_meta, dose_list, dose_col, cpd_col)
+    if verbose:
+        print(f'median scores: {time.perf_counter() - start:.2f}s')
+
+    ##stage 2 - signature strength and activity score (MAS/TAS), of the compounds and of the DMSO plates
+    start = time.perf_counter()
+    df_cpd_ss, df_activity = compute_SS_activity_score(feature_store,
+                                                       df_med_scores.drop(['no_of_replicates'], axis = 1),
+                                                       dose_col, metadata_cols, num_feats)
+    dmso_95pct = get_dmso_activity_percentile(get_cpd_dataframe(feature_store, 'DMSO', cpd_col), plate_col,
+                                              metadata_cols, num_feats)
+    if verbose:
+        print(f'signature strength & activity score: {time.perf_counter() - start:.2f}s')
+
+    ##stage 3 - null distribution and p-values
+    start = time.perf_counter()
+    cpds_replicates = get_cpds_replicates(df_med_scores, df_meta, dose_list, dose_col, replicate_col)
+    cpd_replicate_class_dict = get_replicates_classes_per_dose(df_med_scores, cpds_replicates, dose_list)
+    null_distribution_reps, null_distribution_medians = run_null_pipeline(
+        feature_store, cpd_replicate_class_dict, dose_list, cpds_replicates, dose_col, replicate_col,
+        metadata_cols, shard_dir, rand_num = rand_num, seed = seed, n_jobs = n_jobs)
+    null_p_vals = get_null_p_values(null_distribution_medians, dose_list, df_med_scores, 'no_of_replicates')
+    df_null_p_vals = pd.DataFrame.from_dict(null_p_vals, orient='index', columns = ['dose_' + str(x) for x in dose_list])
+    df_null_p_vals['no_of_replicates'] = df_med_scores['no_of_replicates']
+    if verbose:
+        print(f'null distribution & p-values: {time.perf_counter() - start:.2f}s')
+
+    return {'median_scores': df_med_scores, 'signature_strength': df_cpd_ss, 'activity_score': df_activity,
+            'dmso_95_percentile': dmso_95pct, 'null_distribution': null_distribution_reps,
+            'null_distribution_medians': null_distribution_medians,
+            'null_medians_per_dose': get_null_medians_per_dose(null_distribution_medians, dose_list),
+            'p_values': df_null_p_vals}
+
+def get_all_scores(df_med_scores, df_cpd_ss, df_activity, activity_col):
+    """
+    This function merges the median scores (replicate correlation), signature strength (SS) and activity
+    score (MAS/TAS) of each compound for all doses (1-6), with the actual doses as the dose values
+    """
+    score_cols = {'replicate_correlation': df_med_scores, 'signature_strength': df_cpd_ss, activity_col: df_activity}
+    df_all_scores = None
+    for col_name, df in score_cols.items():
+        df_vals = df.drop(columns = ['no_of_replicates'], errors='ignore').rename(columns = DOSE_NAMES)
+        df_vals = df_vals.rename_axis('cpd').reset_index().melt(id_vars=['cpd'], var_name="dose", value_name=col_name)
+        df_all_scores = df_vals if df_all_scores is None else pd.merge(df_all_scores, df_vals, on=['cpd', 'dose'],
+                                                                        how='inner')
+    return df_all_scores
+
+def get_cpd_score_summary(df_med_scores):
+    """This function returns the median score of every compound per dose in a long dataframe"""
+    df_summary = df_med_scores.rename_axis('compound').reset_index().melt(
+        id_vars=["compound", "no_of_replicates"], value_vars=list(DOSE_NAMES), var_name="dose",
+        value_name="median_replicate_score")
+    df_summary['dose'] = df_summary['dose'].replace(DOSE_NAMES)
+    return df_summary
+
+def save_level4_results(level4_results, assay, data_dir, results_dir):
+    """
+    This function saves the final artifacts of the Level-4 pipeline, with the same file names and formats
+    the notebooks 1-3 save them with
+    """
+    outputs = ASSAY_OUTPUTS[assay]
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(results_dir, exist_ok=True)
+    df_med_scores = level4_results['median_scores']
+    df_med_scores.rename_axis('cpd').reset_index().to_csv(os.path.join(data_dir, 'cpd_replicate_median_scores.csv'),
+                                                          index=False)
+    get_cpd_score_summary(df_med_scores).to_csv(os.path.join(results_dir, outputs['cpd_summary_file']), sep="\t",
+                                                index=False)
+    df_all_scores = get_all_scores(df_med_scores, level4_results['signature_strength'],
+                                   level4_results['activity_score'], outputs['activity_col'])
+    df_all_scores.to_csv(os.path.join(data_dir, outputs['all_scores_file']), index=False)
+    save_to_pickle(level4_results['dmso_95_percentile'], data_dir, outputs['dmso_file'])
+    save_to_pickle(level4_results['null_distribution'], data_dir, 'null_distribution.pickle')
+    save_to_pickle(level4_results['null_medians_per_dose'], data_dir, 'null_dist_medians_per_dose.pickle')
+    level4_results['p_values'].rename_axis('cpd').reset_index().to_csv(
+        os.path.join(data_dir, 'cpd_replicate_p_values.csv'), index=False)
+
+def level4_pipeline(assay=None, data_dir=None, level4_file=None, results_dir=None, rand_num=None, seed=None,
+                    shard_dir=None, n_jobs=None):
+    """
+    This function runs the Level-4 analysis (median scores, SS/activity scores, null distribution and
+    p-values) on the Level-4 replicates csv file saved by notebook 1 in data_dir, and saves only the final
+    artifacts, the figures are left to the visualization notebook.
+
+    Args:
+            assay: 'cp' (Cell painting) or 'L1000'.
+            data_dir: Directory with the Level-4 replicates csv file, where the outputs are saved.
+            level4_file: Level-4 replicates csv file name.
+            results_dir: Directory where the median score summary per compound is saved.
+            rand_num: number of random replicate lists per replicate class and dose.
+            seed: random seed.
+            shard_dir: Directory where the null distribution cells are checkpointed, None to not checkpoint.
+            n_jobs: number of worker processes.
+
+    Output:
+            cpd_replicate_median_scores.csv, <assay> all scores csv, DMSO 95th percentile pickle,
+            null_distribution.pickle, null_dist_medians_per_dose.pickle and cpd_replicate_p_values.csv
+            in data_dir, median score summary per compound in results_dir
+    """
+    columns = ASSAY_COLUMNS[assay]
+    feature_store = open_feature_store(os.path.join(data_dir, level4_file), columns['dose_col'],
+                                       columns['replicate_col'], columns['metadata_cols'], compression='gzip',
+                                       low_memory = False)
+    level4_results = run_level4_pipeline(feature_store, columns['dose_col'], columns['replicate_col'],
+                                         columns['metadata_cols'], ASSAY_OUTPUTS[assay]['plate_col'],
+                                         rand_num = rand_num, seed = seed, shard_dir = shard_dir, n_jobs = n_jobs,
+                                         verbose = True)
+    save_level4_results(level4_results, assay, data_dir, results_dir)
+    print("Done!! saved the Level-4 median scores, SS/activity scores, null distribution and p-values")
+
+def parse_args():
+    """Arguments to pass to this Script"""
+
+    parser = argparse.ArgumentParser(description="Parse arguments")
+    parser.add_argument('--assay', type=str, default='cp', choices=list(ASSAY_COLUMNS), nargs='?',
+                        help='Assay of the Level-4 profiles: cp (Cell painting) or L1000')
+    parser.add_argument('--data_dir', type=str, default='cellpainting_lvl4_cpd_replicate_datasets', nargs='?',
+                        help='Directory with the Level-4 replicates csv file, where the outputs are saved')
+    parser.add_argument('--level4_file', type=str, default='cp_level4_cpd_replicates.csv.gz', nargs='?',
+                        help='Level-4 replicates csv file name')
+    parser.add_argument('--results_dir', type=str, default='../results', nargs='?',
+                        help='Directory where the median score summary per compound is saved')
+    parser.add_argument('--rand_num', type=int, default=1000, nargs='?',
+                        help='Number of random replicate lists per replicate class and dose')
+    parser.add_argument('--seed', type=int, default=1903, nargs='?', help='Random seed')
+    parser.add_argument('--shard_dir', type=str, default=None, nargs='?',
+                        help='Directory where each null distribution (dose, replicate class) is checkpointed')
+    parser.add_argument('--n_jobs', type=int, default=None, nargs='?',
+                        help='Number of worker processes, defaults to the number of CPUs')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    level4_pipeline(args.assay, args.data_dir, args.level4_file, args.results_dir, args.rand_num, args.seed,
+                    args.shard_dir, args.n_jobs)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+from correlation import spearman_corr
+
+def get_cpd_corr(df_cpd_agg, dtype='float64'):
+    """
+    Compute the Spearman correlation matrix between all compounds of a dose at once: every compound
+    signature is rank-transformed a single time, and the matrix is the product of the rank-standardized
+    signatures, instead of re-ranking the compounds of every MOA separately.
+
+    params:
+    df_cpd_agg: consensus dataframe of a particular dose aggregated per compound,
+    with compounds as the index and only feature columns
+    dtype: 'float64' (default) or 'float32', precision of the correlation matrix
+
+    Returns:
+    cpds_corr: 2D numpy array of the compound x compound spearman correlation values,
+    in the same order as df_cpd_agg.index
+
+    """
+    return spearman_corr(df_cpd_agg.values.astype('float64'), dtype=dtype)
+
+def get_cpds_median(cpds_corr, cpd_idx):
+    """
+    Get the median of the correlation values between a set of compounds,
+    gathered from the compound x compound correlation matrix of their dose.
+
+    params:
+    cpds_corr: compound x compound correlation matrix (output of get_cpd_corr)
+    cpd_idx: positions of the compounds in cpds_corr
+
+    Returns:
+    median_val: median of the pairwise correlation values, 1 for a single compound
+
+    """
+    if len(cpd_idx) == 1:
+        return 1
+    cpd_idx = np.asarray(cpd_idx)
+    upper_idx = np.triu_indices(len(cpd_idx), k = 1)
+    return np.median(cpds_corr[cpd_idx[upper_idx[0]], cpd_idx[upper_idx[1]]])
+
+def get_median_score(moa_list, df_dose, df_cpd_agg, moa_col='moa', cpd_col='pert_iname'):
+
+    """
+    Get the correlation values between compounds of each MOA,
+    then calculate the median of these correlation values
+    and assign it as the "median score" of the MOA.
+
+    The correlation matrix between all compounds of the dose is computed once (get_cpd_corr),
+    the median score of each MOA is then a gather over the positions of its compounds.
+
+    params:
+    moa_list: list of distinct moas for a particular dose
+    df_dose: merged consensus and moa dataframe of a partcular dose
+    df_cpd_agg: consensus dataframe of a particular dose aggregated per compound (only feature columns)
+    moa_col: moa column name in df_dose
+    cpd_col: compound column name in df_dose
+
+    Returns:
+    moa_median_score: Dict with moa as the keys, and their median scores as the values
+    moa_cpds: Dict with moa as the keys, and the list of compounds for each moa as the values
+
+    """
+    cpds_corr = get_cpd_corr(df_cpd_agg)
+    cpd_index = pd.Index(df_cpd_agg.index)
+    ##compounds of each moa, in order of first appearance in df_dose
+    dose_moa_cpds = df_dose[[moa_col, cpd_col]].drop_duplicates().groupby(moa_col, sort=False)[cpd_col].agg(list)
+
+    moa_cpds = {}
+    moa_median_score = {}
+    for moa in moa_list:
+        cpds = dose_moa_cpds[moa]
+        moa_cpds[moa] = cpds
+        moa_median_score[moa] = get_cpds_median(cpds_corr, cpd_index.get_indexer(cpds))
+
+    return moa_median_score, moa_cpds
+
+def get_dose_median_score(dose, cpd_agg_values, cpds, df_dose_moas, moa_col='moa', cpd_col='pert_iname'):
+    """
+    Get the median score of every moa in a dose (see get_median_score), from the aggregated compound
+    signatures of the dose, in the form used by run_per_dose to process the doses in parallel
+
+    params:
+    dose: dose number
+    cpd_agg_values: 2D numpy array of the aggregated compound signatures of the dose
+    cpds: compounds of the rows of cpd_agg_values
+    df_dose_moas: moa and compound columns of the merged consensus and moa dataframe of the dose
+
+    Returns:
+    moa_median_score: Dict with moa as the keys, and their median scores as the values
+    moa_cpds: Dict with moa as the keys, and the list of compounds for each moa as the values
+
+    """
+    df_cpd_agg = pd.DataFrame(cpd_agg_values, index = cpds)
+    moa_list = df_dose_moas[moa_col].unique().tolist()
+    return get_median_score(moa_list, df_dose_moas, df_cpd_agg, moa_col, cpd_col)
@@ -0,0 +1,342 @@
+import os
+import argparse
+import pickle
+import hashlib
+import pandas as pd
+import numpy as np
+from multiprocessing import Pool
+from correlation import rank_standardize
+from null_sampler import get_dose_replicate_map, draw_random_replicates, get_null_cell_rng
+from null_scores import calc_null_dist_median_scores_from_ranked
+from feature_store import Level4FeatureStore, open_feature_store
+from dose_executor import share_dose_input, attach_shared_block
+
+ASSAY_COLUMNS = {
+    'cp': {
+        'dose_col': 'Metadata_dose_recode',
+        'replicate_col': 'replicate_name',
+        'metadata_cols': ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_dose_recode',
+                          'Metadata_Plate', 'Metadata_Well', 'Metadata_broad_id', 'Metadata_moa',
+                          'broad_id', 'pert_iname', 'moa', 'replicate_name'],
+    },
+    'L1000': {
+        'dose_col': 'dose',
+        'replicate_col': 'replicate_id',
+        'metadata_cols': ['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose',
+                          'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well'],
+    },
+}
+
+##version of the null distribution draws, shards of an older sampler are recomputed
+SHARD_VERSION = 3
+
+##state shared by all null distribution cells in a (worker) process, set by init_null_worker
+_worker_state = {}
+
+def init_null_worker(dose_data, cpd_replicate_class_dict, rand_num, seed, shard_dir):
+    """
+    This function stores the inputs shared by all null distribution cells in the (worker) process, dose_data
+    holds the spec of the rank-standardized replicates (see share_dose_input), the replicate ids and the
+    replicate layout of every dose.
+    """
+    _worker_state.update(dose_data=dose_data, cpd_replicate_class_dict=cpd_replicate_class_dict,
+                         rand_num=rand_num, seed=seed, shard_dir=shard_dir, ranked={}, attached=[])
+
+def get_dose_data(df, dose, cpd_replicate_dict, dose_col, replicate_col, metadata_cols):
+    """This function returns the features, the replicate ids (of the feature rows) and the replicate layout of a dose"""
+    if isinstance(df, Level4FeatureStore):
+        dose_features = df.get_dose_features(dose)
+        df_dose = df.get_dose_metadata(dose)
+    else:
+        df_dose = df[df[dose_col] == dose]
+        dose_features = df_dose.drop(metadata_cols, axis = 1).values
+    rep_index = pd.Index(df_dose[replicate_col].values)
+    rep_layout = get_dose_replicate_map(cpd_replicate_dict, dose)
+    return dose_features, rep_index, rep_layout
+
+def get_dose_checksum(dose_features, rep_index, rep_layout):
+    """
+    Checksum of the data shared by all cells of a dose: the Level-4 features and replicate ids of the dose
+    and the replicates of every compound in the dose
+    """
+    rep_names, _, rep_counts = rep_layout
+    checksum = hashlib.sha1(str(SHARD_VERSION).encode())
+    checksum.update(np.ascontiguousarray(dose_features, dtype='float64').tobytes())
+    for reps in [rep_index, rep_names]:
+        checksum.update('\0'.join(map(str, reps)).encode() + b'\1')
+    checksum.update(np.asarray(rep_counts, dtype=np.int64).tobytes())
+    return checksum.hexdigest()
+
+def get_data_checksum(dose_checksum, class_reps):
+    """
+    Checksum of the data a (dose, replicate class) cell is computed from: the checksum of the dose (see
+    get_dose_checksum) and the replicates of the class
+    """
+    checksum = hashlib.sha1(dose_checksum.encode())
+    checksum.update('\0'.join(map(str, class_reps)).encode())
+    return checksum.hexdigest()
+
+def get_shard_path(shard_dir, dose, replicate_class):
+    """Path of the checkpoint shard of a (dose, replicate class) cell"""
+    return os.path.join(shard_dir, f'dose_{dose}_class_{replicate_class}.pickle')
+
+def load_shard(shard_path, rand_num, seed, checksum):
+    """
+    This function returns the content of a checkpoint shard, or None if the shard does not exist
+    or was computed with a different number of random lists, seed or data (see get_data_checksum).
+    """
+    if not os.path.exists(shard_path):
+        return None
+    with open(shard_path, 'rb') as handle:
+        shard = pickle.load(handle)
+    if (shard['rand_num'] != rand_num) | (shard['seed'] != seed) | (shard.get('checksum') != checksum):
+        return None
+    return shard
+
+def save_shard(shard_path, shard):
+    """This function saves a checkpoint shard"""
+    ##write to a temporary file first, so that a crash never leaves a truncated shard behind
+    tmp_path = shard_path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(shard, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, shard_path)
+
+def get_ranked_dose(dose):
+    """
+    Read-only view of the rank-standardized replicates of a dose, a worker attaches to the shared memory
+    block of a dose once for all the cells of the dose it runs
+    """
+    ranked = _worker_state['ranked']
+    if dose not in ranked:
+        spec = _worker_state['dose_data'][dose][0]
+        if spec[0] == 'shared':
+            shm = attach_shared_block(spec[1])
+            _worker_state['attached'].append(shm)
+            ranked[dose] = np.ndarray(spec[2], dtype=np.dtype(spec[3]), buffer=shm.buf)
+            ranked[dose].flags.writeable = False
+        else:
+            ranked[dose] = spec[1]
+    return ranked[dose]
+
+def run_null_cell(task):
+    """
+    This function computes a (dose, replicate class) cell of the null distribution, i.e. the random
+    replicate lists of the class and their median correlation scores, from the rank-standardized
+    replicates of the dose, and saves the cell to its checkpoint shard. Returns the dose, the replicate
+    class and the shard.
+    """
+    dose, replicate_class, checksum = task
+    rand_num, seed, shard_dir = _worker_state['rand_num'], _worker_state['seed'], _worker_state['shard_dir']
+    _, rep_index, rep_layout = _worker_state['dose_data'][dose]
+    class_reps = _worker_state['cpd_replicate_class_dict'][replicate_class][dose-1]
+    rng = get_null_cell_rng(seed, dose, replicate_class)
+    replicate_list = draw_random_replicates(*rep_layout, int(replicate_class), rand_num, rng, class_reps)
+    median_list = calc_null_dist_median_scores_from_ranked(get_ranked_dose(dose), rep_index, replicate_list)
+    shard = {'dose': dose, 'replicate_class': replicate_class, 'rand_num': rand_num, 'seed': seed,
+             'checksum': checksum, 'replicates': replicate_list, 'medians': median_list}
+    if shard_dir is not None:
+        save_shard(get_shard_path(shard_dir, dose, replicate_class), shard)
+    return dose, replicate_class, shard
+
+def run_null_pipeline(df, cpd_replicate_class_dict, dose_list, cpd_replicate_dict, dose_col, replicate_col,
+                      metadata_cols, shard_dir, rand_num = 1000, seed = 1903, n_jobs = None):
+    """
+    This function generates the null distribution replicates and their median correlation scores for
+    every no_of_replicates class per DOSE(1-6). The (dose, replicate class) cells are independent, so they
+    are fanned out over a pool of n_jobs processes (see run_null_cell), each cell with its own deterministic
+    seed. Every dose is rank-standardized once, in the current process, and copied to shared memory, which
+    the workers read as a zero-copy view for all the cells of the dose. Every cell is saved as its own
+    checkpoint shard in shard_dir, and cells with a shard of the same data already on disk are skipped
+    (doses without any cell left to compute are not ranked), so an interrupted run resumes where it
+    stopped. Without a shard directory, the cells are only kept in memory.
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns, or a Level4FeatureStore, whose
+            dose features are memory-mapped views instead of copies of the dataframe.
+            cpd_replicate_class_dict: dictionary with no_of_replicate classes as the keys and the replicate
+            ids of the compounds of each class per dose (1-6) as the values, lists with one of these
+            replicates and two replicates of the same compound are never drawn for their class.
+            dose_list: list of doses (1-6).
+            cpd_replicate_dict: dictionary with compounds as the keys and the replicate ids of each
+            compound per dose (1-6) as the values.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns in df.
+            shard_dir: Directory where the checkpoint shards are saved, None to not checkpoint the cells.
+            rand_num: number of random replicate lists per replicate class and dose.
+            seed: random seed.
+            n_jobs: number of worker processes, defaults to the number of CPUs (at most one per cell left
+            to compute); 1 runs in the current process.
+
+    Returns:
+            null_distribution_reps: dictionary with no_of_replicate classes as the keys and the rand_num lists
+            of random replicate ids per dose as the values.
+            null_distribution_medians: dictionary with no_of_replicate classes as the keys and the rand_num
+            median scores per dose as the values.
+    """
+    if (shard_dir is not None) and (not os.path.exists(shard_dir)):
+        os.makedirs(shard_dir)
+    replicate_classes = list(cpd_replicate_class_dict)
+    cell_shards = {}
+    dose_data = {}
+    tasks = []
+    for dose in dose_list:
+        dose_features, rep_index, rep_layout = get_dose_data(df, dose, cpd_replicate_dict, dose_col, replicate_col,
+                                                             metadata_cols)
+        ##the features of the dose are hashed once, each cell only adds the replicates of its class
+        dose_checksum = get_dose_checksum(dose_features, rep_index, rep_layout)
+        dose_tasks = []
+        for replicate_class in replicate_classes:
+            checksum = get_data_checksum(dose_checksum, cpd_replicate_class_dict[replicate_class][dose-1])
+            shard = None
+            if shard_dir is not None:
+                shard = load_shard(get_shard_path(shard_dir, dose, replicate_class), rand_num, seed, checksum)
+            if shard is None:
+                dose_tasks.append((dose, replicate_class, checksum))
+            else:
+                cell_shards[(dose, replicate_class)] = shard
+        if dose_tasks:
+            dose_data[dose] = (rank_standardize(dose_features.astype('float64')), rep_index, rep_layout)
+            tasks.extend(dose_tasks)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, max(len(tasks), 1))
+
+    if n_jobs == 1:
+        init_null_worker({dose: (('value', ranked), rep_index, rep_layout)
+                          for dose, (ranked, rep_index, rep_layout) in dose_data.items()},
+                         cpd_replicate_class_dict, rand_num, seed, shard_dir)
+        try:
+            for task in tasks:
+                dose, replicate_class, shard = run_null_cell(task)
+                cell_shards[(dose, replicate_class)] = shard
+        finally:
+            _worker_state.clear()
+    else:
+        shared_blocks = []
+        try:
+            shared_data = {dose: (share_dose_input(ranked, shared_blocks), rep_index, rep_layout)
+                           for dose, (ranked, rep_index, rep_layout) in dose_data.items()}
+            dose_data.clear()
+            init_args = (shared_data, cpd_replicate_class_dict, rand_num, seed, shard_dir)
+            with Pool(processes=n_jobs, initializer=init_null_worker, initargs=init_args) as pool:
+                for dose, replicate_class, shard in pool.imap_unordered(run_null_cell, tasks):
+                    cell_shards[(dose, replicate_class)] = shard
+        finally:
+            for shm in shared_blocks:
+                shm.close()
+                shm.unlink()
+
+    null_distribution_reps = {replicate_class:[] for replicate_class in replicate_classes}
+    null_distribution_medians = {replicate_class:[] for replicate_class in replicate_classes}
+    for dose in dose_list:
+        for replicate_class in replicate_classes:
+            null_distribution_reps[replicate_class].append(cell_shards[(dose, replicate_class)]['replicates'])
+            null_distribution_medians[replicate_class].append(cell_shards[(dose, replicate_class)]['medians'])
+
+    return null_distribution_reps, null_distribution_medians
+
+def get_cpds_replicates(df_cpd_med_scores, df_lvl4, dose_list, dose_col, replicate_col):
+    """
+    This function returns all replicates id/names found in each compound (index of df_cpd_med_scores)
+    and in all doses(1-6)
+    """
+    df_reps = df_lvl4[df_lvl4['pert_iname'].isin(df_cpd_med_scores.index) & df_lvl4[dose_col].isin(dose_list)]
+    cpd_dose_reps = df_reps.groupby(['pert_iname', dose_col])[replicate_col].apply(list).to_dict()
+    cpds_replicates = {cpd:[cpd_dose_reps.get((cpd, dose), []) for dose in dose_list]
+                       for cpd in df_cpd_med_scores.index}
+    return cpds_replicates
+
+def get_replicates_classes_per_dose(df_cpd_med_scores, cpds_replicates, dose_list):
+    """
+    This function returns a dictionary with the no_of_replicate classes of the compounds as the keys, and
+    all the replicate ids of the compounds of each class per dose (1-6) as the values
+    """
+    replicate_class_dict = {}
+    for size, df_size in df_cpd_med_scores.groupby('no_of_replicates', sort=False):
+        replicate_class_dict[size] = [[rep for cpd in df_size.index for rep in cpds_replicates[cpd][idx]]
+                                      for idx in range(len(dose_list))]
+    return replicate_class_dict
+
+def get_null_medians_per_dose(null_distribution_medians, dose_list):
+    """This function returns the null distribution median scores of all replicate classes per dose"""
+    return {dose:[median for key in null_distribution_medians for median in null_distribution_medians[key][dose-1]]
+            for dose in dose_list}
+
+def save_to_pickle(value, path, file_name):
+    """saves a value into a pickle file"""
+
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    with open(os.path.join(path, file_name), 'wb') as handle:
+        pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+def null_distribution_pipeline(assay=None, data_dir=None, level4_file=None, shard_dir=None, rand_num=None,
+                               seed=None, n_jobs=None):
+    """
+    This function generates the null distribution of the Level-4 median scores from the outputs of the
+    median score notebook in data_dir and saves the null distribution replicates and median scores
+    as pickle files in data_dir.
+
+    Args:
+            assay: 'cp' (Cell painting) or 'L1000'.
+            data_dir: Directory with the Level-4 replicates and the compounds median scores csv files.
+            level4_file: Level-4 replicates csv file name.
+            shard_dir: Directory where the checkpoint shards are saved, defaults to null_distribution_shards
+            in data_dir.
+            rand_num: number of random replicate lists per replicate class and dose.
+            seed: random seed.
+            n_jobs: number of worker processes.
+
+    Output:
+            null_distribution.pickle, null_distribution_medians.pickle (per replicate class) and
+            null_dist_medians_per_dose.pickle (per dose, as saved by the null p-values notebook) in data_dir
+    """
+    columns = ASSAY_COLUMNS[assay]
+    if shard_dir is None:
+        shard_dir = os.path.join(data_dir, 'null_distribution_shards')
+    feature_store = open_feature_store(os.path.join(data_dir, level4_file), columns['dose_col'],
+                                       columns['replicate_col'], columns['metadata_cols'], compression='gzip',
+                                       low_memory = False)
+    df_level4 = feature_store.metadata
+    df_cpd_med_scores = pd.read_csv(os.path.join(data_dir, 'cpd_replicate_median_scores.csv'))
+    df_cpd_med_scores = df_cpd_med_scores.set_index('cpd').rename_axis(None, axis=0)
+
+    dose_list = sorted(df_level4[columns['dose_col']].dropna().unique().tolist())[1:7]
+    cpds_replicates = get_cpds_replicates(df_cpd_med_scores, df_level4, dose_list, columns['dose_col'],
+                                          columns['replicate_col'])
+    cpd_replicate_class_dict = get_replicates_classes_per_dose(df_cpd_med_scores, cpds_replicates, dose_list)
+    null_distribution_reps, null_distribution_medians = run_null_pipeline(
+        feature_store, cpd_replicate_class_dict, dose_list, cpds_replicates,
+        columns['dose_col'], columns['replicate_col'], columns['metadata_cols'], shard_dir,
+        rand_num = rand_num, seed = seed, n_jobs = n_jobs)
+
+    save_to_pickle(null_distribution_reps, data_dir, 'null_distribution.pickle')
+    save_to_pickle(null_distribution_medians, data_dir, 'null_distribution_medians.pickle')
+    save_to_pickle(get_null_medians_per_dose(null_distribution_medians, dose_list), data_dir,
+                   'null_dist_medians_per_dose.pickle')
+    print("Done!! generated the null distribution replicates and median scores")
+
+def parse_args():
+    """Arguments to pass to this Script"""
+
+    parser = argparse.ArgumentParser(description="Parse arguments")
+    parser.add_argument('--assay', type=str, default='cp', choices=list(ASSAY_COLUMNS), nargs='?',
+                        help='Assay of the Level-4 profiles: cp (Cell painting) or L1000')
+    parser.add_argument('--data_dir', type=str, default='cellpainting_lvl4_cpd_replicate_datasets', nargs='?',
+                        help='Directory with the Level-4 replicates and the compounds median scores csv files')
+    parser.add_argument('--level4_file', type=str, default='cp_level4_cpd_replicates.csv.gz', nargs='?',
+                        help='Level-4 replicates csv file name')
+    parser.add_argument('--shard_dir', type=str, default=None, nargs='?',
+                        help='Directory where each (dose, replicate class) checkpoint shard is saved, defaults to \
+                        null_distribution_shards in data_dir')
+    parser.add_argument('--rand_num', type=int, default=1000, nargs='?',
+                        help='Number of random replicate lists per replicate class and dose')
+    parser.add_argument('--seed', type=int, default=1903, nargs='?', help='Random seed')
+    parser.add_argument('--n_jobs', type=int, default=None, nargs='?',
+                        help='Number of worker processes, defaults to the number of CPUs')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    null_distribution_pipeline(args.assay, args.data_dir, args.level4_file, args.shard_dir, args.rand_num,
+                               args.seed, args.n_jobs)
@@ -0,0 +1,141 @@
+import numpy as np
+
+def get_dose_replicate_map(cpd_replicate_dict, dose):
+    """
+    This function lays out all replicates of a specific dose contiguously by compound, so that the
+    replicates of the i-th compound are rep_names[rep_starts[i]:rep_starts[i] + rep_counts[i]].
+
+    Args:
+            cpd_replicate_dict: dictionary with compounds as the keys and the replicate ids of each
+            compound per dose (1-6) as the values.
+            dose: dose number.
+
+    Returns:
+            rep_names: numpy array of all replicate ids in the dose.
+            rep_starts: integer numpy array, position of the first replicate of each compound in rep_names.
+            rep_counts: integer numpy array, number of replicates of each compound in the dose.
+    """
+    dose_reps = [cpd_replicate_dict[cpd][dose-1] for cpd in cpd_replicate_dict if cpd_replicate_dict[cpd][dose-1]]
+    rep_names = np.array([rep for reps in dose_reps for rep in reps], dtype=object)
+    rep_counts = np.array([len(reps) for reps in dose_reps], dtype=np.int64)
+    rep_starts = np.concatenate(([0], np.cumsum(rep_counts)[:-1])).astype(np.int64)
+    return rep_names, rep_starts, rep_counts
+
+def draw_random_replicates(rep_names, rep_starts, rep_counts, no_of_replicates, rand_num, rng, class_reps=None,
+                           max_draws=100, max_batch_size=2**22):
+    """
+    This function returns rand_num distinct lists of distinct random replicates, with the same constraint as
+    get_random_replicates of the null p-values notebooks: a list is rejected only if it has a replicate of
+    class_reps (the replicates of the replicate class being scored) AND two of its replicates come from the
+    same compound. As with resampling until a valid list shows up, every valid set of replicates is equally
+    likely: lists of uniformly drawn replicates are drawn for a whole batch at once, and only the valid lists
+    without a repeated replicate are kept. Duplicated lists are dropped by comparing the sorted replicate
+    positions of all lists at once. Lists are drawn in batches of at most max_batch_size replicates, so large
+    null distributions (e.g. 100k lists) use bounded memory.
+
+    Args:
+            rep_names, rep_starts, rep_counts: replicate layout of the dose (output of get_dose_replicate_map).
+            no_of_replicates: number of replicates in each list (the replicate class).
+            rand_num: number of distinct lists to draw.
+            rng: numpy random Generator.
+            class_reps: optional list of the replicate ids of the replicate class.
+            max_draws: maximum number of batches to draw, as a multiple of the number of batches needed
+            without rejections, before giving up on finding rand_num distinct lists.
+            max_batch_size: maximum number of replicates (lists x no_of_replicates) drawn at once.
+
+    Returns:
+            replicate_list: list of rand_num lists of replicate ids.
+    """
+    if no_of_replicates > len(rep_names):
+        raise ValueError(f"Cannot draw {no_of_replicates} replicates from {len(rep_names)} replicates")
+    rep_cpds = np.repeat(np.arange(len(rep_counts)), rep_counts)
+    in_class = np.zeros(len(rep_names), dtype=bool)
+    if class_reps:
+        class_reps = set(class_reps)
+        in_class = np.fromiter((rep in class_reps for rep in rep_names), dtype=bool, count=len(rep_names))
+    batch_size = min(rand_num, max(1, max_batch_size // no_of_replicates))
+    drawn = np.empty((0, no_of_replicates), dtype=np.int64)
+    for _ in range(max_draws * int(np.ceil(rand_num / batch_size))):
+        rand_reps = np.sort(rng.integers(len(rep_names), size=(batch_size, no_of_replicates)), axis = 1)
+        distinct_reps = np.all(np.diff(rand_reps, axis = 1) != 0, axis = 1)
+        ##replicates are laid out by compound, so the compounds of sorted replicates are sorted too
+        similar_reps = np.any(np.diff(rep_cpds[rand_reps], axis = 1) == 0, axis = 1)
+        valid = distinct_reps & ~(in_class[rand_reps].any(axis = 1) & similar_reps)
+        drawn = np.concatenate((drawn, rand_reps[valid]))
+        ##keep the first draw of every distinct list, in the order they were drawn
+        first_idx = np.sort(np.unique(drawn, axis = 0, return_index = True)[1])
+        drawn = drawn[first_idx]
+        if len(drawn) >= rand_num:
+            return rep_names[drawn[:rand_num]].tolist()
+    raise ValueError(f"Could not draw {rand_num} distinct lists of {no_of_replicates} replicates")
+
+def get_null_cell_rng(seed, dose, replicate_class):
+    """
+    This function returns the random generator of a (dose, replicate class) cell of the null distribution,
+    seeded with (seed, dose, replicate class) so that every cell is reproducible on its own.
+    """
+    return np.random.default_rng([seed, int(dose), int(replicate_class)])
+
+def get_null_distribution_replicates(cpd_replicate_class_dict, dose_list, cpd_replicate_dict,
+                                     rand_num = 1000, seed = 1903):
+    """
+    This function returns a null distribution dictionary, with no_of_replicates(replicate class)
+    as the keys and 1000 lists of randomly selected replicate combinations as the values
+    for each no_of_replicates class per DOSE(1-6). A list is never drawn with both a replicate of the
+    no_of_replicates class itself and two replicates of the same compound (see draw_random_replicates).
+
+    Every (dose, replicate class) gets its own random generator (see get_null_cell_rng), so the null
+    distribution is reproducible regardless of the order the classes are processed in.
+
+    Args:
+            cpd_replicate_class_dict: dictionary with no_of_replicate classes as the keys and the replicate
+            ids of the compounds of each class per dose (1-6) as the values.
+            dose_list: list of doses (1-6).
+            cpd_replicate_dict: dictionary with compounds as the keys and the replicate ids of each
+            compound per dose (1-6) as the values.
+            rand_num: number of random replicate lists per replicate class and dose.
+            seed: random seed.
+
+    Returns:
+            null_distribution_reps: dictionary with no_of_replicate classes as the keys and the rand_num lists
+            of random replicate ids per dose as the values.
+    """
+    null_distribution_reps = {replicate_class:[] for replicate_class in cpd_replicate_class_dict}
+    for dose in dose_list:
+        rep_names, rep_starts, rep_counts = get_dose_replicate_map(cpd_replicate_dict, dose)
+        for replicate_class in cpd_replicate_class_dict:
+            rng = get_null_cell_rng(seed, dose, replicate_class)
+            replicate_list = draw_random_replicates(rep_names, rep_starts, rep_counts, int(replicate_class),
+                                                    rand_num, rng, cpd_replicate_class_dict[replicate_class][dose-1])
+            null_distribution_reps[replicate_class].append(replicate_list)
+    return null_distribution_reps
+
+def get_duplicate_lists(null_distribution_reps, dose_list):
+    """
+    This function returns the random replicate lists drawn more than once (in any order) in the null
+    distribution of a no_of_replicate class per dose. Replicate ids are integer-coded and all the lists of
+    a (dose, replicate class) are compared at once, so large null distributions (e.g. 100k lists) are
+    checked in about linear time instead of comparing every list with all the others.
+
+    Args:
+            null_distribution_reps: dictionary with no_of_replicate classes as the keys and the lists of
+            random replicate ids per dose as the values.
+            dose_list: list of doses (1-6).
+
+    Returns:
+            duplicates_reps: dictionary with the no_of_replicate classes with duplicated lists as the keys,
+            and the duplicated lists of each dose with duplicates as the values.
+    """
+    duplicates_reps = {}
+    for dose in dose_list:
+        for key in null_distribution_reps:
+            null_dist = null_distribution_reps[key][dose-1]
+            if len(null_dist) < 2:
+                continue
+            _, rep_codes = np.unique(np.asarray(null_dist).ravel(), return_inverse=True)
+            sorted_codes = np.sort(rep_codes.reshape(len(null_dist), -1), axis = 1)
+            _, list_codes, list_counts = np.unique(sorted_codes, axis = 0, return_inverse=True, return_counts=True)
+            dup_idx = np.flatnonzero(list_counts[list_codes.ravel()] > 1)
+            if len(dup_idx):
+                duplicates_reps.setdefault(key, []).append([null_dist[idx] for idx in dup_idx])
+    return duplicates_reps
@@ -0,0 +1,118 @@
+import pandas as pd
+import numpy as np
+from correlation import spearman_corr
+from dose_executor import run_per_dose
+
+def get_dose_correlation(df, dose_num, dose_col, replicate_col, metadata_cols, dtype='float64'):
+    """
+    This function computes the replicate-by-replicate Spearman correlation matrix of all
+    replicates in a specific dose, the feature matrix of the dose is rank-transformed only once.
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns.
+            dose_num: dose number to compute the correlation matrix for.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns in df.
+            dtype: 'float64' (default) or 'float32', precision of the correlation matrix.
+
+    Returns:
+            dose_corr: 2D numpy array of the Spearman correlation values between replicates in the dose.
+            rep_index: pandas Index that maps replicate ids to the rows/columns of dose_corr.
+    """
+    df_dose = df[df[dose_col] == dose_num]
+    dose_corr = spearman_corr(df_dose.drop(metadata_cols, axis = 1).values.astype('float64'), dtype=dtype)
+    rep_index = pd.Index(df_dose[replicate_col].values)
+    return dose_corr, rep_index
+
+def calc_null_dist_median_scores(dose_corr, rep_index, replicate_lists):
+    """
+    This function calculate the median of the correlation values for each list in the 1000 lists of
+    random replicate combination for a no_of_replicate class per dose, by gathering the upper-triangle
+    entries of every list from the precomputed dose correlation matrix, all lists at once.
+
+    Args:
+            dose_corr: 2D numpy array, replicate-by-replicate correlation matrix of the dose.
+            rep_index: pandas Index that maps replicate ids to the rows/columns of dose_corr.
+            replicate_lists: list of lists of random replicate ids, all lists with the same length.
+
+    Returns:
+            median_corr_list: list of median correlation values, one for each list of replicates.
+    """
+    rep_rows = rep_index.get_indexer(np.asarray(replicate_lists).ravel()).reshape(len(replicate_lists), -1)
+    if (rep_rows < 0).any():
+        raise KeyError("Some replicates in the null distribution are not found in the dose")
+    upper_idx = np.triu_indices(rep_rows.shape[1], k = 1)
+    reps_corr = dose_corr[rep_rows[:, upper_idx[0]], rep_rows[:, upper_idx[1]]]
+    median_corr_list = np.median(reps_corr, axis = 1).tolist()
+    return median_corr_list
+
+def calc_null_dist_median_scores_from_ranked(ranked, rep_index, replicate_lists, max_block_size=2**24):
+    """
+    This function calculate the same median correlation values as calc_null_dist_median_scores, but from
+    the rank-standardized replicates of the dose instead of the full dose correlation matrix: only the
+    replicate pairs found in the lists are correlated, a block of lists at a time, so memory use stays
+    bounded (max_block_size values) when many doses are processed side by side in worker processes.
+
+    Args:
+            ranked: 2D numpy array of the rank-standardized replicates of the dose.
+            rep_index: pandas Index that maps replicate ids to the rows of ranked.
+            replicate_lists: list of lists of random replicate ids, all lists with the same length.
+            max_block_size: maximum number of values to gather from ranked at once.
+
+    Returns:
+            median_corr_list: list of median correlation values, one for each list of replicates.
+    """
+    rep_rows = rep_index.get_indexer(np.asarray(replicate_lists).ravel()).reshape(len(replicate_lists), -1)
+    if (rep_rows < 0).any():
+        raise KeyError("Some replicates in the null distribution are not found in the dose")
+    upper_idx = np.triu_indices(rep_rows.shape[1], k = 1)
+    block_lists = max(1, max_block_size // (len(upper_idx[0]) * ranked.shape[1]))
+    median_corr = np.empty(len(rep_rows))
+    for start in range(0, len(rep_rows), block_lists):
+        block_rows = rep_rows[start:start + block_lists]
+        reps_corr = np.einsum('lpf,lpf->lp', ranked[block_rows[:, upper_idx[0]]], ranked[block_rows[:, upper_idx[1]]])
+        median_corr[start:start + block_lists] = np.median(reps_corr, axis = 1)
+    return median_corr.tolist()
+
+def get_dose_null_medians(dose, features, rep_names, dose_null_lists):
+    """
+    This function calculate the median correlation scores of the random replicate lists of every
+    no_of_replicate class in a dose, from the features of the replicates in the dose.
+    """
+    dose_corr = spearman_corr(features)
+    rep_index = pd.Index(rep_names)
+    return {key:calc_null_dist_median_scores(dose_corr, rep_index, dose_null_lists[key]) for key in dose_null_lists}
+
+def get_null_dist_median_scores(null_distribution_cpds, dose_list, df, dose_col, replicate_col, metadata_cols,
+                                n_jobs=None, verbose=False):
+    """
+    This function calculate the median correlation scores for all 1000 lists of randomly combined
+    replicates for each no_of_replicate class across all doses (1-6). The correlation matrix of
+    each dose is computed once and shared by all no_of_replicate classes, doses are processed in
+    parallel (see run_per_dose).
+
+    Args:
+            null_distribution_cpds: dictionary with no_of_replicate classes as the keys and the 1000 lists of
+            random replicate combinations per dose as the values.
+            dose_list: list of doses (1-6).
+            df: Level-4 pandas dataframe with metadata and feature columns.
+            dose_col: A string that indicates the dose number column.
+            replicate_col: A string that indicates the replicate id/replicate name column.
+            metadata_cols: A list of all non-feature columns in df.
+            n_jobs: number of worker processes, defaults to the number of CPUs; 1 runs in the current process.
+            verbose: If True, prints the run time of each dose.
+
+    Returns:
+            null_distribution_medians: dictionary with no_of_replicate classes as the keys and the 1000 median
+            scores per dose as the values.
+    """
+    dose_inputs = {}
+    for dose in dose_list:
+        df_dose = df[df[dose_col] == dose]
+        dose_null_lists = {key:null_distribution_cpds[key][dose-1] for key in null_distribution_cpds}
+        dose_inputs[dose] = (df_dose.drop(metadata_cols, axis = 1).values.astype('float64'),
+                             df_dose[replicate_col].values, dose_null_lists)
+    dose_medians, _ = run_per_dose(get_dose_null_medians, dose_inputs, (), n_jobs, verbose)
+    null_distribution_medians = {key:[dose_medians[dose][key] for dose in dose_list] for key in null_distribution_cpds}
+    return null_distribution_medians
@@ -0,0 +1,51 @@
+import numpy as np
+
+def calc_p_values(null_median_scores, actual_median_scores, p_correction=True):
+    """
+    This function calculate the empirical p-values of a set of median scores against a null distribution,
+    i.e. the probability of the null median scores being greater than or equal to each median score. The null
+    distribution is sorted once and all p-values are found with a binary search (searchsorted).
+
+    Args:
+            null_median_scores: list or numpy array of null distribution median scores.
+            actual_median_scores: numpy array of median scores to compute the p-values for.
+            p_correction: If True, add one to both the numerator and the denominator, (r + 1) / (n + 1),
+            so that p-values are never exactly zero.
+
+    Returns:
+            p_values: numpy array with the same shape as actual_median_scores.
+    """
+    null_sorted = np.sort(np.asarray(null_median_scores, dtype='float64'))
+    n_null = len(null_sorted)
+    n_greater_equal = n_null - np.searchsorted(null_sorted, np.asarray(actual_median_scores), side='left')
+    p_values = (n_greater_equal + int(p_correction)) / (n_null + int(p_correction))
+    return p_values
+
+def get_null_p_values(null_dist_median, dose_list, df_med_values, size_col, p_correction=True):
+    """
+    This function returns a dict, with compounds (or MOAs) as the keys and their p-values for
+    each dose (1-6) as the values. All compounds of a size class (e.g. no_of_replicates) are tested
+    against the null distribution of their class at once.
+
+    Args:
+            null_dist_median: dictionary with size classes as the keys and the null distribution
+            median scores per dose as the values.
+            dose_list: list of doses (1-6).
+            df_med_values: pandas dataframe with compounds (or MOAs) as the index, their size class and
+            their median scores for each dose (dose_1 - dose_6) as the columns.
+            size_col: A string that indicates the size class column e.g. no_of_replicates, moa_size.
+            p_correction: If True, p-values are computed as (r + 1) / (n + 1), see calc_p_values.
+
+    Returns:
+            sorted_null_p_vals: dictionary sorted by compounds (or MOAs) with the p-values per dose as the values.
+    """
+    null_p_vals = {}
+    for key in null_dist_median:
+        df_size = df_med_values[df_med_values[size_col] == key]
+        dose_p_values = np.empty((df_size.shape[0], len(dose_list)))
+        for idx, num in enumerate(dose_list):
+            dose_p_values[:, idx] = calc_p_values(null_dist_median[key][num-1], df_size['dose_' + str(num)].values,
+                                                  p_correction)
+        null_p_vals.update(zip(df_size.index, dose_p_values.tolist()))
+    sorted_null_p_vals = {key:value for key, value in sorted(null_p_vals.items(), key=lambda item: item[0])}
+    return sorted_null_p_vals
@@ -0,0 +1,175 @@
+import io
+import os
+import gzip
+import collections
+import urllib.request
+from contextlib import ExitStack
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+##the 8 distinct dose classes of the Cell painting Level-4 data
+DOSE_CLASSES = np.array([0.04, 0.12, 0.37, 1.11, 3.33, 10.0, 20.0, 25.0])
+
+META_INFO_COLS = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_Plate', 'Metadata_Well',
+                  'Metadata_broad_id', 'Metadata_moa', 'Metadata_dose_recode']
+
+def recode_dose(dose_values, doses=DOSE_CLASSES):
+    """
+    This function recodes the doses in Level-4 data to the 8 distinct dose classes, for all values at once:
+    doses in (0, 0.04] are recoded to 0.04, other doses are binned (np.digitize) on their value rounded
+    to 2 decimals, and doses outside of the classes (e.g. 0 for DMSO, >= 25) are left as they are.
+    Only the distinct doses are rounded, with the same rounding as the builtin round.
+
+    Args:
+            dose_values: dose value, or numpy array / pandas Series of dose values.
+            doses: sorted dose classes, the last one is only the upper bound of the previous class.
+
+    Returns:
+            The recoded doses, as a float, numpy array or pandas Series (with the index of dose_values).
+    """
+    doses = np.asarray(doses, dtype=np.float64)
+    values = np.asarray(dose_values, dtype=np.float64)
+    uniq_values, uniq_idx = np.unique(values.ravel(), return_inverse=True)
+    rounded = np.array([round(value, 2) for value in uniq_values.tolist()], dtype=np.float64)
+    ##class of each distinct dose, -1 below the first class and len(doses) - 1 from the last bound
+    dose_class = np.digitize(rounded, doses) - 1
+    in_class = (dose_class >= 0) & (dose_class < len(doses) - 1)
+    recoded = np.where(in_class, doses[np.clip(dose_class, 0, len(doses) - 1)], uniq_values)
+    recoded = np.where((uniq_values > 0.0) & (uniq_values <= doses[0]), doses[0], recoded)
+    recoded = recoded[uniq_idx].reshape(values.shape)
+    if isinstance(dose_values, pd.Series):
+        return pd.Series(recoded, index=dose_values.index, name=dose_values.name)
+    if recoded.ndim == 0:
+        return float(recoded)
+    return recoded
+
+def add_dose_recode(df_lvl4, dose_col='Metadata_mmoles_per_liter', recode_col='Metadata_dose_recode'):
+    """This function adds the recoded doses (see recode_dose) of a Level-4 dataframe as a new column"""
+    df_lvl4[recode_col] = recode_dose(df_lvl4[dose_col])
+    return df_lvl4
+
+def feature_selection(df_lvl4, max_nulls=384, feature_select_ops=None, meta_info_cols=META_INFO_COLS):
+    """
+    This function performs feature selection by dropping the feature columns with more than max_nulls
+    null values (384 i.e. equivalent to one plate worth of cell profiles), then fills the remaining null
+    values with the mean of their column. Null values are counted and filled on the whole feature
+    matrix at once, instead of one column at a time.
+
+    Args:
+            df_lvl4: Level-4 dataframe, metadata columns start with "Metadata_" and all other
+            columns are numeric features.
+            max_nulls: maximum number of null values in a feature column.
+            feature_select_ops: list of pycytominer feature_select operations applied after the null
+            columns are dropped (e.g. ["correlation_threshold", "variance_threshold"]), default (None)
+            skips pycytominer feature selection.
+            meta_info_cols: metadata columns kept in the output.
+
+    Returns:
+            df_lvl4_new: dataframe of the meta_info_cols and the selected features.
+    """
+    feature_cols = pd.Index([col for col in df_lvl4.columns if not col.startswith("Metadata_")])
+    features = df_lvl4[feature_cols].to_numpy(dtype=np.float64)
+    nulls = np.isnan(features)
+    keep_idx = np.flatnonzero(nulls.sum(axis=0) <= max_nulls)
+    if feature_select_ops:
+        from pycytominer import feature_select
+        df_lvl4_features = pd.DataFrame(features[:, keep_idx], index=df_lvl4.index, columns=feature_cols[keep_idx])
+        df_lvl4_features = feature_select(df_lvl4_features, operation=feature_select_ops)
+        keep_idx = feature_cols.get_indexer(df_lvl4_features.columns)
+    features = features[:, keep_idx]
+    nulls = nulls[:, keep_idx]
+    if nulls.any():
+        null_rows, null_cols = np.nonzero(nulls)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            col_means = np.where(nulls, 0.0, features).sum(axis=0) / (~nulls).sum(axis=0)
+        features[null_rows, null_cols] = col_means[null_cols]
+    df_lvl4_features = pd.DataFrame(features, index=df_lvl4.index, columns=feature_cols[keep_idx])
+    df_lvl4_new = pd.concat([df_lvl4[meta_info_cols].copy(), df_lvl4_features], axis=1)
+    return df_lvl4_new
+
+def iter_csv_blocks(file_path, chunk_size=2**26, compression='infer'):
+    """
+    This function reads a (gzip) csv file, local or from a url, and yields blocks of about chunk_size
+    bytes of complete rows, each block starts with the header row so that it can be parsed on its own.
+    Rows are split on newlines, i.e. quoted values must not contain newlines.
+
+    Args:
+            file_path: path or url of the csv file.
+            chunk_size: number of (decompressed) bytes read at once.
+            compression: 'gzip', None or 'infer' (gzip if the file name ends with .gz).
+
+    Returns:
+            Generator of bytes blocks.
+    """
+    file_path = str(file_path)
+    if compression == 'infer':
+        compression = 'gzip' if file_path.split('?')[0].endswith('.gz') else None
+    with ExitStack() as stack:
+        if file_path.startswith(('http://', 'https://')):
+            handle = stack.enter_context(urllib.request.urlopen(file_path))
+        else:
+            handle = stack.enter_context(open(file_path, 'rb'))
+        if compression == 'gzip':
+            handle = stack.enter_context(gzip.GzipFile(fileobj=handle))
+        header = handle.readline()
+        remainder = b''
+        while True:
+            data = handle.read(chunk_size)
+            if not data:
+                break
+            block = remainder + data
+            end = block.rfind(b'\n') + 1
+            if end:
+                yield header + block[:end]
+            remainder = block[end:]
+        if remainder.strip():
+            yield header + remainder
+
+def read_csv_block(task):
+    """This function parses a block of csv rows, then applies chunk_func (if any) to the dataframe"""
+    block, chunk_func, read_csv_kwargs = task
+    df_chunk = pd.read_csv(io.BytesIO(block), **read_csv_kwargs)
+    if chunk_func is not None:
+        df_chunk = chunk_func(df_chunk)
+    return df_chunk
+
+def read_profiles(file_paths, n_jobs=None, chunk_size=2**26, chunk_func=None, compression='infer', **read_csv_kwargs):
+    """
+    This function reads one or more large profile csv files (e.g. the Level-4 profiles of a Cell painting
+    batch, or its per plate files) into a single dataframe. Files are decompressed in the current process
+    and split in blocks of rows, which are parsed in a pool of worker processes (at most 2 blocks per
+    worker are pending at once).
+
+    Args:
+            file_paths: path or url of a csv file, or list of paths.
+            n_jobs: number of worker processes, defaults to the number of CPUs; 1 parses all blocks in
+            the current process.
+            chunk_size: number of (decompressed) bytes of each block of rows.
+            chunk_func: function applied by the workers to the dataframe of every block (e.g.
+            add_dose_recode), it must be defined at module level.
+            compression: 'gzip', None or 'infer' (gzip if the file name ends with .gz).
+            read_csv_kwargs: arguments passed to pd.read_csv for every block.
+
+    Returns:
+            df_profiles: dataframe of the rows of all files, in file order.
+    """
+    if isinstance(file_paths, (str, os.PathLike)):
+        file_paths = [file_paths]
+    tasks = ((block, chunk_func, read_csv_kwargs) for file_path in file_paths
+             for block in iter_csv_blocks(file_path, chunk_size, compression))
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs == 1:
+        df_chunks = [read_csv_block(task) for task in tasks]
+    else:
+        df_chunks = []
+        with Pool(n_jobs) as pool:
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.apply_async(read_csv_block, (task,)))
+                if len(pending) >= 2 * n_jobs:
+                    df_chunks.append(pending.popleft().get())
+            while pending:
+                df_chunks.append(pending.popleft().get())
+    df_profiles = pd.concat(df_chunks, ignore_index=True)
+    return df_profiles
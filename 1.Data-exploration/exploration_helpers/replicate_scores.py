@@ -0,0 +1,85 @@
+import pandas as pd
+import numpy as np
+from correlation import rank_standardize
+from dose_executor import run_per_dose
+from feature_store import Level4FeatureStore, get_dose_replicates
+
+def group_median_scores(ranked, group_codes, n_groups):
+    """
+    This function calculates the median of the pairwise Spearman correlation values between the
+    replicates of every group (e.g. a compound at a specific dose). Groups with the same number of
+    replicates are stacked and their correlation matrices computed in a single batched matmul.
+
+    Args:
+            ranked: 2D numpy array of rank-standardized replicates (output of rank_standardize).
+            group_codes: 1D integer numpy array, the group (0 to n_groups-1) of each row in ranked.
+            n_groups: Total number of groups.
+
+    Returns:
+            medians: 1D numpy array of length n_groups, median score of each group: 1 for groups with a
+            single replicate and NaN for groups without replicates.
+    """
+    order = np.argsort(group_codes, kind='stable')
+    sizes = np.bincount(group_codes, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    medians = np.full(n_groups, np.nan)
+    medians[sizes == 1] = 1
+    for size in np.unique(sizes[sizes > 1]):
+        grp_idx = np.flatnonzero(sizes == size)
+        rows = order[starts[grp_idx][:, None] + np.arange(size)]
+        block = ranked[rows]
+        corr = np.matmul(block, block.transpose(0, 2, 1))
+        upper_idx = np.triu_indices(size, k = 1)
+        medians[grp_idx] = np.median(corr[:, upper_idx[0], upper_idx[1]], axis = 1)
+    return medians
+
+def get_dose_median_scores(dose, features, cpd_codes, n_cpds):
+    """This function computes the median score of every compound (cpd_codes) in the features of a dose"""
+    return group_median_scores(rank_standardize(features), cpd_codes, n_cpds)
+
+def get_dose_cpd_replicates(df, dose, dose_col, metadata_cols, cpd_col, all_cpds):
+    """
+    This function returns the features of the replicates of the compounds all_cpds in a dose and their
+    compound codes (positions in all_cpds), the features are a view of a feature store if no row is dropped
+    """
+    df_dose, features = get_dose_replicates(df, dose, dose_col, metadata_cols)
+    cpd_codes = pd.Categorical(df_dose[cpd_col], categories=all_cpds).codes.astype(np.int64)
+    with_cpd = cpd_codes >= 0
+    if not with_cpd.all():
+        features, cpd_codes = features[with_cpd], cpd_codes[with_cpd]
+    return features, cpd_codes
+
+def get_cpd_medianscores(df, dose_col, metadata_cols, cpd_col='pert_iname', n_jobs=None, verbose=False):
+    """
+    This function computes median scores for all compounds found in the Level-4 dataframe PER DOSE (1-6),
+    i.e. the median of the Spearman correlation values between the replicates of each compound per dose.
+
+    Compounds are factorized once, and the doses are processed in parallel (see run_per_dose), each
+    dose rank-transforms its feature matrix only once instead of filtering the dataframe for every compound.
+    With a feature store, the features of each dose are read from the memory-mapped store (see
+    get_dose_replicates) instead of a copy of the whole feature block.
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns, features should have
+            no missing values, or a Level4FeatureStore.
+            dose_col: A string that indicates the dose number column.
+            metadata_cols: A list of all non-feature columns in df.
+            cpd_col: A string that indicates the compound name column.
+            n_jobs: number of worker processes, defaults to the number of CPUs; 1 runs in the current process.
+            verbose: If True, prints the run time of each dose.
+
+    Returns:
+            df_cpd_med_score: pandas dataframe with compounds (sorted) as the index and the median scores
+            for each dose (dose_1 - dose_6) as the columns, compounds without replicates in a dose are
+            given a null value.
+    """
+    df_meta = df.metadata if isinstance(df, Level4FeatureStore) else df
+    dose_list = sorted(df_meta[dose_col].dropna().unique().tolist())[1:7]
+    all_cpds = sorted(df_meta[cpd_col].dropna().unique().tolist())
+
+    dose_inputs = {dose:get_dose_cpd_replicates(df, dose, dose_col, metadata_cols, cpd_col, all_cpds)
+                   for dose in dose_list}
+    dose_medians, _ = run_per_dose(get_dose_median_scores, dose_inputs, (len(all_cpds),), n_jobs, verbose)
+
+    df_cpd_med_score = pd.DataFrame({'dose_' + str(dose):dose_medians[dose] for dose in dose_list}, index = all_cpds)
+    return df_cpd_med_score
@@ -0,0 +1,182 @@
+import os
+import sys
+import glob
+import pickle
+import hashlib
+import inspect
+import functools
+import importlib
+import numpy as np
+import pandas as pd
+
+def is_feature_store(value):
+    """
+    True if value is a Level4FeatureStore. feature_store (and pyarrow) is not imported here: a store can only
+    be passed by a caller that already imported the module, so callers that cache plain functions do not
+    need the feature store dependencies.
+    """
+    feature_store = sys.modules.get('feature_store')
+    return (feature_store is not None) and isinstance(value, feature_store.Level4FeatureStore)
+
+def update_hash(digest, value):
+    """
+    This function adds a value (input data or argument) to a blake2b digest: numpy arrays and pandas objects
+    are hashed from their raw data, containers are hashed item by item and other values are pickled.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(type(value).__name__.encode())
+        digest.update(repr(value.dtypes.tolist() if isinstance(value, pd.DataFrame) else value.dtype).encode())
+        digest.update(pickle.dumps(list(value.columns) if isinstance(value, pd.DataFrame) else value.name))
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray) and not value.dtype.hasobject:
+        digest.update(f'ndarray{value.dtype.str}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif is_feature_store(value):
+        ##a store is identified by the checksum of the csv file it was built from
+        digest.update(pickle.dumps((value.store_dir, value.index['source_checksum'], value.index['dtype'])))
+    elif isinstance(value, dict):
+        digest.update(f'dict{len(value)}'.encode())
+        for key, item in value.items():
+            update_hash(digest, key)
+            update_hash(digest, item)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            update_hash(digest, item)
+    else:
+        try:
+            digest.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            digest.update(repr(value).encode())
+
+def get_func_source(func):
+    """Source code of a function, or its bytecode and constants if the source is not available"""
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return repr((func.__code__.co_code, func.__code__.co_consts))
+
+def get_module_source(module_name):
+    """
+    Source code of an imported (or importable) module, or an empty string for the __main__ module of a
+    notebook or script, whose functions are only keyed by their own source
+    """
+    if module_name == '__main__':
+        return ''
+    try:
+        return inspect.getsource(sys.modules.get(module_name) or importlib.import_module(module_name))
+    except (OSError, TypeError, ImportError):
+        return ''
+
+class ResultCache:
+    """
+    Disk cache of the results of expensive analysis functions (e.g. null distributions, PCA and clustering
+    sweeps). Results are keyed by a hash of the function source, the source of its module (which covers the
+    helpers it calls from the same module) and of helper_modules, the version string, its arguments (with
+    the defaults applied) and the data of its inputs, so a result is reused only if none of them changed.
+    Changes anywhere else, e.g. in a module that is not listed or in an upgraded library, are not seen by
+    the keys: list the modules the function calls into, and bump version when such a change alters the
+    results. Every result is saved as its own pickle file, and the least recently used files are removed
+    once the cache is larger than max_bytes. Use an instance as a decorator, or to wrap an imported function:
+
+        result_cache = ResultCache('result_cache')
+        get_null_dist_median_scores = result_cache(get_null_dist_median_scores)
+
+    Args:
+            cache_dir: Directory where the results are saved.
+            max_bytes: maximum size of the cache directory in bytes, defaults to 5 GB.
+            ignore_args: names of the arguments that do not change the result (e.g. n_jobs, verbose),
+            left out of the keys.
+            helper_modules: names of the other modules the cached functions call into, whose source is
+            part of the keys.
+            version: salt of the keys, bump it to invalidate all the results computed so far.
+    """
+    def __init__(self, cache_dir, max_bytes=5 * 1024 ** 3, ignore_args=('n_jobs', 'verbose'), helper_modules=(),
+                 version='1'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ignore_args = set(ignore_args)
+        self.helper_modules = list(helper_modules)
+        self.version = str(version)
+
+    def get_key(self, func, args, kwargs):
+        """Hash of the version, the function and module sources, its arguments and their data"""
+        bound_args = inspect.signature(func).bind(*args, **kwargs)
+        bound_args.apply_defaults()
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f'{self.version}:{func.__module__}.{func.__qualname__}'.encode())
+        digest.update(get_func_source(func).encode())
+        for module_name in [func.__module__] + self.helper_modules:
+            digest.update(module_name.encode())
+            digest.update(get_module_source(module_name).encode())
+        for name, value in bound_args.arguments.items():
+            if name not in self.ignore_args:
+                digest.update(name.encode())
+                update_hash(digest, value)
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        """Path of the pickle file of a key"""
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def load(self, key):
+        """
+        This function returns (True, result) if the result of key is cached, else (False, None). The
+        modification time of a loaded file is updated, so that it is the last to be evicted.
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as handle:
+                result = pickle.load(handle)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(path)
+        return True, result
+
+    def save(self, key, result):
+        """This function saves a result through a temporary file, then evicts the least recently used results"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as handle:
+            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """This function removes the least recently used results until the cache fits in max_bytes"""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pickle')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        """This function removes all cached results"""
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pickle')):
+            os.remove(path)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def cached_func(*args, **kwargs):
+            key = self.get_key(func, args, kwargs)
+            found, result = self.load(key)
+            if not found:
+                result = func(*args, **kwargs)
+                self.save(key, result)
+            return result
+        cached_func.result_cache = self
+        return cached_func
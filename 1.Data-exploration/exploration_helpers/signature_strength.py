@@ -0,0 +1,135 @@
+import pandas as pd
+import numpy as np
+from correlation import rank_standardize
+from replicate_scores import group_median_scores, get_dose_cpd_replicates
+from feature_store import Level4FeatureStore
+
+def group_signature_strength(features, group_codes, n_groups):
+    """
+    This function computes the signature strength of every group (e.g. a compound at a specific dose) of
+    replicates: features are scaled by the square root of the number of replicates of their group, the
+    replicates are sorted by group code, the features above the threshold are counted per replicate and summed
+    per group with np.add.reduceat.
+
+    Args:
+            features: 2D numpy array - replicates as rows and features as columns.
+            group_codes: 1D integer numpy array, the group (0 to n_groups-1) of each row in features.
+            n_groups: Total number of groups.
+
+    Returns:
+            group_ss: 1D numpy array of length n_groups, signature strength of each group, NaN for groups
+            without replicates.
+    """
+    order = np.argsort(group_codes, kind='stable')
+    group_codes = group_codes[order]
+    sizes = np.bincount(group_codes, minlength=n_groups)
+    features = features[order]
+    features_gtr_2 = (np.abs(features * np.sqrt(sizes[group_codes])[:, None]) >= 2.0).sum(axis = 1)
+
+    non_empty = np.flatnonzero(sizes)
+    starts = np.concatenate(([0], np.cumsum(sizes[non_empty])[:-1]))
+    group_ss = np.full(n_groups, np.nan)
+    if len(non_empty):
+        group_ss[non_empty] = np.add.reduceat(features_gtr_2, starts) / sizes[non_empty]
+    return group_ss
+
+def compute_signature_strength(df, cpds_list, dose_list, dose_col, metadata_cols, cpd_col='pert_iname'):
+    """
+    This function computes the signature strength (SS) of each compound per dose based on its replicates,
+    i.e. the number of features with an absolute z-score (scaled by the square root of the number of
+    replicates) greater than or equal to 2, divided by the number of replicates.
+
+    The compounds of a dose are counted in one pass (see group_signature_strength), a dose at a time, so
+    that only the features of one dose are copied, the features of a feature store are read from the
+    memory-mapped store (see get_dose_replicates).
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns, or a Level4FeatureStore.
+            cpds_list: A list of compounds to compute the signature strength for.
+            dose_list: list of doses (1-6).
+            dose_col: A string that indicates the dose number column.
+            metadata_cols: A list of all non-feature columns in df.
+            cpd_col: A string that indicates the compound name column.
+
+    Returns:
+            df_cpd_ss: pandas dataframe with compounds (sorted) as the index and the signature strength for
+            each dose (dose_1 - dose_6) as the columns, compounds without replicates in a dose are
+            given a null value.
+    """
+    all_cpds = sorted(cpds_list)
+    cpd_ss = np.full((len(dose_list), len(all_cpds)), np.nan)
+    for idx, dose in enumerate(dose_list):
+        features, cpd_codes = get_dose_cpd_replicates(df, dose, dose_col, metadata_cols, cpd_col, all_cpds)
+        cpd_ss[idx] = group_signature_strength(features, cpd_codes, len(all_cpds))
+
+    df_cpd_ss = pd.DataFrame(cpd_ss.T, index = all_cpds,
+                             columns = ['dose_' + str(dose) for dose in dose_list])
+    return df_cpd_ss
+
+def compute_activity_score(df_cpd_ss, df_med_scores, num_feats):
+    """
+    This function computes the activity score of each compound per dose, i.e. the Morphological
+    Activity Score (MAS) for Cell painting or the Transcriptional Activity Score (TAS) for L1000:
+    sqrt(max(median replicate score, 0) * signature strength / number of features)
+
+    Args:
+            df_cpd_ss: pandas dataframe of signature strength (output of compute_signature_strength).
+            df_med_scores: pandas dataframe with compounds as the index and median scores per dose as the columns.
+            num_feats: Number of features (morphological features or landmark genes).
+
+    Returns:
+            df_cpd_activity: pandas dataframe with the same index and columns as df_cpd_ss.
+    """
+    med_scores = df_med_scores.loc[df_cpd_ss.index, df_cpd_ss.columns].values.astype('float64')
+    cpd_activity = np.sqrt(np.maximum(med_scores, 0) * df_cpd_ss.values / num_feats)
+    df_cpd_activity = pd.DataFrame(cpd_activity, index = df_cpd_ss.index, columns = df_cpd_ss.columns)
+    return df_cpd_activity
+
+def compute_SS_activity_score(df, df_med_scores, dose_col, metadata_cols, num_feats):
+    """
+    This function computes both the signature strength and the activity score (MAS/TAS) for each
+    compound in df_med_scores based on its replicates across all doses (1-6)
+
+    Args:
+            df: Level-4 pandas dataframe with metadata and feature columns, or a Level4FeatureStore.
+            df_med_scores: pandas dataframe with compounds as the index and median scores per dose as the columns.
+            dose_col: A string that indicates the dose number column.
+            metadata_cols: A list of all non-feature columns in df.
+            num_feats: Number of features (morphological features or landmark genes).
+
+    Returns:
+            df_cpd_ss: pandas dataframe of signature strength per compound (index) and dose (columns).
+            df_cpd_activity: pandas dataframe of activity score (MAS/TAS) per compound (index) and dose (columns).
+    """
+    df_meta = df.metadata if isinstance(df, Level4FeatureStore) else df
+    dose_list = sorted(df_meta[dose_col].dropna().unique().tolist())[1:7]
+    df_cpd_ss = compute_signature_strength(df, df_med_scores.index.tolist(), dose_list, dose_col, metadata_cols)
+    df_cpd_activity = compute_activity_score(df_cpd_ss, df_med_scores, num_feats)
+    return df_cpd_ss, df_cpd_activity
+
+def get_dmso_activity_percentile(df_dmso, plate_col, metadata_cols, num_feats, percentile=95):
+    """
+    This function computes the activity score (MAS/TAS) of the DMSO replicates of every plate, from the
+    median correlation score and the signature strength of the DMSO replicates of the plate:
+    sqrt(abs(median replicate score) * signature strength / number of features), and returns the given
+    percentile of these scores. Plates with a single DMSO replicate have no replicate correlation and are
+    left out. All plates are scored at once (see group_median_scores and group_signature_strength).
+
+    Args:
+            df_dmso: Level-4 pandas dataframe of the DMSO replicates, with metadata and feature columns.
+            plate_col: A string that indicates the plate column.
+            metadata_cols: A list of all non-feature columns in df_dmso.
+            num_feats: Number of features (morphological features or landmark genes).
+            percentile: percentile of the DMSO activity scores to return.
+
+    Returns:
+            dmso_percentile: the percentile of the activity scores of the DMSO plates.
+    """
+    plate_codes, plates = pd.factorize(df_dmso[plate_col])
+    plate_codes = plate_codes.astype(np.int64)
+    features = df_dmso.drop(metadata_cols, axis = 1).values.astype('float64')
+    plate_medians = group_median_scores(rank_standardize(features), plate_codes, len(plates))
+    plate_ss = group_signature_strength(features, plate_codes, len(plates))
+    with_replicates = np.bincount(plate_codes, minlength=len(plates)) > 1
+    dmso_scores = np.sqrt((np.abs(plate_medians) * plate_ss)[with_replicates] / num_feats)
+    return np.percentile(dmso_scores, percentile)
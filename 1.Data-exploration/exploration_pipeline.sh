@@ -13,6 +13,14 @@ jupyter nbconvert --to=html \
 jupyter nbconvert --to=script --FilesWriter.build_directory=scripts/nbconverted *.ipynb
 
 # Step 2 - Analyzing level 4 profiles
+#
+# Without the notebook reports, the data stages of notebooks 2 and 3 (and the median scores of notebook 1)
+# can be rerun in a single process from the Level-4 replicates saved by notebook 1, e.g. in cell_painting:
+#   python ../../exploration_helpers/level4_pipeline.py --assay cp \
+#       --data_dir cellpainting_lvl4_cpd_replicate_datasets --level4_file cp_level4_cpd_replicates.csv.gz
+# and in L1000:
+#   python ../../exploration_helpers/level4_pipeline.py --assay L1000 \
+#       --data_dir L1000_lvl4_cpd_replicate_datasets --level4_file L1000_level4_cpd_replicates.csv.gz
 
 # Cell Painting
 cd cell_painting
@@ -1,4 +1,5 @@
 import os
+import sys
 import requests
 import pickle
 import argparse
@@ -8,29 +9,39 @@ import re
 from os import walk
 from collections import Counter
 import cmapPy.pandasGEXpress.parse_gct as pg
-from cmapPy.pandasGEXpress.parse import parse
 from io import BytesIO
 from urllib.request import urlopen
 from zipfile import ZipFile
 
-def construct_lvl4_data(data_dir, level4_dir, pertinfo_file):
+##custom modules required
+sys.path.append('../../1.Data-exploration/exploration_helpers')
+from gctx_reader import read_gctx_ids, read_gctx_columns, get_sig_id
+from correlation import spearman_corr
+
+def construct_lvl4_data(data_dir, level4_dir, pertinfo_file, chunk_size = 1000):
     """
     This function returns L1000 Level-4 Data that is aligned with 
-    the important metadata information to compute compound's median scores
+    the important metadata information to compute compound's median scores.
+    The metadata is read first, then only the replicates found in it are read 
+    from the GCTX file, chunk_size replicates (signatures) at a time
     """
     
-    lvl4_data = parse(os.path.join(data_dir, level4_dir))
-    lvl4_data = lvl4_data.data_df.rename_axis(None).T
-    lvl4_data = lvl4_data.rename_axis(None).reset_index()
-    lvl4_data.rename(columns={"index": "replicate_id"}, inplace = True)
     df_metalvl_5 = pd.read_csv(os.path.join(data_dir, 'col_meta_level_5_REP.A_A549_only_n9482.txt'), delimiter = "\t")
-    lvl4_data['sig_id'] = lvl4_data['replicate_id'].apply(lambda x: ''.join(re.sub('(24H.+(\_|\.)[A-Z0-9]+.)\:', '24H:', x)))
     df_meta_features = df_metalvl_5[['sig_id', 'pert_id', 'pert_idose', 'det_plate', 'det_well']].copy()
     df_meta_features['dose'] = df_meta_features['pert_idose'].map({'-666' : 0, '0.04 uM' : 1, '0.12 uM' : 2, '0.37 uM' : 3,
                                                                    '1.11 uM' : 4, '3.33 uM' : 5, '10 uM' : 6, '20 uM' : 7})
     df_pertinfo = pd.read_csv(pertinfo_file)
     df_pertinfo.rename(columns={"broad_id": "pert_id"}, inplace = True)
     df_meta_features = pd.merge(df_meta_features, df_pertinfo, on=['pert_id'], how = 'left')
+    
+    ##only the replicates with a signature in the metadata are read from the GCTX file
+    gctx_path = os.path.join(data_dir, level4_dir)
+    replicate_ids = read_gctx_ids(gctx_path)
+    replicate_ids = replicate_ids[get_sig_id(replicate_ids).isin(df_meta_features['sig_id']).values]
+    lvl4_data = pd.concat(read_gctx_columns(gctx_path, replicate_ids, chunk_size))
+    lvl4_data = lvl4_data.rename_axis(None).reset_index()
+    lvl4_data.rename(columns={"index": "replicate_id"}, inplace = True)
+    lvl4_data['sig_id'] = get_sig_id(lvl4_data['replicate_id']).values
     lvl4_data = pd.merge(lvl4_data, df_meta_features, on='sig_id')
     
     return lvl4_data
@@ -44,7 +55,9 @@ def feature_selection(df_data):
     
     df_data_genes = df_data.drop(['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose', 
                                   'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well'], axis = 1).copy()
-    df_data_corr = df_data_genes.corr(method = 'spearman')
+    ##rank-based Spearman kernel, in float64 so that the 0.9 threshold keeps the same genes
+    df_data_corr = pd.DataFrame(spearman_corr(df_data_genes.values.T, dtype='float64'), 
+                                index = df_data_genes.columns, columns = df_data_genes.columns)
     drop_cols = []
     n_cols = len(df_data_corr.columns)
     for i in range(n_cols):
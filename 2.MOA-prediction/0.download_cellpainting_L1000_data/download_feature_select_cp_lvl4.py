@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 import pathlib
 import pandas as pd
@@ -6,42 +7,11 @@ import numpy as np
 from collections import defaultdict
 from pycytominer import feature_select
 
+##custom modules required
+sys.path.append('../../1.Data-exploration/exploration_helpers')
+from profile_ingestion import read_profiles, add_dose_recode, feature_selection
+
 
-def recode_dose(dose_value):
-    """This function recode the doses in Level-4 data to 8 distinct dose classes"""
-    
-    doses = [0.04,0.12,0.37,1.11,3.33,10.0,20.0,25.0]
-    for x in range(len(doses)-1):
-        if (dose_value > 0.0) & (dose_value <= 0.04):
-            dose_value = 0.04
-        elif doses[x] <= round(dose_value,2) < doses[x+1]:
-            dose_value = doses[x]
-    return dose_value
-    
-def feature_selection(df_lvl4): 
-    """
-    Perform feature selection by dropping columns with null values 
-    (greater than 384 i.e. equivalent to one plate worth of cell profiles) 
-    and highly correlated values from the data.
-    """
-    metadata_columns = [x for x in df_lvl4.columns if (x.startswith("Metadata_"))]
-    df_lvl4_metadata = df_lvl4[metadata_columns].copy()
-    df_lvl4_features = df_lvl4.drop(metadata_columns, axis = 1)
-    null_cols = [col for col in df_lvl4_features.columns if df_lvl4_features[col].isnull().sum() > 384]
-    df_lvl4_features.drop(null_cols, axis = 1, inplace=True)
-    ##feature selection was done already..prior to getting the spherized data!!
-    ###df_lvl4_features = feature_select(df_lvl4_features, operation=["correlation_threshold", "variance_threshold"])
-    
-    for col in df_lvl4_features.columns:
-        if df_lvl4_features[col].isnull().sum():
-            df_lvl4_features[col].fillna(value=df_lvl4_features[col].mean(), inplace = True)
-            
-    df_meta_info = df_lvl4_metadata[['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_Plate', 'Metadata_Well',
-                                     'Metadata_broad_id', 'Metadata_moa', 'Metadata_dose_recode']].copy()
-    df_lvl4_new = pd.concat([df_meta_info, df_lvl4_features], axis=1)
-    
-    return df_lvl4_new
-    
 def merge_dataframe(df, pertinfo_file):
     """
     This function merge aligned L1000 and Cell painting Metadata information dataframe 
@@ -67,21 +37,22 @@ def save_to_csv(df, path, file_name, compress=None):
     
     df.to_csv(os.path.join(path, file_name), index=False, compression=compress)
     
-def download_cp_lvl4_align_moa(profile_link=None, pertinfo_file=None, data_dir=None):
+def download_cp_lvl4_align_moa(profile_link=None, pertinfo_file=None, data_dir=None, n_jobs=None):
     """
     This function downloads the Cell painting level-4 profiles data from its github repo, 
     perform dose recode, feature selection and align its compounds and MOAs (Mechanism of actions) 
     with the ones found in L1000 profiles and save the resulting dataframe as csv file.
+    The profiles are parsed (and their doses recoded) in blocks of rows by n_jobs worker processes.
     Args:
             profile_link: Github repo link of Cell painting level-4 data.
             pertinfo_file: Aligned metadata perturbation csv file directory for Cell painting & L1000
             data_dir: Directory to save the cell painting level-4 data.
+            n_jobs: number of worker processes, defaults to the number of CPUs.
             
     Output:
             saved csv file: Cell painting level-4 profiles data
     """
-    df_level4 = pd.read_csv(profile_link, compression='gzip',low_memory = False)
-    df_level4['Metadata_dose_recode'] = df_level4['Metadata_mmoles_per_liter'].apply(recode_dose)
+    df_level4 = read_profiles(profile_link, n_jobs=n_jobs, chunk_func=add_dose_recode, compression='gzip', low_memory = False)
     df_level4_new = feature_selection(df_level4)
     df_level4_new, df_level4_no_cpds = merge_dataframe(df_level4_new, pertinfo_file)
     save_to_csv(df_level4_new, data_dir, 'cp_level4_cpd_replicates.csv.gz', compress="gzip")
@@ -97,8 +68,10 @@ def parse_args():
     parser.add_argument('--pertinfo_file', type=str, default = '../aligned_moa_CP_L1000.csv', nargs='?', help='Aligned metadata perturbation.csv file directory for Cell painting & L1000')
     parser.add_argument('--data_dir', type=str, default = "datasets/raw", nargs='?', help='Directory to save the cell painting \
     level-4 data')
+    parser.add_argument('--n_jobs', type=int, default = None, nargs='?', help='Number of worker processes that parse \
+    the profiles, defaults to the number of CPUs')
     return parser.parse_args()
     
 if __name__ == '__main__':
     args = parse_args()
-    download_cp_lvl4_align_moa(args.profile_link, args.pertinfo_file, args.data_dir)
\ No newline at end of file
+    download_cp_lvl4_align_moa(args.profile_link, args.pertinfo_file, args.data_dir, args.n_jobs)
\ No newline at end of file
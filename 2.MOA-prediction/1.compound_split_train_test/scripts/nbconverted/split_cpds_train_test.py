@@ -7,6 +7,7 @@
 
 
 import os
+import sys
 import requests
 import pickle
 import argparse
@@ -19,6 +20,10 @@ import random
 import shutil
 from split_compounds import split_cpds_moas
 
+##custom modules required
+sys.path.append('../../1.Data-exploration/exploration_helpers')
+from level4_cache import read_level4_csv
+
 
 # In[2]:
 
@@ -29,10 +34,10 @@ data_path = '../0.download_cellpainting_L1000_data/data/'
 # In[3]:
 
 
-df_level4_cp = pd.read_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
-df_level4_L1 = pd.read_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+df_level4_cp = read_level4_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                            usecols=['pert_iname', 'moa'], compression='gzip',low_memory = False)
+df_level4_L1 = read_level4_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
+                            usecols=['pert_iname', 'moa'], compression='gzip',low_memory = False)
 
 
 # In[4]:
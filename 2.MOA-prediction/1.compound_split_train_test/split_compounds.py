@@ -7,6 +7,7 @@ from os import walk
 from collections import Counter
 import random
 import shutil
+from scipy import sparse
 
 def sort_moas(cpds_moa):
     """
@@ -32,6 +33,28 @@ def create_cpd_moa_df(cpds_moa):
     df_pert_cpds_moas['marked'] = df_pert_cpds_moas['train'] | df_pert_cpds_moas['test']
     return df_pert_cpds_moas
 
+def get_moa_cpd_matrix(df_pert_cpds_moas, moa_list):
+    """
+    Create the sparse MOA x compound incidence matrix of the compound-MOA pairs, with the MOAs in moa_list order
+    and the compounds in their order of appearance in df_pert_cpds_moas, so that the compounds of each MOA (the
+    column indices of its row) are in the same order as its pairs in df_pert_cpds_moas.
+    
+    Args:
+         df_pert_cpds_moas: pandas dataframe of the compound-MOA pairs (output of create_cpd_moa_df)
+         moa_list: List of all MOAs (output of sort_moas)
+    
+    Returns:
+            moa_cpds: scipy sparse CSR matrix of shape (number of MOAs, number of compounds)
+            cpd_codes: the compound (column) of each pair in df_pert_cpds_moas
+            moa_codes: the MOA (row) of each pair in df_pert_cpds_moas
+    """
+    cpd_codes, cpds = pd.factorize(df_pert_cpds_moas['pert_iname'])
+    moa_codes = pd.Index(moa_list).get_indexer(df_pert_cpds_moas['moa'])
+    moa_cpds = sparse.csr_matrix((np.ones(len(cpd_codes), dtype=np.int64), (moa_codes, cpd_codes)),
+                                 shape=(len(moa_list), len(cpds)))
+    moa_cpds.sort_indices()
+    return moa_cpds, cpd_codes, moa_codes
+
 def split_cpds_moas(cpd_moas_dict, train_ratio=0.8, test_ratio=0.2):
     """
     This function splits compounds into test & train data based on the number of MOAs that are attributed to them,
@@ -42,6 +65,10 @@ def split_cpds_moas(cpd_moas_dict, train_ratio=0.8, test_ratio=0.2):
     - This function was extracted from https://rpubs.com/shantanu/lincs_split_moa
     and then refactored to Python
     
+    The train/test/marked state is kept per compound in numpy arrays, and the compounds of each MOA are read from
+    a sparse MOA x compound incidence matrix, MOAs are processed in ascending order of their number of compounds.
+    The split (and the order of the returned pairs) is the same as splitting the compound-MOA dataframe MOA by MOA.
+    
     Args:
          cpd_moas_dict: Dictionary comprises of compounds as the keys and their respective MOAs (Mechanism of actions)
          as the values
@@ -55,43 +82,47 @@ def split_cpds_moas(cpd_moas_dict, train_ratio=0.8, test_ratio=0.2):
     ##preliminary funcs
     moa_list = sort_moas(cpd_moas_dict)
     df = create_cpd_moa_df(cpd_moas_dict)
+    moa_cpds, cpd_codes, moa_codes = get_moa_cpd_matrix(df, moa_list)
+    
+    n_cpds = moa_cpds.shape[1]
+    cpd_train = np.zeros(n_cpds, dtype=bool)
+    cpd_test = np.zeros(n_cpds, dtype=bool)
+    ##index of the MOA each compound was marked at, len(moa_list) for compounds that are not marked yet
+    cpd_marked_at = np.full(n_cpds, len(moa_list))
     
     random.seed(333)
-    for moa in moa_list:
-        df_moa = df[df['moa'] == moa].reset_index(drop=True)
-        no_cpd = df_moa.shape[0]
+    for moa_idx, moa in enumerate(moa_list):
+        moa_cpd_idx = moa_cpds.indices[moa_cpds.indptr[moa_idx]:moa_cpds.indptr[moa_idx + 1]]
+        no_cpd = len(moa_cpd_idx)
         
         if no_cpd == 1:
             n_trn, n_tst = 1, 0
         else:
             n_trn, n_tst = np.floor(no_cpd*train_ratio), np.ceil(no_cpd*test_ratio),
             
-        n_tst_mk = sum(df_moa.test)
-        n_trn_mk = sum(df_moa.train)
-        moa_mk = df_moa[df_moa['marked']].copy()
-        moa_not_mk = df_moa[~df_moa['marked']].copy()
+        n_tst_mk = cpd_test[moa_cpd_idx].sum()
+        n_trn_mk = cpd_train[moa_cpd_idx].sum()
+        cpds_not_mk = moa_cpd_idx[cpd_marked_at[moa_cpd_idx] == len(moa_list)]
         trn_needed = int(n_trn - n_trn_mk)
         tst_needed = int(n_tst - n_tst_mk)
         n_cpds_needed = trn_needed + tst_needed
-        ##print(moa, df_moa.shape[0], moa_not_mk.shape[0], n_cpds_needed, trn_needed, tst_needed)
     
         trn_needed = max(trn_needed, 0)
         tst_needed = max(tst_needed, 0)
         trn_flg = list(np.concatenate((np.tile(True, trn_needed), np.tile(False, tst_needed))))
         trn_flg = random.sample(trn_flg, n_cpds_needed)
-        tst_flg = [not boolean for boolean in trn_flg]
-        moa_not_mk.train = trn_flg
-        moa_not_mk.test = tst_flg
-        if moa_not_mk.shape[0] > 0:
-            moa_not_mk.marked = True
-        df_moa = pd.concat([moa_not_mk, moa_mk], axis=0, ignore_index=True)
-        df_other_moa = df[df['moa'] != moa].reset_index(drop=True)
-        df_otrs_mk = df_other_moa[df_other_moa['marked']].reset_index(drop=True)
-        df_otrs_not_mk= df_other_moa[~df_other_moa['marked']].reset_index(drop=True)
-        df_otrs_not_mk = df_otrs_not_mk[['pert_iname', 'moa']].merge(moa_not_mk.drop(['moa'], axis=1),
-                                                                     on=['pert_iname'], how='left').fillna(False)
-        
-        df = pd.concat([df_moa, df_otrs_mk, df_otrs_not_mk], axis=0, ignore_index=True)
-        df[['train', 'test']] = df[['train', 'test']].apply(lambda x: x.astype(bool))
+        if len(trn_flg) != len(cpds_not_mk):
+            raise ValueError(f"{moa}: {len(trn_flg)} compounds needed, {len(cpds_not_mk)} compounds not marked")
+        cpd_train[cpds_not_mk] = trn_flg
+        cpd_test[cpds_not_mk] = ~np.array(trn_flg, dtype=bool)
+        cpd_marked_at[cpds_not_mk] = moa_idx
         
-    return df
\ No newline at end of file
+    df['train'] = cpd_train[cpd_codes]
+    df['test'] = cpd_test[cpd_codes]
+    df['marked'] = cpd_marked_at[cpd_codes] < len(moa_list)
+    ##order of the pairs after moving the pairs of every MOA to the top in turn: the MOAs processed last first, the
+    ##pairs marked at their own MOA before the others, which follow the order their compounds were marked in
+    pair_marked_at = cpd_marked_at[cpd_codes]
+    order = np.lexsort((np.arange(len(df)), pair_marked_at, pair_marked_at != moa_codes, -moa_codes))
+    df = df.iloc[order].reset_index(drop=True)
+    return df
@@ -7,6 +7,7 @@
 
 
 import os
+import sys
 import requests
 import pickle
 import argparse
@@ -18,6 +19,10 @@ from collections import Counter
 import random
 import shutil
 
+##custom modules required
+sys.path.append('../../1.Data-exploration/exploration_helpers')
+from level4_cache import read_level4_csv
+
 
 # In[2]:
 
@@ -29,10 +34,10 @@ cpd_split_path = '../1.compound_split_train_test/data'
 # In[3]:
 
 
-df_level4_cp = pd.read_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
-df_level4_L1 = pd.read_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+df_level4_cp = read_level4_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                            compression='gzip',low_memory = False)
+df_level4_L1 = read_level4_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
+                            compression='gzip',low_memory = False)
 
 
 # In[4]:
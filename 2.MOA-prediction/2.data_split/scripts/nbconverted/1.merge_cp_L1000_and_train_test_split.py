@@ -11,6 +11,7 @@
 
 
 import os
+import sys
 import pandas as pd
 import numpy as np
 import re
@@ -18,6 +19,10 @@ from os import walk
 from collections import Counter
 import random
 
+##custom modules required
+sys.path.append('../../1.Data-exploration/exploration_helpers')
+from level4_cache import read_level4_csv
+
 
 # In[2]:
 
@@ -29,10 +34,10 @@ cpd_split_path = '../1.compound_split_train_test/data'
 # In[3]:
 
 
-df_level4_cp = pd.read_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
-df_level4_L1 = pd.read_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
-                        compression='gzip',low_memory = False)
+df_level4_cp = read_level4_csv(os.path.join(data_path, 'cp_level4_cpd_replicates.csv.gz'), 
+                            compression='gzip',low_memory = False)
+df_level4_L1 = read_level4_csv(os.path.join(data_path, 'L1000_level4_cpd_replicates.csv.gz'), 
+                            compression='gzip',low_memory = False)
 
 
 # In[4]:
@@ -112,36 +117,64 @@ df_level4_L1.shape
 # In[15]:
 
 
-def merge_cp_L1000_df(df_cp, df_L1000, all_cpds):
+def get_group_replicates(df, df_groups, sampled_col, rng):
+    
+    """
+    This function selects n_reps replicates of every (compound, dose) group of df: a random
+    sample of the replicates for the groups where sampled_col is True, the replicates in their
+    original order for the others
+    
+    return
+    rows: positions of the selected rows in df, in (group_order, replicate) order
+    """
+    df_reps = df[['pert_iname', 'dose']].merge(df_groups, on=['pert_iname', 'dose'], how='left')
+    in_groups = df_reps['group_order'].notnull().values
+    ##random sort keys for the sampled groups, keys that keep the original order for the others
+    sort_keys = np.where(df_reps[sampled_col].fillna(False).values.astype(bool), 
+                         rng.random(len(df_reps)), np.arange(len(df_reps)) / max(len(df_reps), 1))
+    order = np.lexsort((sort_keys[in_groups], df_reps['group_order'].values[in_groups]))
+    rows = np.flatnonzero(in_groups)[order]
+    rep_num = df_reps.iloc[rows].groupby('group_order').cumcount().values
+    return rows[rep_num < df_reps['n_reps'].values[rows]]
+
+def merge_cp_L1000_df(df_cp, df_L1000, all_cpds, seed = None):
     
     """
-    This function merge Cell painting and L1000 level-4 data to one dataframe based on their compounds
+    This function merge Cell painting and L1000 level-4 data to one dataframe based on their compounds,
+    with the same number of replicates (the smaller of the two assays) for each compound per dose: 
+    replicates of the assay with more replicates are randomly sampled.
+    
+    Both assays are grouped by (compound, dose) once, the replicates are drawn with a groupby-cumcount
+    and the merged dataframe is assembled in one concat.
     
     args
     df_cp: Cell painting Level-4 dataFrame
     df_L1: L1000 Level-4 dataFrame
     all_cpds: Compounds found in both Cell painting and L1000
+    seed: random seed of the replicates sampling
     
     return
     df_lvl4: merged CP & L1000 dataframe
     """
-    df_level4_cp_rand = pd.DataFrame(columns = df_cp.columns)
-    df_level4_L1_rand = pd.DataFrame(columns = df_L1000.columns)
+    rng = np.random.default_rng(seed)
+    ##(compound, dose) groups in all_cpds order, doses in order of appearance in L1000
+    df_L1000 = df_L1000[df_L1000['pert_iname'].isin(all_cpds)]
+    df_groups = df_L1000.groupby(['pert_iname', 'dose'], sort=False).size().rename('L1_size').reset_index()
+    cp_size = df_cp.groupby(['pert_iname', 'dose']).size().rename('cp_size')
+    df_groups = df_groups.join(cp_size, on=['pert_iname', 'dose']).fillna({'cp_size': 0})
+    df_groups['cpd_order'] = pd.Categorical(df_groups['pert_iname'], categories=pd.unique(all_cpds)).codes
+    df_groups = df_groups.sort_values('cpd_order', kind='stable').reset_index(drop=True)
+    df_groups['group_order'] = np.arange(len(df_groups))
+    df_groups['n_reps'] = np.minimum(df_groups['cp_size'], df_groups['L1_size'])
+    df_groups['cp_sampled'] = df_groups['cp_size'] >= df_groups['L1_size']
+    df_groups['L1_sampled'] = ~df_groups['cp_sampled']
+    df_groups = df_groups[['pert_iname', 'dose', 'group_order', 'n_reps', 'cp_sampled', 'L1_sampled']]
+    
+    df_level4_cp_rand = df_cp.iloc[get_group_replicates(df_cp, df_groups, 'cp_sampled', rng)].reset_index(drop=True)
+    df_level4_L1_rand = df_L1000.iloc[get_group_replicates(df_L1000, df_groups, 'L1_sampled', rng)].reset_index(drop=True)
     
-    for idx, cpd in enumerate(all_cpds):
-        df_cpd = df_L1000[df_L1000['pert_iname'] == cpd]
-        for dose in df_cpd['dose'].unique():
-            df_dose = df_cpd[df_cpd['dose'] == dose].copy()
-            df_cpd_cp = df_cp[(df_cp['pert_iname'] == cpd) & (df_cp['dose'] == dose)]
-            if df_cpd_cp.shape[0] >= df_dose.shape[0]:
-                df_level4_cp_rand = pd.concat([df_level4_cp_rand,df_cpd_cp.sample(df_dose.shape[0])], ignore_index = True)
-                df_level4_L1_rand = pd.concat([df_level4_L1_rand,df_dose], ignore_index = True)
-            else:
-                df_level4_cp_rand = pd.concat([df_level4_cp_rand,df_cpd_cp], ignore_index = True)
-                df_level4_L1_rand = pd.concat([df_level4_L1_rand,df_dose.sample(df_cpd_cp.shape[0])], ignore_index = True)
-                
-    df_level4_cp_rand.rename({'broad_id':'pert_id'}, axis = 1, inplace = True)
-    df_level4_cp_rand.drop(['dose', 'pert_iname', 'moa', 'pert_id', 'Metadata_broad_sample'], axis = 1, inplace = True)
+    df_level4_cp_rand = df_level4_cp_rand.rename({'broad_id':'pert_id'}, axis = 1)
+    df_level4_cp_rand = df_level4_cp_rand.drop(['dose', 'pert_iname', 'moa', 'pert_id', 'Metadata_broad_sample'], axis = 1)
     df_lvl4 = pd.concat([df_level4_cp_rand,df_level4_L1_rand], axis = 1)
     
     return df_lvl4
@@ -150,7 +183,7 @@ def merge_cp_L1000_df(df_cp, df_L1000, all_cpds):
 # In[16]:
 
 
-df_level4 = merge_cp_L1000_df(df_level4_cp, df_level4_L1, all_cpds)
+df_level4 = merge_cp_L1000_df(df_level4_cp, df_level4_L1, all_cpds, seed = 333)
 
 
 # In[17]:
@@ -0,0 +1,101 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+
+def get_drug_mean_targets(drug_codes, targets, n_drugs):
+    """
+    This function returns the mean target labels of every drug (rows in drug code order), the targets of
+    the replicates of each drug are summed at once with a sparse drug x replicate matrix.
+    """
+    n_rows = len(drug_codes)
+    drug_rows = sparse.csr_matrix((np.ones(n_rows), (drug_codes, np.arange(n_rows))), shape=(n_drugs, n_rows))
+    return (drug_rows @ targets) / np.bincount(drug_codes, minlength=n_drugs)[:, None]
+
+def assign_folds(drugs, replicates, targets, nfold, cpd_freq_num, seed=33):
+    """
+    This function assigns every replicate to a K-fold with multi-label stratification (see
+    drug_stratification of the model helpers): drugs with at most cpd_freq_num replicates are stratified
+    on their mean target labels, so all their replicates are in the same fold, and the replicates of the
+    more frequent drugs are stratified on their own target labels. Drugs and replicates are integer-coded,
+    and the folds are assigned on arrays instead of dictionaries.
+
+    Args:
+            drugs: numpy array of the drug (pert_iname) of every replicate.
+            replicates: numpy array of the replicate id of every replicate.
+            targets: 2D numpy array of the target MOA labels of every replicate.
+            nfold: Number of K-folds.
+            cpd_freq_num: maximum number of replicates of the less frequent drugs.
+            seed: random state of the stratified K-fold splits.
+
+    Returns:
+            folds: integer numpy array of the fold of every replicate.
+    """
+    drug_codes, drug_names = pd.factorize(drugs, sort=True)
+    drug_counts = np.bincount(drug_codes, minlength=len(drug_names))
+    rare_drugs = np.flatnonzero(drug_counts <= cpd_freq_num)
+    folds = np.full(len(drug_codes), -1)
+
+    # STRATIFY DRUGS X OR LESS based on each specific drug/compound
+    if len(rare_drugs):
+        drug_targets = get_drug_mean_targets(drug_codes, targets, len(drug_names))[rare_drugs]
+        drug_folds = np.full(len(drug_names), -1)
+        skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=seed)
+        for fold, (_, idx_val) in enumerate(skf.split(drug_targets, drug_targets)):
+            drug_folds[rare_drugs[idx_val]] = fold
+        folds = drug_folds[drug_codes]
+
+    # STRATIFY DRUGS X OR MORE based on the drug's replicates
+    freq_rows = np.flatnonzero(folds < 0)
+    if len(freq_rows):
+        rep_codes, rep_ids = pd.factorize(replicates[freq_rows])
+        rep_folds = np.full(len(rep_ids), -1)
+        skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=seed)
+        for fold, (_, idx_val) in enumerate(skf.split(targets[freq_rows], targets[freq_rows])):
+            rep_folds[rep_codes[idx_val]] = fold
+        folds[freq_rows] = rep_folds[rep_codes]
+    return folds
+
+def get_fold_key(df, target_cols, col_name):
+    """Hash of the drugs, replicate ids and target labels of a train dataframe"""
+    digest = hashlib.blake2b(digest_size=8)
+    df_fold_data = df[['pert_iname', col_name] + list(target_cols)]
+    digest.update(pd.util.hash_pandas_object(df_fold_data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def get_drug_folds(df, nfold, target_cols, col_name, cpd_freq_num, seed=33, fold_dir=None):
+    """
+    This function returns the K-fold of every replicate of a train dataframe (see assign_folds). If
+    fold_dir is given, the folds are saved as a csv file (replicate ids and folds) keyed by a hash of the
+    data, nfold, cpd_freq_num and seed, and every later run on the same data reads the file instead of
+    recomputing the folds, so that all models are trained on the same folds.
+
+    Args:
+            df: train data - pandas dataframe containing all drugs and target labels.
+            nfold: Number of K-folds.
+            target_cols: A list of all target MOA (Mechanism of actions) labels.
+            col_name: A string that indicates the replicate id/replicate name column.
+            cpd_freq_num: maximum number of replicates of the less frequent drugs.
+            seed: random state of the stratified K-fold splits.
+            fold_dir: directory of the fold files, default (None) does not save the folds.
+
+    Returns:
+            folds: integer numpy array of the fold of every row of df.
+    """
+    replicates = df[col_name].values
+    if fold_dir is not None:
+        fold_key = get_fold_key(df, target_cols, col_name)
+        fold_path = os.path.join(fold_dir, f"folds_{nfold}fold_freq{cpd_freq_num}_seed{seed}_{fold_key}.csv")
+        if os.path.exists(fold_path):
+            df_folds = pd.read_csv(fold_path, dtype={col_name: replicates.dtype})
+            if np.array_equal(df_folds[col_name].values, replicates):
+                return df_folds['fold'].values
+    folds = assign_folds(df['pert_iname'].values, replicates, df[list(target_cols)].values, nfold, cpd_freq_num, seed)
+    if fold_dir is not None:
+        os.makedirs(fold_dir, exist_ok=True)
+        tmp_path = fold_path + f".{os.getpid()}.tmp"
+        pd.DataFrame({col_name: replicates, 'fold': folds}).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, fold_path)
+    return folds
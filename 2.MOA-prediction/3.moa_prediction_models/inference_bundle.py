@@ -0,0 +1,141 @@
+import os
+import glob
+import pickle
+import numpy as np
+import pandas as pd
+
+def save_pickle(path, value):
+    """This function pickles a value through a temporary file"""
+    tmp_path = path + f".{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def get_fold_transforms_path(model_dir, file_name, fold):
+    """Path of the fitted preprocessing transforms of a fold"""
+    return os.path.join(model_dir, file_name + f"_FOLD{fold}_transforms.pickle")
+
+def save_fold_transforms(model_dir, file_name, fold, fold_transforms):
+    """
+    This function saves the preprocessing transforms fitted on the train data of a fold (e.g. the
+    fold_transforms returned by preprocess), next to the models trained on the fold.
+    """
+    save_pickle(get_fold_transforms_path(model_dir, file_name, fold), fold_transforms)
+
+def get_bundle_path(model_dir, file_name):
+    """Path of the inference bundle of a model"""
+    return os.path.join(model_dir, file_name + "_inference_bundle.pickle")
+
+def save_inference_bundle(model_dir, file_name, assay, model_name, input_features, target_cols, checkpoint_paths,
+                          model_params=None, feature_models=None, add_stat_feats=False, shuffle=False):
+    """
+    This function saves everything needed to score new profiles with the trained models of a training
+    script in a single inference bundle: the input features, the feature transforms fitted on the
+    whole train data (e.g. UMAP and FactorAnalysis), the transforms fitted on every fold (see
+    save_fold_transforms) and the checkpoints of all (seed, fold) models.
+
+    Args:
+            model_dir: directory of the model checkpoints.
+            file_name: model file name, the bundle is saved as {file_name}_inference_bundle.pickle.
+            assay: assay of the train data - 'cp', 'L1000' or 'cp_L1000'.
+            model_name: type of the model - 'simplenn', '1dcnn', 'tabnet' or 'resnet'.
+            input_features: list of the feature columns of the profiles given to the models.
+            target_cols: A list of all target MOA (Mechanism of actions) labels.
+            checkpoint_paths: Dictionary with the (seed, fold) of every model as the keys (seed is None
+            for models trained without seeds), and the path of its checkpoint as the values.
+            model_params: Dictionary of the arguments used to create the model (e.g. num_features,
+            num_targets and hidden_size).
+            feature_models: Dictionary of the feature transforms fitted on the whole train data, e.g.
+            the 'umap_model' and 'factor_model' returned by umap_factor_features.
+            add_stat_feats: True if the summary statistics of the input features were added as features
+            (see add_stat_feats of the model helpers).
+            shuffle: True if the models were trained on the shuffled train data.
+
+    Returns:
+            bundle_path: path of the inference bundle.
+    """
+    folds = sorted(set(fold for _, fold in checkpoint_paths))
+    fold_transforms = {}
+    for fold in folds:
+        with open(get_fold_transforms_path(model_dir, file_name, fold), 'rb') as handle:
+            fold_transforms[fold] = pickle.load(handle)
+    bundle = {'assay': assay, 'model_name': model_name, 'shuffle': bool(shuffle),
+              'input_features': list(input_features), 'target_cols': list(target_cols),
+              'model_params': dict(model_params or {}), 'feature_models': feature_models,
+              'add_stat_feats': add_stat_feats,
+              'fold_transforms': fold_transforms,
+              'checkpoints': [(seed, fold, os.path.basename(path)) for (seed, fold), path in checkpoint_paths.items()]}
+    bundle_path = get_bundle_path(model_dir, file_name)
+    save_pickle(bundle_path, bundle)
+    return bundle_path
+
+def load_inference_bundle(bundle_path):
+    """This function loads an inference bundle, checkpoints are given as paths in the bundle directory"""
+    with open(bundle_path, 'rb') as handle:
+        bundle = pickle.load(handle)
+    model_dir = os.path.dirname(bundle_path)
+    bundle['checkpoints'] = [(seed, fold, os.path.join(model_dir, name)) for seed, fold, name in bundle['checkpoints']]
+    return bundle
+
+def find_inference_bundles(data_dir, assay, model_names=None, shuffle=False):
+    """
+    This function returns the inference bundles of the models trained on the data of an assay, in
+    the model directories of data_dir.
+
+    Args:
+            data_dir: directory that contains the model directories (the data_dir of the training scripts).
+            assay: assay of the train data - 'cp', 'L1000' or 'cp_L1000'.
+            model_names: list of the model types to load, default (None) loads all saved models.
+            shuffle: If True, loads the models trained on the shuffled train data.
+
+    Returns:
+            bundles: Dictionary with the model names as the keys, and the inference bundles as the values.
+    """
+    bundles = {}
+    for bundle_path in sorted(glob.glob(os.path.join(data_dir, '*', '*_inference_bundle.pickle'))):
+        bundle = load_inference_bundle(bundle_path)
+        if (bundle['assay'] != assay) or (bundle['shuffle'] != bool(shuffle)):
+            continue
+        if (model_names is None) or (bundle['model_name'] in model_names):
+            bundles[bundle['model_name']] = bundle
+    return bundles
+
+def add_feature_models(df_x, feature_models):
+    """
+    This function adds the UMAP and FactorAnalysis features (fitted on the whole train data, see
+    umap_factor_features) to the input features, in the column order used for training.
+    """
+    if not feature_models:
+        return df_x
+    df_x = df_x.reset_index(drop=True)
+    ump, fct = feature_models['umap_model'], feature_models['factor_model']
+    df_umap = pd.DataFrame(ump.transform(df_x), columns=['UMAP_'+str(num) for num in range(ump.n_components)])
+    df_fct = pd.DataFrame(fct.transform(df_x), columns=['FC_'+str(num) for num in range(fct.n_components)])
+    return pd.concat((df_x, df_umap, df_fct), axis=1)
+
+def apply_fold_transforms(df_x, fold_transforms):
+    """
+    This function applies the preprocessing transforms fitted on the train data of a fold to new
+    profiles, in the same order as the preprocess function of the model helpers: mean of the features
+    (ResNet models), normalization, PCA components and feature selection (TabNet models).
+
+    Args:
+            df_x: pandas dataframe of the model features of the profiles.
+            fold_transforms: Dictionary of the fitted transforms of the fold, 'norm_model' and the
+            optional 'pca_model', 'add_mean' and 'feature_mask'.
+
+    Returns:
+            x_fold: float32 numpy array of the model inputs.
+    """
+    df_x = df_x.reset_index(drop=True)
+    if fold_transforms.get('add_mean'):
+        df_x = pd.concat([df_x, pd.DataFrame(df_x.mean(axis=1), columns = ['mean_of_features'])], axis = 1)
+    df_x = pd.DataFrame(fold_transforms['norm_model'].transform(df_x), columns = df_x.columns)
+    pca_model = fold_transforms.get('pca_model')
+    if pca_model is not None:
+        df_pca = pd.DataFrame(pca_model.transform(df_x), columns=['pca'+ str(i) for i in range(pca_model.n_components_)])
+        df_x = pd.concat([df_x, df_pca], axis = 1)
+    x_fold = df_x.values
+    if fold_transforms.get('feature_mask') is not None:
+        x_fold = x_fold[:, fold_transforms['feature_mask']]
+    return np.ascontiguousarray(x_fold, dtype=np.float32)
@@ -8,7 +8,11 @@ import numpy as np
 from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
 from skmultilearn.adapt import MLkNN
 
-##custom modules required
+##custom modules required, found from the location of this script so that it runs from any directory.
+##level4_cache is shared with the exploration helpers, it only needs numpy, pandas and pyarrow
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '../../../1.Data-exploration/exploration_helpers'))
+from level4_cache import read_level4_csv
 from mlknn_helpers import mlknn_train_pred,model_eval_results,save_to_csv
 from mlknn_helpers import split_data,check_if_shuffle_data
 
@@ -54,13 +58,13 @@ class cp_L1000_mlknn_moa_train_prediction:
         _,_,trn_pred_name,tst_pred_name = check_if_shuffle_data(self.shuffle, model_file_name, 
                                                                 model_dir_name, trn_pred_name, tst_pred_name)
         if self.shuffle:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
         else:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
-        df_test = pd.read_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
-                              compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
+        df_test = read_level4_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
+                                  compression='gzip',low_memory = False)
         df_targets = pd.read_csv(os.path.join(self.data_dir, 'target_labels.csv'))
         
         metadata_cols = ['replicate_name', 'replicate_id', 'Metadata_broad_sample', 'Metadata_pert_id', 
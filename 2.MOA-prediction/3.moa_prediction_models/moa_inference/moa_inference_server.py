@@ -0,0 +1,429 @@
+import io
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+import numpy as np
+import torch
+
+##custom modules required, found from the location of this script so that it runs from any directory
+MODELS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(MODELS_DIR)
+from inference_bundle import find_inference_bundles,add_feature_models,apply_fold_transforms
+sys.path.append(os.path.join(MODELS_DIR, 'pytorch_model_helpers'))
+from pytorch_utils import CNN_Model,SimpleNN_Model
+from pytorch_helpers import add_stat_feats
+from model_export import stack_ensemble,export_torchscript,export_onnx
+
+TORCH_MODELS = {'simplenn': SimpleNN_Model, '1dcnn': CNN_Model}
+
+def load_resnet_model(model_path):
+    """This function loads a ResNet (keras) model, tensorflow is only imported for ResNet models"""
+    sys.path.append(os.path.join(MODELS_DIR, 'resnet_model_helpers'))
+    import tensorflow as tf
+    from resnet_helpers import logloss
+    return tf.keras.models.load_model(model_path, custom_objects={'logloss': logloss})
+
+class MOAModelEnsemble:
+    """
+    All the (seed, fold) models of a trained MOA prediction model (SimpleNN, 1D-CNN, TabNet or ResNet),
+    loaded once from the inference bundle saved by its training script (see inference_bundle). New
+    profiles are preprocessed once per fold with the transforms fitted on the train data of the fold,
+    and the MOA probabilities of all models are averaged, the same way the test predictions of the
+    training scripts are averaged across folds and seeds. The SimpleNN and 1D-CNN models are stacked in a
+    single TorchScript model (see model_export), which scores all (seed, fold) models in one forward pass.
+
+    Args:
+            bundle: inference bundle of the model (see inference_bundle.load_inference_bundle).
+            device: Device used for inference - CPU or GPU.
+            batch_size: number of profiles given to the models at once.
+            fuse: If True, the SimpleNN and 1D-CNN models are scored with their stacked TorchScript model,
+            otherwise every (seed, fold) model is scored separately.
+    """
+
+    def __init__(self, bundle, device='cpu', batch_size=4096, fuse=True):
+
+        self.bundle = bundle
+        self.model_name = bundle['model_name']
+        self.device = device
+        self.batch_size = batch_size
+        self.fold_models = {}
+        for seed, fold, model_path in sorted(bundle['checkpoints'], key=lambda job: (job[1], -1 if job[0] is None else job[0])):
+            self.fold_models.setdefault(fold, []).append(self.load_model(model_path))
+        self.num_models = sum(len(models) for models in self.fold_models.values())
+        self.stacked_model = None
+        if fuse and (self.model_name in TORCH_MODELS):
+            self.stacked_model = export_torchscript(self.stack_models())
+
+    def stack_models(self):
+        """This function returns the (eager) stacked model of the SimpleNN or 1D-CNN models, see model_export"""
+        return stack_ensemble([self.fold_models[fold] for fold in sorted(self.fold_models)]).to(self.device)
+
+    def export(self, model_path, export_format='torchscript'):
+        """
+        This function saves the stacked SimpleNN or 1D-CNN models as a TorchScript or ONNX model, which takes
+        the profiles preprocessed for every fold (in sorted fold order) and returns the averaged MOA probabilities.
+        """
+        if self.model_name not in TORCH_MODELS:
+            raise ValueError(f"The {self.model_name} models can not be exported")
+        if export_format == 'onnx':
+            export_onnx(self.stack_models().cpu(), model_path)
+        else:
+            export_torchscript(self.stack_models(), model_path)
+
+    def load_model(self, model_path):
+        """This function loads the checkpoint of a (seed, fold) model"""
+        if self.model_name in TORCH_MODELS:
+            model = TORCH_MODELS[self.model_name](**self.bundle['model_params'])
+            model.load_state_dict(torch.load(model_path, map_location=self.device))
+            model.to(self.device)
+            model.eval()
+            return model
+        if self.model_name == 'tabnet':
+            from pytorch_tabnet.tab_model import TabNetRegressor
+            model = TabNetRegressor()
+            model.load_model(model_path)
+            return model
+        if self.model_name == 'resnet':
+            return load_resnet_model(model_path)
+        raise ValueError(f"Unknown model type: {self.model_name}")
+
+    def check_profiles(self, df_profiles):
+        """This function raises a ValueError if model features are missing from the profiles"""
+        missing_cols = pd.Index(self.bundle['input_features']).difference(df_profiles.columns)
+        if len(missing_cols):
+            raise ValueError(f"{len(missing_cols)} features of the {self.model_name} model are missing from the "
+                             f"profiles, e.g. {missing_cols[:5].tolist()}")
+
+    def get_features(self, df_profiles):
+        """This function returns the model features of the profiles, before the fold transforms"""
+        self.check_profiles(df_profiles)
+        df_x = df_profiles[self.bundle['input_features']].reset_index(drop=True).astype(np.float64)
+        if self.bundle.get('add_stat_feats'):
+            df_x = add_stat_feats(df_x)
+        return add_feature_models(df_x, self.bundle['feature_models'])
+
+    def predict_model(self, model, x_fold):
+        """MOA probabilities of the profiles for one (seed, fold) model"""
+        if self.model_name in TORCH_MODELS:
+            preds = []
+            with torch.inference_mode():
+                for start in range(0, len(x_fold), self.batch_size):
+                    inputs = torch.from_numpy(x_fold[start:start + self.batch_size]).to(self.device)
+                    preds.append(model(inputs).sigmoid().cpu().numpy())
+            return np.concatenate(preds)
+        if self.model_name == 'tabnet':
+            return 1 / (1 + np.exp(-model.predict(x_fold)))
+        return model.predict(x_fold, batch_size=self.batch_size, verbose=0)
+
+    def predict_stacked(self, df_x):
+        """MOA probabilities of the profiles for the stacked model, in one forward pass per batch"""
+        x_folds = np.stack([apply_fold_transforms(df_x, self.bundle['fold_transforms'][fold])
+                            for fold in sorted(self.fold_models)])
+        preds = []
+        with torch.inference_mode():
+            for start in range(0, x_folds.shape[1], self.batch_size):
+                inputs = torch.from_numpy(x_folds[:, start:start + self.batch_size]).to(self.device)
+                preds.append(self.stacked_model(inputs).cpu().numpy())
+        return np.concatenate(preds).astype(np.float64)
+
+    def predict(self, df_profiles):
+        """
+        This function returns the MOA probabilities of the profiles, averaged across all (seed, fold) models.
+
+        Args:
+                df_profiles: pandas dataframe of the profiles, with (at least) the input features of the model.
+
+        Returns:
+                preds: numpy array of the MOA probabilities, with the target_cols of the bundle as columns.
+        """
+        return self.predict_features(self.get_features(df_profiles))
+
+    def predict_features(self, df_x):
+        """
+        This function returns the MOA probabilities of profiles already given as model features (see
+        get_features), averaged across all (seed, fold) models. The fold transforms and the models act on
+        every profile separately, so the features of several requests can be scored at once.
+        """
+        preds = np.zeros((len(df_x), len(self.bundle['target_cols'])))
+        if len(df_x) == 0:
+            return preds
+        if self.stacked_model is not None:
+            return self.predict_stacked(df_x)
+        for fold, models in self.fold_models.items():
+            x_fold = apply_fold_transforms(df_x, self.bundle['fold_transforms'][fold])
+            for model in models:
+                preds += self.predict_model(model, x_fold)
+        return preds / self.num_models
+
+class MOAInferenceServer:
+    """
+    Local inference service of the MOA prediction models trained on the data of an assay. All (seed, fold)
+    models and their preprocessing transforms are loaded once, and new profiles are scored without re-running
+    the training scripts. predict() scores a dataframe at once; submit() queues the profiles of a request,
+    and a background thread micro-batches the queued requests (up to batch_size profiles, waiting at most
+    max_wait_ms for more requests) so that many small requests share the model passes.
+
+    The returned MOA probabilities are averaged across the (seed, fold) models of each model type, then
+    across the model types. The UMAP features of the SimpleNN models depend on the other profiles that
+    are transformed at once (as for the test data of the training scripts), so the UMAP and FactorAnalysis
+    features are computed for every request on its own, and only the features of the requests are
+    micro-batched: a request gets the same probabilities as if it was scored alone with predict().
+
+        with MOAInferenceServer('../../2.data_split/model_data/cp/', 'cp', model_names=['simplenn']) as server:
+            df_preds = server.submit(df_plate).result()
+
+    Args:
+            data_dir: directory that contains the model directories of the training scripts.
+            assay: assay of the train data - 'cp', 'L1000' or 'cp_L1000'.
+            model_names: list of the model types to load ('simplenn', '1dcnn', 'tabnet', 'resnet'), default
+            (None) loads all models trained on the data.
+            shuffle: If True, loads the models trained on the shuffled train data.
+            device: Device used for inference - CPU or GPU, defaults to the GPU if it is available.
+            batch_size: maximum number of profiles of a micro-batch and of a model pass.
+            max_wait_ms: maximum time (in milliseconds) a queued request waits for more requests.
+            warm_up: If True, a profile of zeros is scored once the models are loaded, so that the first
+            request does not wait for the just-in-time compilation of UMAP.
+            fuse: If True, the SimpleNN and 1D-CNN models are scored with their stacked TorchScript model.
+    """
+
+    def __init__(self, data_dir, assay, model_names=None, shuffle=False, device=None, batch_size=4096, max_wait_ms=5,
+                 warm_up=True, fuse=True):
+
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        bundles = find_inference_bundles(data_dir, assay, model_names, shuffle)
+        if not bundles:
+            raise FileNotFoundError(f"No inference bundle of the {assay} models was found in {data_dir}")
+        self.models = {model_name: MOAModelEnsemble(bundle, self.device, batch_size, fuse)
+                       for model_name, bundle in bundles.items()}
+        target_cols = [bundle['target_cols'] for bundle in bundles.values()]
+        if any(cols != target_cols[0] for cols in target_cols):
+            raise ValueError(f"The {assay} models were not trained on the same target labels")
+        self.target_cols = target_cols[0]
+        self.input_features = sorted(set(col for bundle in bundles.values() for col in bundle['input_features']))
+        self.requests = queue.Queue()
+        self.batch_thread = None
+        self.lock = threading.Lock()
+        if warm_up:
+            self.predict(pd.DataFrame(np.zeros((2, len(self.input_features))), columns=self.input_features))
+
+    def predict(self, df_profiles):
+        """
+        This function returns the MOA probabilities of the profiles (see the class docstring).
+
+        Args:
+                df_profiles: pandas dataframe of the profiles, with the input features of the models.
+
+        Returns:
+                df_preds: pandas dataframe of the MOA probabilities, with the index of df_profiles.
+        """
+        preds = self.predict_requests([df_profiles])
+        return pd.DataFrame(preds, columns=self.target_cols, index=df_profiles.index)
+
+    def predict_requests(self, requests):
+        """
+        This function returns the MOA probabilities of the profiles of several requests (a list of dataframes),
+        in the order of the requests. The model features (e.g. UMAP) are computed for every request on its own,
+        then the features of all requests are given to the fold transforms and the models at once.
+        """
+        preds = []
+        for model in self.models.values():
+            df_x = pd.concat([model.get_features(df_profiles) for df_profiles in requests], ignore_index=True)
+            preds.append(model.predict_features(df_x))
+        return np.mean(preds, axis=0)
+
+    def submit(self, df_profiles):
+        """
+        This function queues the profiles of a request for the next micro-batch, and returns a Future of
+        their MOA probabilities (see predict). The micro-batch thread is started on the first request.
+        """
+        for model in self.models.values():
+            model.check_profiles(df_profiles)
+        self.start()
+        future = Future()
+        self.requests.put((df_profiles, future))
+        return future
+
+    def start(self):
+        """This function starts the micro-batch thread"""
+        with self.lock:
+            if self.batch_thread is None:
+                self.batch_thread = threading.Thread(target=self.run_batches, daemon=True)
+                self.batch_thread.start()
+
+    def stop(self):
+        """This function scores the queued requests, then stops the micro-batch thread"""
+        with self.lock:
+            if self.batch_thread is not None:
+                self.requests.put(None)
+                self.batch_thread.join()
+                self.batch_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run_batches(self):
+        """This function collects the queued requests in micro-batches until stop() is called"""
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            num_rows = len(request[0])
+            deadline = time.monotonic() + self.max_wait
+            stopped = False
+            while num_rows < self.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopped = True
+                    break
+                batch.append(request)
+                num_rows += len(request[0])
+            self.run_batch(batch)
+            if stopped:
+                return
+
+    def run_batch(self, batch):
+        """This function scores the profiles of a micro-batch at once, and sets the result of every request"""
+        try:
+            preds = self.predict_requests([df_profiles for df_profiles, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        start = 0
+        for df_profiles, future in batch:
+            stop = start + len(df_profiles)
+            future.set_result(pd.DataFrame(preds[start:stop], columns=self.target_cols, index=df_profiles.index))
+            start = stop
+
+def make_request_handler(server):
+    """
+    This function returns the HTTP request handler of an MOAInferenceServer: POST /predict with a csv body
+    (Content-Type: text/csv) or a JSON list of profile records returns the JSON records of the MOA
+    probabilities; GET / returns the loaded models and the target labels. Errors are returned as a JSON
+    {'error': message}, with status 400 for invalid profiles and 500 for a failure of the models.
+    """
+
+    class MOARequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, payload, status=200):
+            body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.send_json({'models': {name: model.num_models for name, model in server.models.items()},
+                            'target_cols': server.target_cols})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/predict':
+                self.send_json({'error': f"Unknown path: {self.path}"}, status=404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                if 'csv' in self.headers.get('Content-Type', ''):
+                    df_profiles = pd.read_csv(io.BytesIO(body))
+                else:
+                    df_profiles = pd.DataFrame(json.loads(body))
+                df_preds = server.submit(df_profiles).result()
+            except ValueError as error:
+                ##malformed profiles, e.g. a body that is not csv/JSON or missing model features
+                self.send_json({'error': str(error)}, status=400)
+                return
+            except Exception as error:
+                ##any other failure of the models or transforms, so the client never sees a dropped connection
+                self.send_json({'error': f"{type(error).__name__}: {error}"}, status=500)
+                return
+            self.send_json(df_preds.to_json(orient='records'))
+
+    return MOARequestHandler
+
+def score_profiles(server, input_paths, output_path):
+    """
+    This function scores the profiles of one or more csv files (e.g. the level-4 profiles of a new plate),
+    and saves their MOA probabilities in output_path, with the non-feature (metadata) columns of the profiles.
+    """
+    df_profiles = pd.concat([pd.read_csv(path, low_memory=False) for path in input_paths], ignore_index=True)
+    time_start = time.time()
+    df_preds = server.predict(df_profiles)
+    elapsed = time.time() - time_start
+    print(f"Scored {len(df_profiles)} profiles in {elapsed:.2f}s "
+          f"({1000 * elapsed / max(len(df_profiles), 1):.3f} ms per profile)")
+    model_cols = set(server.input_features) | set(server.target_cols)
+    id_cols = [col for col in df_profiles.columns if col not in model_cols]
+    df_preds = pd.concat([df_profiles[id_cols], df_preds], axis=1)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    df_preds.to_csv(output_path, index=False)
+
+def parse_args():
+    """Arguments to pass to this Script"""
+
+    parser = argparse.ArgumentParser(description="Score profiles with the trained MOA prediction models")
+    parser.add_argument('--data_dir', type=str, help='directory that contains the model directories of the training scripts')
+    parser.add_argument('--assay', type=str, choices=['cp', 'L1000', 'cp_L1000'], help='assay of the models')
+    parser.add_argument('--models', type=str, nargs='+', choices=['simplenn', '1dcnn', 'tabnet', 'resnet'],
+                        default=None, help='model types to load, defaults to all models trained on the data')
+    parser.add_argument('--shuffle', action="store_true", help='load the models trained on the shuffled data')
+    parser.add_argument('--input', type=str, nargs='+', default=None, help='csv files of the profiles to score, \
+    if not given the models are served over HTTP')
+    parser.add_argument('--output', type=str, default='moa_predictions.csv', help='csv file of the MOA probabilities')
+    parser.add_argument('--batch_size', type=int, default = 4096, nargs='?', help='maximum number of profiles per batch')
+    parser.add_argument('--max_wait_ms', type=float, default = 5, nargs='?', help='maximum time a request waits \
+    for a micro-batch')
+    parser.add_argument('--n_threads', type=int, default = None, nargs='?', help='Number of torch threads')
+    parser.add_argument('--no_fuse', action="store_true", help='score every (seed, fold) SimpleNN and 1D-CNN model \
+    separately, instead of their stacked TorchScript model')
+    parser.add_argument('--export_dir', type=str, default=None, help='directory where the stacked SimpleNN and 1D-CNN \
+    models are exported, instead of scoring profiles')
+    parser.add_argument('--export_format', type=str, choices=['torchscript', 'onnx'], default='torchscript',
+                        help='format of the exported models')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='host of the HTTP server')
+    parser.add_argument('--port', type=int, default=8000, help='port of the HTTP server')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.n_threads:
+        torch.set_num_threads(args.n_threads)
+    moa_server = MOAInferenceServer(args.data_dir, args.assay, args.models, args.shuffle,
+                                    batch_size=args.batch_size, max_wait_ms=args.max_wait_ms,
+                                    warm_up=not args.export_dir, fuse=not args.no_fuse)
+    print(f"Loaded models: {', '.join(f'{name} ({model.num_models})' for name, model in moa_server.models.items())}")
+    if args.export_dir:
+        os.makedirs(args.export_dir, exist_ok=True)
+        extension = '.onnx' if args.export_format == 'onnx' else '.pt'
+        for name, model in moa_server.models.items():
+            if name in TORCH_MODELS:
+                model_path = os.path.join(args.export_dir, f"{args.assay}_{name}_stacked{extension}")
+                model.export(model_path, args.export_format)
+                print(f"Exported the stacked {name} models to {model_path}")
+    elif args.input:
+        score_profiles(moa_server, args.input, args.output)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), make_request_handler(moa_server))
+        print(f"Serving MOA predictions on http://{args.host}:{args.port}/predict")
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            moa_server.stop()
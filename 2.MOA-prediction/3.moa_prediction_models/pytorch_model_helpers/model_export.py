@@ -0,0 +1,245 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.weight_norm import WeightNorm
+from pytorch_utils import CNN_Model,SimpleNN_Model
+
+def get_weight(layer):
+    """Weight of a linear or convolution layer, computed from its weight norm (g * v / ||v||) if it has one"""
+    for hook in layer._forward_pre_hooks.values():
+        if isinstance(hook, WeightNorm) and hook.name == 'weight':
+            return hook.compute_weight(layer)
+    return layer.weight
+
+def get_batch_norm_affine(batch_norm):
+    """Scale and shift of an eval-mode batch norm, i.e. batch_norm(x) = x * scale + shift"""
+    scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+    shift = batch_norm.bias - batch_norm.running_mean * scale
+    return scale, shift
+
+def fold_batch_norm_linear(batch_norm, linear):
+    """
+    This function folds an eval-mode batch norm (or None) into the linear layer that follows it.
+
+    Returns:
+            weight: weight of the folded layer, with shape (in_features, out_features).
+            bias: bias of the folded layer, with shape (out_features,).
+    """
+    weight = get_weight(linear)
+    bias = linear.bias if linear.bias is not None else torch.zeros(linear.out_features)
+    if batch_norm is not None:
+        scale, shift = get_batch_norm_affine(batch_norm)
+        bias = bias + weight @ shift
+        weight = weight * scale
+    return weight.t(), bias
+
+def fold_batch_norm_conv(batch_norm, conv, length):
+    """
+    This function folds an eval-mode batch norm into the 1D convolution that follows it, for inputs of a
+    fixed length. The zero padding of the convolution is applied after the batch norm, so the shift of the
+    batch norm is folded as a bias of every output position: the convolution of a constant input.
+
+    Returns:
+            weight: weight of the folded convolution.
+            bias: bias of the folded convolution, with shape (out_channels, length).
+    """
+    scale, shift = get_batch_norm_affine(batch_norm)
+    weight = get_weight(conv)
+    bias = F.conv1d(shift[None, :, None].expand(1, -1, length), weight, conv.bias, conv.stride, conv.padding)[0]
+    return weight * scale[None, :, None], bias
+
+def stack_linear_layers(layers, num_groups=None):
+    """
+    This function stacks the folded linear layers (see fold_batch_norm_linear) of the ensemble members, for
+    batched matrix products. If num_groups is given, the layers of the consecutive members of a group (e.g.
+    the seeds of a fold, which share the same inputs) are concatenated along the outputs.
+
+    Returns:
+            weights: tensor of shape (members or groups, in_features, out_features [x group size]).
+            biases: tensor of shape (members or groups, 1, out_features [x group size]).
+    """
+    weights = [weight for weight, _ in layers]
+    biases = [bias for _, bias in layers]
+    if num_groups is not None:
+        group_size = len(layers) // num_groups
+        weights = [torch.cat(weights[idx:idx + group_size], 1) for idx in range(0, len(layers), group_size)]
+        biases = [torch.cat(biases[idx:idx + group_size]) for idx in range(0, len(layers), group_size)]
+    return torch.stack(weights).detach().contiguous(), torch.stack(biases)[:, None, :].detach().contiguous()
+
+def get_ensemble_members(fold_models):
+    """This function returns the members of an ensemble in (fold, seed) order, and the number of seeds"""
+    num_seeds = len(fold_models[0])
+    if any(len(models) != num_seeds for models in fold_models):
+        raise ValueError("All folds of the ensemble must have the same number of models")
+    return [model for models in fold_models for model in models], num_seeds
+
+class StackedSimpleNN(nn.Module):
+    """
+    The (seed, fold) SimpleNN_Model members of an ensemble, with the batch norms and weight norms folded into
+    the linear layers, stacked in a single model that scores all members in one forward pass (batched matrix
+    products) and returns their averaged MOA probabilities. The members of a fold share the same inputs (the
+    profiles preprocessed with the transforms of the fold), so the first layers of the seeds of a fold are
+    computed as a single layer.
+
+    Args:
+            fold_models: list with the list of trained (seed) models of every fold, all folds must have the
+            same number of models.
+    """
+
+    def __init__(self, fold_models):
+        super(StackedSimpleNN, self).__init__()
+        models, self.num_seeds = get_ensemble_members(fold_models)
+        self.hidden_size = models[0].dense2.in_features
+        weight1, bias1 = stack_linear_layers([fold_batch_norm_linear(model.batch_norm1, model.dense1) for model in models],
+                                             len(fold_models))
+        weight2, bias2 = stack_linear_layers([fold_batch_norm_linear(model.batch_norm2, model.dense2) for model in models])
+        weight3, bias3 = stack_linear_layers([fold_batch_norm_linear(model.batch_norm3, model.dense3) for model in models])
+        self.register_buffer('weight1', weight1)
+        self.register_buffer('bias1', bias1)
+        self.register_buffer('weight2', weight2)
+        self.register_buffer('bias2', bias2)
+        self.register_buffer('weight3', weight3)
+        self.register_buffer('bias3', bias3)
+
+    def forward(self, x):
+        """x: profiles preprocessed for every fold, with shape (num_folds, num_profiles, num_features)"""
+        num_profiles = x.shape[1]
+        x = F.leaky_relu(torch.baddbmm(self.bias1, x, self.weight1))
+        x = x.reshape(-1, num_profiles, self.num_seeds, self.hidden_size).transpose(1, 2)
+        x = F.leaky_relu(torch.baddbmm(self.bias2, x.reshape(-1, num_profiles, self.hidden_size), self.weight2))
+        x = torch.baddbmm(self.bias3, x, self.weight3)
+        return torch.sigmoid(x).mean(0)
+
+class StackedCNN(nn.Module):
+    """
+    The (seed, fold) CNN_Model members of an ensemble, with the batch norms and weight norms folded into the
+    linear and convolution layers, stacked in a single model that scores all members in one forward pass:
+    the dense layers are batched matrix products, and the convolutions of the members are grouped
+    convolutions. Returns the averaged MOA probabilities of the members.
+
+    Args:
+            fold_models: list with the list of trained (seed) models of every fold, all folds must have the
+            same number of models.
+    """
+
+    def __init__(self, fold_models):
+        super(StackedCNN, self).__init__()
+        models, self.num_seeds = get_ensemble_members(fold_models)
+        model = models[0]
+        self.num_models = len(models)
+        self.cha_1_reshape = model.cha_1_reshape
+        self.cha_po_1 = model.cha_po_1
+        self.padding1 = model.conv1.padding[0]
+        self.padding2 = model.conv2.padding[0]
+        self.padding2_1 = model.conv2_1.padding[0]
+        self.padding2_2 = model.conv2_2.padding[0]
+        self.pool_kernel_size = model.max_po_c2.kernel_size
+        self.pool_stride = model.max_po_c2.stride
+        self.pool_padding = model.max_po_c2.padding
+        weight1, bias1 = stack_linear_layers([fold_batch_norm_linear(None, model.dense1) for model in models],
+                                             len(fold_models))
+        weight3, bias3 = stack_linear_layers([fold_batch_norm_linear(model.batch_norm3, model.dense3) for model in models])
+        self.register_buffer('weight1', weight1)
+        self.register_buffer('bias1', bias1)
+        self.register_buffer('conv_weight1', torch.cat([get_weight(model.conv1) for model in models]).detach())
+        for name, batch_norm_name in [('2', 'batch_norm_c2'), ('2_1', 'batch_norm_c2_1'), ('2_2', 'batch_norm_c2_2')]:
+            convs = [fold_batch_norm_conv(getattr(model, batch_norm_name), getattr(model, 'conv' + name), self.cha_po_1)
+                     for model in models]
+            self.register_buffer('conv_weight' + name, torch.cat([weight for weight, _ in convs]).detach())
+            self.register_buffer('conv_bias' + name, torch.cat([bias for _, bias in convs]).detach())
+        self.register_buffer('weight3', weight3)
+        self.register_buffer('bias3', bias3)
+
+    def forward(self, x):
+        """x: profiles preprocessed for every fold, with shape (num_folds, num_profiles, num_features)"""
+        num_profiles = x.shape[1]
+        x = F.celu(torch.baddbmm(self.bias1, x, self.weight1), alpha=0.06)
+        ##channels of every member are consecutive: (num_profiles, num_models * cha_1, cha_1_reshape)
+        x = x.transpose(0, 1).reshape(num_profiles, -1, self.cha_1_reshape)
+        x = F.relu(F.conv1d(x, self.conv_weight1, None, 1, self.padding1, 1, self.num_models))
+        x = F.adaptive_avg_pool1d(x, self.cha_po_1)
+        x = F.relu(F.conv1d(x, self.conv_weight2, None, 1, self.padding2, 1, self.num_models) + self.conv_bias2)
+        x_s = x
+        x = F.relu(F.conv1d(x, self.conv_weight2_1, None, 1, self.padding2_1, 1, self.num_models) + self.conv_bias2_1)
+        x = F.relu(F.conv1d(x, self.conv_weight2_2, None, 1, self.padding2_2, 1, self.num_models) + self.conv_bias2_2)
+        x = x * x_s
+        x = F.max_pool1d(x, self.pool_kernel_size, self.pool_stride, self.pool_padding)
+        x = x.reshape(num_profiles, self.num_models, -1).transpose(0, 1)
+        x = torch.baddbmm(self.bias3, x, self.weight3)
+        return torch.sigmoid(x).mean(0)
+
+def stack_ensemble(fold_models):
+    """
+    This function stacks the trained (seed, fold) models of a SimpleNN_Model or CNN_Model ensemble in a single
+    model (see StackedSimpleNN and StackedCNN).
+
+    Args:
+            fold_models: list with the list of trained (seed) models of every fold.
+
+    Returns:
+            stacked_model: eval-mode model that returns the averaged MOA probabilities of the members, for
+            the profiles preprocessed for every fold (shape (num_folds, num_profiles, num_features)).
+    """
+    with torch.no_grad():
+        if isinstance(fold_models[0][0], SimpleNN_Model):
+            return StackedSimpleNN(fold_models).eval()
+        if isinstance(fold_models[0][0], CNN_Model):
+            return StackedCNN(fold_models).eval()
+    raise ValueError(f"Models of type {type(fold_models[0][0]).__name__} can not be stacked")
+
+def predict_stacked_checkpoints(Model, model_params, checkpoint_paths, x_folds, device='cpu', batch_size=4096):
+    """
+    This function loads the saved (seed, fold) checkpoints of a SimpleNN_Model or CNN_Model training run,
+    stacks them (see stack_ensemble) and scores the test profiles of all folds in one forward pass per batch,
+    instead of a test pass of every (seed, fold) model. The predictions are the MOA probabilities averaged
+    across all models, as the test predictions of the training jobs are averaged across folds and seeds.
+
+    Args:
+            Model: model class of the checkpoints (SimpleNN_Model or CNN_Model).
+            model_params: dictionary with the keyword arguments of Model.
+            checkpoint_paths: dictionary with the (seed, fold) of every model as the keys (seed is None for
+            runs without seeds) and the path of its checkpoint as the values.
+            x_folds: dictionary with the folds as the keys and the test profiles preprocessed for the fold
+            (numpy array of shape (num_profiles, num_features)) as the values.
+            device: Device used for inference - CPU or GPU.
+            batch_size: number of profiles given to the stacked model at once.
+
+    Returns:
+            predictions: numpy array of the MOA probabilities of the test profiles.
+    """
+    folds = sorted(x_folds)
+    fold_models = {fold:[] for fold in folds}
+    for seed, fold in sorted(checkpoint_paths, key=lambda job: (job[1], -1 if job[0] is None else job[0])):
+        model = Model(**model_params)
+        model.load_state_dict(torch.load(checkpoint_paths[(seed, fold)], map_location=device))
+        fold_models[fold].append(model.to(device).eval())
+    stacked_model = stack_ensemble([fold_models[fold] for fold in folds]).to(device)
+    x_folds = np.stack([x_folds[fold] for fold in folds]).astype(np.float32)
+    preds = []
+    with torch.inference_mode():
+        for start in range(0, x_folds.shape[1], batch_size):
+            inputs = torch.from_numpy(x_folds[:, start:start + batch_size]).to(device)
+            preds.append(stacked_model(inputs).cpu().numpy())
+    return np.concatenate(preds).astype(np.float64)
+
+def export_torchscript(stacked_model, model_path=None):
+    """
+    This function compiles a stacked ensemble to a frozen TorchScript model, which is saved in model_path (if
+    given) and can be loaded with torch.jit.load without the model classes.
+    """
+    scripted_model = torch.jit.freeze(torch.jit.script(stacked_model.eval()))
+    if model_path is not None:
+        torch.jit.save(scripted_model, model_path)
+    return scripted_model
+
+def export_onnx(stacked_model, model_path, opset_version=17):
+    """
+    This function saves a stacked ensemble as an ONNX model, with a dynamic number of profiles. It requires the
+    onnx package.
+    """
+    num_folds, num_features = stacked_model.weight1.shape[:2]
+    torch.onnx.export(stacked_model.eval(), (torch.zeros(num_folds, 2, num_features),), model_path,
+                      input_names=['profiles'], output_names=['moa_probabilities'],
+                      dynamic_axes={'profiles': {1: 'num_profiles'}, 'moa_probabilities': {0: 'num_profiles'}},
+                      opset_version=opset_version)
@@ -1,4 +1,5 @@
 import umap
+import sklearn
 from sklearn.decomposition import PCA,FactorAnalysis
 from sklearn.preprocessing import StandardScaler,QuantileTransformer
 from sklearn.metrics import precision_recall_curve,log_loss
@@ -7,7 +8,7 @@ from sklearn.feature_selection import VarianceThreshold
 import os
 import pandas as pd
 import numpy as np
-from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+from fold_assignment import get_drug_folds
 
 def split_data(df_train, df_test, metadata_cols, target_cols):
     """
@@ -32,7 +33,7 @@ def check_if_shuffle_data(shuffle, model_file_name=None, model_dir_name=None, tr
             dir_name_list[idx] = f"{x}_shuffle"
     return dir_name_list
 
-def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=60):
+def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=60,seed=33,fold_dir=None):
     """
     This function performs multi-label K-fold stratification on the compounds/drugs found
     in the train dataset. Here, because the distribution of drugs is highly imbalanced
@@ -49,6 +50,9 @@ def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=60):
     are rare belong to the same fold. 
     For more info: https://www.kaggle.com/c/lish-moa/discussion/195195
     
+    The folds are assigned on integer-coded drugs and replicates (see fold_assignment.assign_folds), and
+    saved in fold_dir so that all models trained on the same data reuse the same folds.
+    
     Args:
             df: train data - pandas dataframe containing all drugs and features.
             
@@ -61,34 +65,16 @@ def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=60):
             cpd_freq_num: A number that is used to divide drugs/compounds into two categories i.e.
             first category consist of highly frequent drugs in the train data and the second one
             consist of rarely seen/less frequent drugs in the train data
+            
+            seed: random state of the multi-label stratified K-fold splits.
+            
+            fold_dir: directory where the folds are saved, default (None) does not save the folds.
     
     Returns:
             df: train data - pandas dataframe with a new column called 'fold', which wil be used for cross-validation
             during model training
     """
-    drug_value_ct = df['pert_iname'].value_counts()
-    drug_vc1 = drug_value_ct.loc[drug_value_ct <= cpd_freq_num].index.sort_values()
-    drug_vc2 = drug_value_ct.loc[drug_value_ct > cpd_freq_num].index.sort_values()
-    dct1 = {}; dct2 = {}
-    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=33)
-    df_drug_vc1 = df.groupby('pert_iname')[target_cols].mean().loc[drug_vc1]
-    
-    # STRATIFY DRUGS X OR LESS based on each specific drug/compound
-    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc1,df_drug_vc1[target_cols])):
-        drugs_fold = {drugs:fold for drugs in df_drug_vc1.index[idxV].values}
-        dct1.update(drugs_fold)
-        
-    # STRATIFY DRUGS X OR MORE based on the drug's replicates
-    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True)
-    df_drug_vc2 = df.loc[df.pert_iname.isin(drug_vc2)].reset_index(drop=True)
-    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc2,df_drug_vc2[target_cols])):
-        drugs_fold = {drugs:fold for drugs in df_drug_vc2[col_name][idxV].values}
-        dct2.update(drugs_fold)
-        
-    ##fold column
-    df['fold'] = df.pert_iname.map(dct1)
-    df.loc[df.fold.isna(),'fold'] = df.loc[df.fold.isna(),col_name].map(dct2)
-    df['fold'] = df['fold'].astype(int)
+    df['fold'] = get_drug_folds(df, nfold, target_cols, col_name, cpd_freq_num, seed, fold_dir)
     
     return df
     
@@ -109,7 +95,7 @@ def add_stat_feats(df):
     df['skew_of_feats'] = df.skew(axis = 1)
     return df
 
-def normalize(trn, val, test):
+def normalize(trn, val, test, return_model=False):
     """
     Performs quantile normalization on the train, test and validation data. The QuantileTransformer
     is fitted on the train data, and transformed on test and validation data.
@@ -118,19 +104,23 @@ def normalize(trn, val, test):
             trn: train data - pandas dataframe.
             val: validation data - pandas dataframe.
             test: test data - pandas dataframe.
+            return_model: If True, the fitted QuantileTransformer is also returned.
     
     Returns:
             trn_norm: normalized train data - pandas dataframe.
             val_norm: normalized validation - pandas dataframe.
             test_norm: normalized test data - pandas dataframe.
+            norm_model: the fitted QuantileTransformer, only if return_model is True.
     """
     norm_model = QuantileTransformer(n_quantiles=100,random_state=0, output_distribution="normal")
     trn_norm = pd.DataFrame(norm_model.fit_transform(trn),index = trn.index,columns = trn.columns)
     val_norm = pd.DataFrame(norm_model.transform(val),index = val.index,columns = val.columns)
     tst_norm = pd.DataFrame(norm_model.transform(test),index = test.index,columns = test.columns)
+    if return_model:
+        return trn_norm, val_norm, tst_norm, norm_model
     return trn_norm, val_norm, tst_norm
     
-def pca_features(train,validation,test,no_of_components):
+def pca_features(train,validation,test,no_of_components,return_model=False):
     """
     This function performs PCA (Principal Component Analysis) transformation on the train, 
     test and validation data. The PCA is fitted on the train data, and transformed on test 
@@ -141,20 +131,24 @@ def pca_features(train,validation,test,no_of_components):
             validation: validation data - pandas dataframe.
             test: test data - pandas dataframe.
             no_of_components: Number of principal components (PCs) to extract from PCA.
+            return_model: If True, the fitted PCA is also returned.
     
     Returns:
             train_pca: train data - pandas dataframe with only PCs.
             validation_pca: validation data - pandas dataframe with only PCs.
             test_pca: test data - pandas dataframe with only PCs.
+            pca: the fitted PCA, only if return_model is True.
     """
     pca = PCA(n_components=no_of_components, random_state=42)
     feat_new = ['pca'+ str(i) for i in range(no_of_components)]
     train_pca = pd.DataFrame(pca.fit_transform(train),columns=feat_new)
     validation_pca = pd.DataFrame(pca.transform(validation),columns=feat_new)
     test_pca = pd.DataFrame(pca.transform(test),columns=feat_new)
+    if return_model:
+        return train_pca, validation_pca, test_pca, pca
     return(train_pca, validation_pca, test_pca)
 
-def umap_factor_features(df_train_x, df_test_x, num_of_components, num_of_dimensions):
+def umap_factor_features(df_train_x, df_test_x, num_of_components, num_of_dimensions, return_models=False):
     """
     This function performs Factor analysis and UMAP transformation on the train, 
     test data, and add the resulting features from the transformation to the original dataframes. 
@@ -165,10 +159,13 @@ def umap_factor_features(df_train_x, df_test_x, num_of_components, num_of_dimens
             test: test data with morphologic/phenotypic features - pandas dataframe.
             no_of_components: Number of components to extract from FactorAnalysis.
             no_of_dimensions: Number of dimensions to extract from UMAP.
+            return_models: If True, the fitted UMAP and FactorAnalysis are also returned.
     
     Returns:
             df_train_x: train data - pandas dataframe with added factoranalysis and UMAP features.
             df_test_x: test data - pandas dataframe with added factoranalysis and UMAP features.
+            feature_models: dictionary of the fitted 'umap_model' and 'factor_model', only if return_models
+            is True.
     """
     fct = FactorAnalysis(n_components=num_of_components, random_state=1903).fit(df_train_x)
     fct_feats = ['FC_'+str(num) for num in range(num_of_components)]
@@ -183,9 +180,11 @@ def umap_factor_features(df_train_x, df_test_x, num_of_components, num_of_dimens
     df_train_x = pd.concat((df_train_x, df_umap_train, df_fct_train), axis=1)
     df_test_x = pd.concat((df_test_x, df_umap_test, df_fct_test), axis=1)
     
+    if return_models:
+        return df_train_x, df_test_x, {'umap_model': ump, 'factor_model': fct}
     return df_train_x, df_test_x
 
-def variance_threshold(x_fold_train, x_fold_val, df_test_x_copy):
+def variance_threshold(x_fold_train, x_fold_val, df_test_x_copy, return_mask=False):
     """
     This function perform feature selection on the data, i.e. removes all low-variance features below the
     given 'threshold' parameter.
@@ -196,11 +195,13 @@ def variance_threshold(x_fold_train, x_fold_val, df_test_x_copy):
             x_fold_val: K-fold validation data with only phenotypic/morphological features and PCs - pandas 
             dataframe.
             df_test_x_copy: test data - pandas dataframe with only phenotypic/morphological features and PCs.
+            return_mask: If True, the boolean mask of the selected features is also returned.
     
     Returns:
             x_fold_train: K-fold train data after feature selection - pandas dataframe.
             x_fold_val: K-fold validation data after feature selection - pandas dataframe.
             df_test_x_copy: test data - pandas dataframe after feature selection - pandas dataframe.
+            feature_mask: boolean numpy array of the selected features, only if return_mask is True.
     
     """
     var_thresh = VarianceThreshold(threshold = 0.8)
@@ -208,13 +209,23 @@ def variance_threshold(x_fold_train, x_fold_val, df_test_x_copy):
     x_fold_train = x_fold_train.loc[:,var_thresh.variances_ > 0.8]
     x_fold_val = x_fold_val.loc[:,var_thresh.variances_ > 0.8]
     df_test_x_copy = df_test_x_copy.loc[:,var_thresh.variances_ > 0.8]
+    if return_mask:
+        return x_fold_train, x_fold_val, df_test_x_copy, var_thresh.variances_ > 0.8
     return x_fold_train, x_fold_val, df_test_x_copy
 
-def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_components):
+def get_preprocess_version():
+    """
+    Versions of the libraries the preprocessing transforms are fitted with, used as the version of the
+    preprocessing cache, so that the cached folds are refitted after an upgrade of scikit-learn or UMAP
+    """
+    return f"sklearn-{sklearn.__version__}_umap-{umap.__version__}"
+
+def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_components, return_transforms=False):
     """
     This function split the train data into a K-fold subset, performs normalization on
     them, performs PCA on the train, test and validation data and finally concatenate new 
-    PCs with the existing dataframes.
+    PCs with the existing dataframes. The PCA is skipped if no_of_components is None. The fitted
+    transforms of the fold can be returned, to be saved with the model (see inference_bundle).
     
     Args:
             fold: fold value.
@@ -222,7 +233,8 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_componen
             df_train_x: train data - pandas dataframe with only phenotypic/morphological features.
             df_train_y: train data - pandas dataframe with only the Mechanism of actions (MOAs) target labels.
             df_test_x: test data - pandas dataframe with only phenotypic/morphological features.
-            no_of_components: Number of principal components (PCs) to extract from PCA.
+            no_of_components: Number of principal components (PCs) to extract from PCA, None for no PCA.
+            return_transforms: If True, the fitted transforms of the fold are also returned.
     
     Returns:
             x_fold_train: K-fold train data with only phenotypic/morphological features and PCs - pandas 
@@ -235,6 +247,8 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_componen
             dataframe.
             df_test_x: test data - pandas dataframe with only phenotypic/morphological features and PCs.
             val_idx: A list of the K-fold validation indices from the train data
+            fold_transforms: dictionary of the fitted 'norm_model' and 'pca_model' (None without PCA), only
+            if return_transforms is True.
     """
     trn_idx = df_train[df_train['fold'] != fold].index
     val_idx = df_train[df_train['fold'] == fold].index
@@ -247,14 +261,21 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_componen
     df_test_x_copy = df_test_x.copy()
     
     ### -- normalize using quantile normalization ----
-    x_fold_train, x_fold_val, df_test_x_copy = normalize(x_fold_train, x_fold_val, df_test_x_copy)
+    x_fold_train, x_fold_val, df_test_x_copy, norm_model = \
+    normalize(x_fold_train, x_fold_val, df_test_x_copy, return_model=True)
     
     ### --- engineer features with PCA ----
-    trn_fold_pca,val_fold_pca,test_pca = pca_features(x_fold_train,x_fold_val,df_test_x_copy,no_of_components)
-    x_fold_train = pd.concat([x_fold_train,trn_fold_pca],axis = 1)
-    x_fold_val = pd.concat([x_fold_val,val_fold_pca],axis = 1)
-    df_test_x_copy  = pd.concat([df_test_x_copy,test_pca],axis = 1)
-    
+    pca_model = None
+    if no_of_components is not None:
+        trn_fold_pca,val_fold_pca,test_pca,pca_model = \
+        pca_features(x_fold_train,x_fold_val,df_test_x_copy,no_of_components,return_model=True)
+        x_fold_train = pd.concat([x_fold_train,trn_fold_pca],axis = 1)
+        x_fold_val = pd.concat([x_fold_val,val_fold_pca],axis = 1)
+        df_test_x_copy  = pd.concat([df_test_x_copy,test_pca],axis = 1)
+    
+    if return_transforms:
+        fold_transforms = {'norm_model': norm_model, 'pca_model': pca_model}
+        return x_fold_train,y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx, fold_transforms
     return x_fold_train,y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx
     
 def model_eval_results(df_trn_y, oofs, df_tst, df_tst_y, df_preds, target_cols):
@@ -97,32 +97,69 @@ class SmoothBCEwLogits(_WeightedLoss):
             loss = loss.mean()
         return loss
         
+def to_float_tensor(values):
+    """This function converts a numpy array to a contiguous float32 torch tensor, without a copy if it is already one"""
+    return torch.from_numpy(np.ascontiguousarray(values, dtype=np.float32))
+
 class TrainDataset:
     """
     This class generates a dictionary of torch tensor objects consisting of train data 
-    - targets and features.
+    - targets and features. The features and targets are converted to contiguous float32 tensors once, 
+    and indexing with a slice (a view) or an index tensor (a gather) returns a whole batch at once.
     """
     def __init__(self, features, targets):
-        self.features = features
-        self.targets = targets
+        self.features = to_float_tensor(features)
+        self.targets = to_float_tensor(targets)
     def __len__(self):
         return (self.features.shape[0])
     def __getitem__(self, idx):
-        dct = {'x' : torch.tensor(self.features[idx, :], dtype=torch.float),
-               'y' : torch.tensor(self.targets[idx, :], dtype=torch.float)}
+        dct = {'x' : self.features[idx],
+               'y' : self.targets[idx]}
         return dct
         
 class TestDataset:
     """
-    This class generates a dictionary of torch tensor objects consisting of test features.
+    This class generates a dictionary of torch tensor objects consisting of test features, converted to
+    a contiguous float32 tensor once (see TrainDataset).
     """
     def __init__(self, features):
-        self.features = features
+        self.features = to_float_tensor(features)
     def __len__(self):
         return (self.features.shape[0])
     def __getitem__(self, idx):
-        dct = {'x' : torch.tensor(self.features[idx, :],dtype=torch.float)}
+        dct = {'x' : self.features[idx]}
         return dct
+
+class TensorBatchSampler:
+    """
+    This class generates the batches of a tensor backed dataset (TrainDataset/TestDataset): slices of 
+    consecutive rows, or index tensors of a random permutation (drawn with the torch random generator) 
+    if shuffle is True, so that every batch is taken from the dataset tensors at once instead of row by row.
+    """
+    def __init__(self, num_samples, batch_size, shuffle=False, drop_last=False):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+    def __iter__(self):
+        order = torch.randperm(self.num_samples) if self.shuffle else None
+        for batch in range(len(self)):
+            start = batch * self.batch_size
+            end = min(start + self.batch_size, self.num_samples)
+            yield order[start:end] if self.shuffle else slice(start, end)
+
+def get_dataloader(dataset, batch_size, shuffle=False, drop_last=False):
+    """
+    This function returns a DataLoader over whole batches of a tensor backed dataset (see TensorBatchSampler),
+    the batches are dictionaries of tensors like the ones of the default DataLoader, so they can be used with
+    train_fn, valid_fn and inference_fn.
+    """
+    batch_sampler = TensorBatchSampler(len(dataset), batch_size, shuffle, drop_last)
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler)
         
 def train_fn(model, optimizer, scheduler, loss_fn, dataloader, device):
     model.train()
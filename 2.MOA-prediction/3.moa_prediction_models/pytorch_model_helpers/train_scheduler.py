@@ -0,0 +1,146 @@
+import os
+import time
+import numpy as np
+import torch
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+def init_train_worker(num_threads):
+    """This function bounds the number of torch threads of a worker process"""
+    torch.set_num_threads(num_threads)
+
+def get_job_pred_path(pred_dir, file_name, fold, seed=None):
+    """Path of the OOF and test predictions of a (seed, fold) training job"""
+    seed_name = '' if seed is None else f"_SEED{seed}"
+    return os.path.join(pred_dir, file_name + f"{seed_name}_FOLD{fold}_preds.npz")
+
+def save_job_preds(pred_path, oof, predictions):
+    """This function saves the predictions of a job through a temporary file, predictions may be None"""
+    job_preds = {'oof': oof} if predictions is None else {'oof': oof, 'predictions': predictions}
+    tmp_path = pred_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as handle:
+        np.savez(handle, **job_preds)
+    os.replace(tmp_path, pred_path)
+
+def run_train_job(job):
+    """
+    This function trains the model of one (seed, fold) job with the training function of the run, saves its
+    OOF and test predictions and returns the seed, fold, predictions path and run time in seconds.
+    """
+    train_func, seed, fold, pred_path, fold_data = job
+    train_args = (fold,) if seed is None else (fold, seed)
+    if fold_data is not None:
+        train_args += (fold_data,)
+    start = time.time()
+    oof, predictions = train_func(*train_args)
+    save_job_preds(pred_path, oof, predictions)
+    return seed, fold, pred_path, time.time() - start
+
+def merge_job_preds(job_paths, nfolds, seeds=None):
+    """
+    This function merges the saved predictions of all jobs in (seed, fold) order, with the same arithmetic
+    as the serial training loops: the OOF predictions of the folds of a seed are summed, the test
+    predictions are averaged across folds, then both are averaged across seeds.
+
+    Args:
+            job_paths: Dictionary with the (seed, fold) of every job as the keys, and the path of its
+            predictions as the values.
+            nfolds: Number of K-folds.
+            seeds: list of the seeds of the run, default (None) for a run without seeds.
+
+    Returns:
+            oofs: numpy array of the OOF (train) predictions.
+            predictions: numpy array of the test predictions, None if the jobs saved no test predictions.
+    """
+    oofs = predictions = None
+    for seed in ([None] if seeds is None else seeds):
+        oof_seed = pred_seed = None
+        for fold in range(nfolds):
+            with np.load(job_paths[(seed, fold)]) as job_preds:
+                if oof_seed is None:
+                    oof_seed = np.zeros(job_preds['oof'].shape)
+                    if 'predictions' in job_preds.files:
+                        pred_seed = np.zeros(job_preds['predictions'].shape)
+                if pred_seed is not None:
+                    pred_seed += job_preds['predictions'] / nfolds
+                oof_seed += job_preds['oof']
+        if seeds is None:
+            return oof_seed, pred_seed
+        if oofs is None:
+            oofs = np.zeros(oof_seed.shape)
+            predictions = None if pred_seed is None else np.zeros(pred_seed.shape)
+        oofs += oof_seed / len(seeds)
+        if predictions is not None:
+            predictions += pred_seed / len(seeds)
+    return oofs, predictions
+
+def run_seed_fold_jobs(train_func, nfolds, pred_dir, seeds=None, file_name='model', n_jobs=None,
+                       device='cpu', verbose=True, fold_func=None):
+    """
+    This function runs the (seed, fold) model fits of a training script in a pool of worker processes,
+    instead of the serial "for seed in SEED: for fold in range(NFOLDS)" loops. Every worker uses at most
+    (number of CPUs / n_jobs) torch threads, so that the workers together use all CPUs of the node without
+    oversubscribing them. Each job saves its OOF and test predictions in pred_dir, and the predictions are
+    merged in (seed, fold) order once all jobs are done (see merge_job_preds), so the result does not
+    depend on the order the jobs finish in. The jobs are dispatched fold by fold: if given, fold_func prepares
+    the inputs of a fold (e.g. its preprocessed split) once in the current process, and the seed jobs of the
+    fold are dispatched with them while the next fold is prepared.
+
+    Workers are spawned, not forked: by the time the jobs start, the training script has already used
+    threaded libraries (torch, UMAP/numba, BLAS), whose thread pools do not survive a fork. train_func and
+    the fold_func outputs are pickled to the workers, so train_func must be importable, e.g. a module level
+    function, or a method of the training class bound to its run arguments with functools.partial, and
+    the training script must only start its run under "if __name__ == '__main__'". Worker processes are
+    not daemonic, i.e. train_func can start its own data loader workers (e.g. TabNet). On a GPU, the jobs
+    run one after another in the current process.
+
+    Args:
+            train_func: picklable function called as train_func(fold, seed), or train_func(fold) if seeds is
+            None, that returns the OOF predictions (with zeros outside of the validation fold) and the test
+            predictions of the fold, or None if the test set is scored once after all jobs (e.g. by the
+            stacked models, see model_export.predict_stacked_checkpoints). The output of fold_func(fold) is
+            passed as an extra last argument.
+            nfolds: Number of K-folds.
+            pred_dir: directory where the predictions of every job are saved (e.g. the model directory).
+            seeds: list of seeds, default (None) runs every fold once without a seed.
+            file_name: prefix of the prediction files.
+            n_jobs: number of worker processes, defaults to the number of CPUs (at most one per job);
+            1 runs all jobs in the current process.
+            device: Device used for training - CPU or GPU.
+            verbose: If True, prints the run time of each job.
+            fold_func: optional function called as fold_func(fold) once per fold in the current process, before
+            the jobs of the fold, its output must not be None.
+
+    Returns:
+            oofs: numpy array of the OOF (train) predictions.
+            predictions: numpy array of the test predictions, None if train_func returns no test predictions.
+    """
+    os.makedirs(pred_dir, exist_ok=True)
+    seed_list = [None] if seeds is None else list(seeds)
+    cpu_count = os.cpu_count() or 1
+    n_jobs = min(n_jobs or cpu_count, len(seed_list) * nfolds)
+    if str(device).startswith('cuda'):
+        n_jobs = 1
+    executor = None
+    if n_jobs > 1:
+        executor = ProcessPoolExecutor(n_jobs, mp_context=get_context('spawn'), initializer=init_train_worker,
+                                       initargs=(max(1, cpu_count // n_jobs),))
+    job_results = {}
+    with executor or nullcontext():
+        for fold in range(nfolds):
+            fold_data = None if fold_func is None else fold_func(fold)
+            for seed in seed_list:
+                job = (train_func, seed, fold, get_job_pred_path(pred_dir, file_name, fold, seed), fold_data)
+                job_results[(seed, fold)] = executor.submit(run_train_job, job) if executor else run_train_job(job)
+        ##results are gathered in job order, whatever order the jobs finish in
+        job_paths = {}
+        for seed in seed_list:
+            for fold in range(nfolds):
+                result = job_results[(seed, fold)]
+                _, _, pred_path, elapsed = result.result() if executor else result
+                job_paths[(seed, fold)] = pred_path
+                if verbose:
+                    seed_name = '' if seed is None else f"seed: {seed}, "
+                    print(f"{seed_name}FOLD: {fold}, elapsed time: {elapsed:.1f}s")
+    return merge_job_preds(job_paths, nfolds, seeds)
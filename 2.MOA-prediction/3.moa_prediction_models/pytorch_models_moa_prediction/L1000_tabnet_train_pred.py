@@ -1,6 +1,7 @@
 import os
 import sys
 import argparse
+import functools
 import pandas as pd
 import numpy as np
 from copy import deepcopy as dp
@@ -16,13 +17,21 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 from pytorch_tabnet.metrics import Metric
 from pytorch_tabnet.tab_model import TabNetRegressor
 
-##custom modules required
-sys.path.append('../pytorch_model_helpers')
+##custom modules required, found from the location of this script so that it runs from any directory.
+##level4_cache and result_cache are shared with the exploration helpers, they only need numpy, pandas and pyarrow
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '../../../1.Data-exploration/exploration_helpers'))
+from level4_cache import read_level4_csv
+from result_cache import ResultCache
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+from inference_bundle import save_fold_transforms,save_inference_bundle
+sys.path.append(os.path.join(SCRIPT_DIR, '../pytorch_model_helpers'))
 import pytorch_utils
 import pytorch_helpers
 from pytorch_utils import initialize_weights,SmoothBCEwLogits,LogitsLogLoss
 from pytorch_helpers import drug_stratification,variance_threshold,model_eval_results
-from pytorch_helpers import preprocess,split_data,check_if_shuffle_data,add_stat_feats,save_to_csv
+from pytorch_helpers import preprocess,get_preprocess_version,split_data,check_if_shuffle_data,add_stat_feats,save_to_csv
+from train_scheduler import run_seed_fold_jobs
 
 class L1000_tabnet_moa_train_prediction:
     
@@ -52,13 +61,16 @@ class L1000_tabnet_moa_train_prediction:
             learning_rate: A number that controls how much we are adjusting the weights of our TabNet network
             with respect the loss gradient after every pass/iteration. 
             
+            n_jobs: Number of worker processes that train the models of the folds in parallel, defaults 
+            to the number of CPUs.
+            
     Output:
             dataframes: train and hold-out test predictions are read in as csv files to the model_pred_dir
             saved model: the TabNet model for every train fold is saved in a model folder in the data_dir
 
     """
     
-    def __init__(self, data_dir=None, model_pred_dir=None, shuffle=None, Epochs=None, Batch_size=None, learning_rate=None):
+    def __init__(self, data_dir=None, model_pred_dir=None, shuffle=None, Epochs=None, Batch_size=None, learning_rate=None, n_jobs=None):
 
         self.data_dir = data_dir
         self.model_pred_dir = model_pred_dir
@@ -66,6 +78,38 @@ class L1000_tabnet_moa_train_prediction:
         self.EPOCHS = Epochs
         self.BATCH_SIZE = Batch_size
         self.LEARNING_RATE = learning_rate
+        self.n_jobs = n_jobs
+    
+    def model_train_pred(self, fold, fold_data, model_dir, model_file_name, df_train_y, pos_weight):
+        """Trains the model of a fold, in a worker process of run_seed_fold_jobs"""
+        
+        model_path = os.path.join(model_dir, model_file_name + f"_FOLD{fold}.pth")
+        tabnet_params = dict(n_d = 64, n_a = 128, n_steps = 1,
+                             gamma = 1.3,lambda_sparse = 0,
+                             n_independent = 2,n_shared = 1,optimizer_fn = optim.Adam,
+                             optimizer_params = dict(lr = self.LEARNING_RATE, weight_decay = 1e-5),
+                             mask_type = "entmax",
+                             scheduler_params = dict(mode = "min", patience = 10, min_lr = 1e-5, factor = 0.9),
+                             scheduler_fn = ReduceLROnPlateau,verbose = 10)
+        
+        x_fold_train, y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx = fold_data
+        
+        ### Fit ###
+        model = TabNetRegressor(**tabnet_params)
+        model.fit(X_train = x_fold_train.values, y_train = y_fold_train.values,
+                  eval_set = [(x_fold_val.values, y_fold_val.values)], eval_name = ["val"],
+                  eval_metric = ["logits_ll"],max_epochs = self.EPOCHS,
+                  patience = 40,batch_size = self.BATCH_SIZE,
+                  virtual_batch_size = 32,num_workers = 1,drop_last = False,
+                  loss_fn = SmoothBCEwLogits(smoothing = 0.001, pos_weight=pos_weight))
+        
+        ###---- Prediction ---
+        oof = np.zeros(df_train_y.shape)
+        valid_preds = 1 / (1 + np.exp(-model.predict(x_fold_val.values)))
+        oof[val_idx] = valid_preds
+        predictions = 1 / (1 + np.exp(-model.predict(df_test_x_copy.values)))
+        model_path = model.save_model(model_path)
+        return oof, predictions
     
     def L1000_tabnet_moa_train_pred(self):
         
@@ -87,15 +131,18 @@ class L1000_tabnet_moa_train_prediction:
         check_if_shuffle_data(self.shuffle, model_file_name, model_dir_name, trn_pred_name, tst_pred_name)
         model_dir = os.path.join(self.data_dir, model_dir_name)
         os.makedirs(model_dir, exist_ok=True)
+        ##the preprocessed folds are cached in the data directory, and reused by all models trained on the data
+        preprocess_cache = ResultCache(os.path.join(self.data_dir, 'preprocess_cache'), version=get_preprocess_version())
+        cached_preprocess = preprocess_cache(preprocess)
         
         if self.shuffle:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
         else:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
-        df_test = pd.read_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
-                              compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
+        df_test = read_level4_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
+                                  compression='gzip',low_memory = False)
         df_targets = pd.read_csv(os.path.join(self.data_dir, 'target_labels.csv'))
         
         metadata_cols = ['Metadata_broad_sample', 'pert_id', 'pert_idose', 'replicate_id', 
@@ -103,56 +150,33 @@ class L1000_tabnet_moa_train_prediction:
         
         target_cols = df_targets.columns[1:]
         df_train_x, df_train_y, df_test_x, df_test_y = split_data(df_train, df_test, metadata_cols, target_cols)
+        input_features = df_train_x.columns.tolist()
         df_train_x = add_stat_feats(df_train_x)
         df_test_x = add_stat_feats(df_test_x)
         
-        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_id',cpd_freq_num=36)
+        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_id',cpd_freq_num=36,
+                                       fold_dir=os.path.join(self.data_dir, 'fold_assignments'))
         pos_weight = initialize_weights(df_train, target_cols, DEVICE)
         wgt_bce = dp(F.binary_cross_entropy_with_logits)
         wgt_bce.__defaults__ = (None, None, None, 'mean', pos_weight)
         
-        def model_train_pred(fold):
-            
-            model_path = os.path.join(model_dir, model_file_name + f"_FOLD{fold}.pth")
-            tabnet_params = dict(n_d = 64, n_a = 128, n_steps = 1,
-                                 gamma = 1.3,lambda_sparse = 0,
-                                 n_independent = 2,n_shared = 1,optimizer_fn = optim.Adam,
-                                 optimizer_params = dict(lr = self.LEARNING_RATE, weight_decay = 1e-5),
-                                 mask_type = "entmax",
-                                 scheduler_params = dict(mode = "min", patience = 10, min_lr = 1e-5, factor = 0.9),
-                                 scheduler_fn = ReduceLROnPlateau,verbose = 10)
-            
-            x_fold_train, y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx = \
-            preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_components)
-            x_fold_train, x_fold_val, df_test_x_copy = variance_threshold(x_fold_train, x_fold_val, df_test_x_copy)
-            
-            ### Fit ###
-            model = TabNetRegressor(**tabnet_params)
-            model.fit(X_train = x_fold_train.values, y_train = y_fold_train.values,
-                      eval_set = [(x_fold_val.values, y_fold_val.values)], eval_name = ["val"],
-                      eval_metric = ["logits_ll"],max_epochs = self.EPOCHS,
-                      patience = 40,batch_size = self.BATCH_SIZE,
-                      virtual_batch_size = 32,num_workers = 1,drop_last = False,
-                      loss_fn = SmoothBCEwLogits(smoothing = 0.001, pos_weight=pos_weight))
-            
-            ###---- Prediction ---
-            oof = np.zeros(df_train_y.shape)
-            valid_preds = 1 / (1 + np.exp(-model.predict(x_fold_val.values)))
-            oof[val_idx] = valid_preds
-            predictions = 1 / (1 + np.exp(-model.predict(df_test_x_copy.values)))
-            model_path = model.save_model(model_path)
-            return oof, predictions
-        
-        def run_k_fold(NFOLDS, df_train_y = df_train_y, df_test_y = df_test_y):
-            oof = np.zeros(df_train_y.shape)
-            predictions = np.zeros(df_test_y.shape)
-            for fold in range(NFOLDS):
-                oof_, pred_ = model_train_pred(fold)
-                predictions += pred_ / NFOLDS
-                oof += oof_
-            return oof, predictions
+        def prepare_fold(fold):
+            x_fold_train, y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx, fold_transforms = \
+            cached_preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_components, return_transforms=True)
+            x_fold_train, x_fold_val, df_test_x_copy, fold_transforms['feature_mask'] = \
+            variance_threshold(x_fold_train, x_fold_val, df_test_x_copy, return_mask=True)
+            save_fold_transforms(model_dir, model_file_name, fold, fold_transforms)
+            return x_fold_train, y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx
         
-        oofs_, predictions_ = run_k_fold(NFOLDS)
+        train_func = functools.partial(self.model_train_pred, model_dir=model_dir, model_file_name=model_file_name,
+                                       df_train_y=df_train_y, pos_weight=pos_weight)
+        oofs_, predictions_ = run_seed_fold_jobs(train_func, NFOLDS, model_dir, file_name=model_file_name,
+                                                 n_jobs=self.n_jobs, device=DEVICE, fold_func=prepare_fold)
+        ##TabNet adds the ".zip" extension to the saved models
+        checkpoint_paths = {(None, fold): os.path.join(model_dir, model_file_name + f"_FOLD{fold}.pth.zip")
+                            for fold in range(NFOLDS)}
+        save_inference_bundle(model_dir, model_file_name, 'L1000', 'tabnet', input_features, target_cols, checkpoint_paths,
+                              add_stat_feats=True, shuffle=self.shuffle)
         df_oofs = pd.DataFrame(oofs_, columns=df_train_y.columns)
         df_preds = pd.DataFrame(predictions_, columns=df_test_y.columns)
         
@@ -174,10 +198,12 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, default = 1024, nargs='?', help='Batch size for the model inputs')
     parser.add_argument('--learning_rate', type=float, default = 2e-3, nargs='?', help='learning rate')
     parser.add_argument('--epochs', type=int, default = 200, nargs='?', help='Number of epochs')
+    parser.add_argument('--n_jobs', type=int, default = None, nargs='?', help='Number of worker processes, \
+    defaults to the number of CPUs')
     return parser.parse_args()
     
 if __name__ == '__main__':
     args = parse_args()
     L1000_tabnet = L1000_tabnet_moa_train_prediction(args.data_dir, args.model_pred_dir, args.shuffle, args.epochs,
-                                                     args.batch_size, args.learning_rate)
+                                                     args.batch_size, args.learning_rate, args.n_jobs)
     L1000_tabnet.L1000_tabnet_moa_train_pred()
\ No newline at end of file
@@ -3,6 +3,7 @@ import sys
 import time
 import datetime
 import argparse
+import functools
 import pandas as pd
 import numpy as np
 import torch
@@ -10,14 +11,23 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
-##custom modules required
-sys.path.append('../pytorch_model_helpers')
+##custom modules required, found from the location of this script so that it runs from any directory.
+##level4_cache and result_cache are shared with the exploration helpers, they only need numpy, pandas and pyarrow
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '../../../1.Data-exploration/exploration_helpers'))
+from level4_cache import read_level4_csv
+from result_cache import ResultCache
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+from inference_bundle import save_fold_transforms,save_inference_bundle
+sys.path.append(os.path.join(SCRIPT_DIR, '../pytorch_model_helpers'))
 import pytorch_utils
 import pytorch_helpers
-from pytorch_utils import initialize_weights,SmoothBCEwLogits,TrainDataset,TestDataset
-from pytorch_utils import train_fn,valid_fn,inference_fn,SimpleNN_Model,seed_everything
-from pytorch_helpers import drug_stratification,normalize,umap_factor_features,model_eval_results
-from pytorch_helpers import preprocess,split_data,check_if_shuffle_data,save_to_csv
+from pytorch_utils import initialize_weights,SmoothBCEwLogits,TrainDataset,get_dataloader
+from pytorch_utils import train_fn,valid_fn,SimpleNN_Model,seed_everything
+from pytorch_helpers import drug_stratification,umap_factor_features,model_eval_results
+from pytorch_helpers import preprocess,get_preprocess_version,split_data,check_if_shuffle_data,save_to_csv
+from train_scheduler import run_seed_fold_jobs
+from model_export import predict_stacked_checkpoints
 
 class cp_simplenn_moa_train_prediction:
     
@@ -48,13 +58,16 @@ class cp_simplenn_moa_train_prediction:
             learning_rate: A number that controls how much we are adjusting the weights of our Simple-NN network
             with respect the loss gradient after every pass/iteration. 
             
+            n_jobs: Number of worker processes that train the models of the folds in parallel, defaults 
+            to the number of CPUs.
+            
     Output:
             dataframes: train and hold-out test predictions are read in as csv files to the model_pred_dir
             saved model: the Simple-NN model for every train fold is saved in a model folder in the data_dir
 
     """
     
-    def __init__(self, data_dir=None, model_pred_dir=None, shuffle=None, Epochs=None, Batch_size=None, learning_rate=None):
+    def __init__(self, data_dir=None, model_pred_dir=None, shuffle=None, Epochs=None, Batch_size=None, learning_rate=None, n_jobs=None):
 
         self.data_dir = data_dir
         self.model_pred_dir = model_pred_dir
@@ -62,6 +75,64 @@ class cp_simplenn_moa_train_prediction:
         self.EPOCHS = Epochs
         self.BATCH_SIZE = Batch_size
         self.LEARNING_RATE = learning_rate
+        self.n_jobs = n_jobs
+    
+    def model_train_pred(self, fold, seed, fold_data, model_dir, model_file_name, df_train_y,
+                         num_features, num_targets, hidden_size, pos_weight, DEVICE, WEIGHT_DECAY,
+                         EARLY_STOPPING_STEPS, EARLY_STOP, IS_TRAIN):
+        """Trains the model of a fold and seed, in a worker process of run_seed_fold_jobs"""
+        
+        seed_everything(seed)
+        model_path = os.path.join(model_dir, model_file_name + f"_SEED{seed}_FOLD{fold}.pth")
+        x_fold_train, y_fold_train, x_fold_val, y_fold_val, df_test_x_copy, val_idx = fold_data
+        
+        train_dataset = TrainDataset(x_fold_train.values, y_fold_train.values)
+        valid_dataset = TrainDataset(x_fold_val.values, y_fold_val.values)
+        trainloader = get_dataloader(train_dataset, batch_size=self.BATCH_SIZE, shuffle=True)
+        validloader = get_dataloader(valid_dataset, batch_size=self.BATCH_SIZE, shuffle=False)
+        
+        model = SimpleNN_Model(num_features=num_features, num_targets=num_targets, hidden_size=hidden_size)
+        model.to(DEVICE)
+        
+        optimizer = torch.optim.Adam(model.parameters(), weight_decay=WEIGHT_DECAY, lr=self.LEARNING_RATE,
+                                     eps=1e-10)
+        scheduler = optim.lr_scheduler.OneCycleLR(optimizer=optimizer, pct_start=0.2, div_factor=1e3, 
+                                                  max_lr=1e-3, epochs=self.EPOCHS, steps_per_epoch=len(trainloader))
+        loss_train = SmoothBCEwLogits(smoothing = 0.001, pos_weight=pos_weight)
+        loss_val = nn.BCEWithLogitsLoss()
+        early_stopping_steps = EARLY_STOPPING_STEPS
+        early_step = 0
+        
+        oof = np.zeros(df_train_y.shape)
+        best_loss = np.inf
+        best_loss_epoch = -1
+        
+        if IS_TRAIN:
+            for epoch in range(self.EPOCHS):
+                train_loss = train_fn(model, optimizer, scheduler, loss_train, trainloader, DEVICE)
+                valid_loss, valid_preds = valid_fn(model, loss_val, validloader, DEVICE)
+                if valid_loss < best_loss:
+                    best_loss = valid_loss
+                    best_loss_epoch = epoch
+                    oof[val_idx] = valid_preds
+                    torch.save(model.state_dict(), model_path)
+                elif (EARLY_STOP == True):
+                    early_step += 1
+                    if (early_step >= early_stopping_steps):
+                        break
+                if epoch % 10 == 0 or epoch == self.EPOCHS-1:
+                    print(f"seed: {seed}, FOLD: {fold}, EPOCH: {epoch},\
+                    train_loss: {train_loss:.6f}, valid_loss: {valid_loss:.6f}, best_loss: {best_loss:.6f},\
+                    best_loss_epoch: {best_loss_epoch}")
+        
+        ##the test set is scored once by the stacked models of all jobs, see predict_stacked_checkpoints
+        if not IS_TRAIN:
+            model = SimpleNN_Model(num_features=num_features, num_targets=num_targets, hidden_size=hidden_size)
+            model.load_state_dict(torch.load(model_path))
+            model.to(DEVICE)
+            valid_loss, valid_preds = valid_fn(model, loss_fn, validloader, DEVICE)
+            oof[val_idx] = valid_preds
+        return oof, None
     
     def cp_nn_moa_train_prediction(self):
         
@@ -91,15 +162,18 @@ class cp_simplenn_moa_train_prediction:
         check_if_shuffle_data(self.shuffle, model_file_name, model_dir_name, trn_pred_name, tst_pred_name)
         model_dir = os.path.join(self.data_dir, model_dir_name)
         os.makedirs(model_dir, exist_ok=True)
+        ##the preprocessed folds are cached in the data directory, and reused by all models trained on the data
+        preprocess_cache = ResultCache(os.path.join(self.data_dir, 'preprocess_cache'), version=get_preprocess_version())
+        cached_preprocess = preprocess_cache(preprocess)
         
         if self.shuffle:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
         else:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
-        df_test = pd.read_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
-                              compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
+        df_test = read_level4_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
+                                  compression='gzip',low_memory = False)
         df_targets = pd.read_csv(os.path.join(self.data_dir, 'target_labels.csv'))
         
         metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_Plate', 'Metadata_Well', 
@@ -108,98 +182,43 @@ class cp_simplenn_moa_train_prediction:
         
         target_cols = df_targets.columns[1:]
         df_train_x, df_train_y, df_test_x, df_test_y = split_data(df_train, df_test, metadata_cols, target_cols)
-        df_train_x, df_test_x = umap_factor_features(df_train_x, df_test_x, no_of_compts, no_of_dims)
+        input_features = df_train_x.columns.tolist()
+        df_train_x, df_test_x, umap_factor_models = \
+        preprocess_cache(umap_factor_features)(df_train_x, df_test_x, no_of_compts, no_of_dims, return_models=True)
         features = df_train_x.columns.tolist()
         num_features=len(features)
         num_targets=len(target_cols)
-        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_name',cpd_freq_num=50)
+        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_name',cpd_freq_num=50,
+                                       fold_dir=os.path.join(self.data_dir, 'fold_assignments'))
         pos_weight = initialize_weights(df_train, target_cols, DEVICE)
         
-        def model_train_pred(fold, seed):
-            
-            seed_everything(seed)
-            model_path = os.path.join(model_dir, model_file_name + f"_SEED{seed}_FOLD{fold}.pth")
-            trn_idx = df_train[df_train['fold'] != fold].index
-            val_idx = df_train[df_train['fold'] == fold].index
-            
-            x_fold_train = df_train_x.loc[trn_idx].reset_index(drop=True).copy()
-            y_fold_train = df_train_y.loc[trn_idx].reset_index(drop=True).copy()
-            
-            x_fold_val = df_train_x.loc[val_idx].reset_index(drop=True).copy()
-            y_fold_val = df_train_y.loc[val_idx].reset_index(drop=True).copy()
-            df_test_x_copy = df_test_x.copy()
-            x_fold_train, x_fold_val, df_test_x_copy = normalize(x_fold_train, x_fold_val, df_test_x_copy)
-            
-            train_dataset = TrainDataset(x_fold_train.values, y_fold_train.values)
-            valid_dataset = TrainDataset(x_fold_val.values, y_fold_val.values)
-            trainloader = torch.utils.data.DataLoader(train_dataset, batch_size=self.BATCH_SIZE, shuffle=True)
-            validloader = torch.utils.data.DataLoader(valid_dataset, batch_size=self.BATCH_SIZE, shuffle=False)
-            
-            model = SimpleNN_Model(num_features=num_features, num_targets=num_targets, hidden_size=hidden_size)
-            model.to(DEVICE)
-            
-            optimizer = torch.optim.Adam(model.parameters(), weight_decay=WEIGHT_DECAY, lr=self.LEARNING_RATE,
-                                         eps=1e-10)
-            scheduler = optim.lr_scheduler.OneCycleLR(optimizer=optimizer, pct_start=0.2, div_factor=1e3, 
-                                                      max_lr=1e-3, epochs=self.EPOCHS, steps_per_epoch=len(trainloader))
-            loss_train = SmoothBCEwLogits(smoothing = 0.001, pos_weight=pos_weight)
-            loss_val = nn.BCEWithLogitsLoss()
-            early_stopping_steps = EARLY_STOPPING_STEPS
-            early_step = 0
-            
-            oof = np.zeros(df_train_y.shape)
-            best_loss = np.inf
-            best_loss_epoch = -1
-            
-            if IS_TRAIN:
-                for epoch in range(self.EPOCHS):
-                    train_loss = train_fn(model, optimizer, scheduler, loss_train, trainloader, DEVICE)
-                    valid_loss, valid_preds = valid_fn(model, loss_val, validloader, DEVICE)
-                    if valid_loss < best_loss:
-                        best_loss = valid_loss
-                        best_loss_epoch = epoch
-                        oof[val_idx] = valid_preds
-                        torch.save(model.state_dict(), model_path)
-                    elif (EARLY_STOP == True):
-                        early_step += 1
-                        if (early_step >= early_stopping_steps):
-                            break
-                    if epoch % 10 == 0 or epoch == self.EPOCHS-1:
-                        print(f"seed: {seed}, FOLD: {fold}, EPOCH: {epoch},\
-                        train_loss: {train_loss:.6f}, valid_loss: {valid_loss:.6f}, best_loss: {best_loss:.6f},\
-                        best_loss_epoch: {best_loss_epoch}")
-                        
-            #--------------------- PREDICTION---------------------
-            testdataset = TestDataset(df_test_x_copy.values)
-            testloader = torch.utils.data.DataLoader(testdataset, batch_size=self.BATCH_SIZE, shuffle=False)
-            model = SimpleNN_Model(num_features=num_features, num_targets=num_targets, hidden_size=hidden_size)
-            model.load_state_dict(torch.load(model_path))
-            model.to(DEVICE)
-            
-            if not IS_TRAIN:
-                valid_loss, valid_preds = valid_fn(model, loss_fn, validloader, DEVICE)
-                oof[val_idx] = valid_preds
-            predictions = np.zeros(df_test_y.shape)
-            predictions = inference_fn(model, testloader, DEVICE)
-            return oof, predictions
+        test_folds = {}
+        def prepare_fold(fold):
+            ##the normalized fold split does not depend on the seed, it is fitted and saved once per fold
+            *fold_data, fold_transforms = \
+            cached_preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, None, return_transforms=True)
+            save_fold_transforms(model_dir, model_file_name, fold, fold_transforms)
+            test_folds[fold] = fold_data[4].values
+            return fold_data
+        
+        train_func = functools.partial(self.model_train_pred, model_dir=model_dir, model_file_name=model_file_name,
+                                       df_train_y=df_train_y, num_features=num_features,
+                                       num_targets=num_targets, hidden_size=hidden_size, pos_weight=pos_weight,
+                                       DEVICE=DEVICE, WEIGHT_DECAY=WEIGHT_DECAY,
+                                       EARLY_STOPPING_STEPS=EARLY_STOPPING_STEPS, EARLY_STOP=EARLY_STOP,
+                                       IS_TRAIN=IS_TRAIN)
         
-        def run_k_fold(folds, seed):
-            oof = np.zeros(df_train_y.shape)
-            predictions = np.zeros(df_test_y.shape)
-            for fold in range(folds):
-                oof_, pred_ = model_train_pred(fold, seed)
-                predictions += pred_ / folds
-                oof += oof_
-            return oof, predictions
-    
-        oofs = np.zeros(df_train_y.shape)
-        predictions = np.zeros(df_test_y.shape)
         time_start = time.time()
-        for seed in SEED:
-            oofs_, predictions_ = run_k_fold(NFOLDS, seed)
-            oofs += oofs_ / len(SEED)
-            predictions += predictions_ / len(SEED)
-            print(f"elapsed time: {time.time() - time_start}")
+        oofs, predictions = run_seed_fold_jobs(train_func, NFOLDS, model_dir, SEED, model_file_name,
+                                               self.n_jobs, DEVICE, fold_func=prepare_fold)
+        print(f"elapsed time: {time.time() - time_start}")
+        checkpoint_paths = {(seed, fold): os.path.join(model_dir, model_file_name + f"_SEED{seed}_FOLD{fold}.pth")
+                            for seed in SEED for fold in range(NFOLDS)}
+        model_params = dict(num_features=num_features, num_targets=num_targets, hidden_size=hidden_size)
+        predictions = predict_stacked_checkpoints(SimpleNN_Model, model_params, checkpoint_paths, test_folds, DEVICE)
+        save_inference_bundle(model_dir, model_file_name, 'cp', 'simplenn', input_features, target_cols, checkpoint_paths,
+                              model_params=model_params,
+                              feature_models=umap_factor_models, shuffle=self.shuffle)
         df_oofs = pd.DataFrame(oofs, columns=df_train_y.columns)
         df_preds = pd.DataFrame(predictions, columns=df_test_y.columns)
         
@@ -221,10 +240,12 @@ def parse_args():
     parser.add_argument('--batch_size', type=int, default = 128, nargs='?', help='Batch size for the model inputs')
     parser.add_argument('--learning_rate', type=float, default = 1e-4, nargs='?', help='learning rate')
     parser.add_argument('--epochs', type=int, default = 50, nargs='?', help='Number of epochs')
+    parser.add_argument('--n_jobs', type=int, default = None, nargs='?', help='Number of worker processes, \
+    defaults to the number of CPUs')
     return parser.parse_args()
     
 if __name__ == '__main__':
     args = parse_args()
     cp_simplenn = cp_simplenn_moa_train_prediction(args.data_dir, args.model_pred_dir, args.shuffle, args.epochs,
-                                                    args.batch_size, args.learning_rate)
+                                                    args.batch_size, args.learning_rate, args.n_jobs)
     cp_simplenn.cp_nn_moa_train_prediction()
\ No newline at end of file
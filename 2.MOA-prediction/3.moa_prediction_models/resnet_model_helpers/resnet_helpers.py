@@ -3,12 +3,13 @@ import pandas as pd
 import sys
 import os
 import random
+import sklearn
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from tensorflow.keras import layers, regularizers, Sequential, Model, backend, optimizers, metrics, losses
 from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
 import tensorflow as tf
-from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+from fold_assignment import get_drug_folds
 from sklearn.metrics import precision_recall_curve,log_loss
 from sklearn.metrics import average_precision_score,roc_auc_score
 
@@ -38,7 +39,7 @@ def check_if_shuffle_data(shuffle, model_file_name=None, model_dir_name=None, tr
             dir_name_list[idx] = f"{x}_shuffle"
     return dir_name_list
 
-def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=40):
+def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=40,seed=33,fold_dir=None):
     """
     This function performs multi-label stratification on the compounds/drugs found
     in the train dataset. Here, because the distribution of drugs is highly imbalanced
@@ -55,6 +56,9 @@ def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=40):
     are rare belong to the same fold. 
     For more info: https://www.kaggle.com/c/lish-moa/discussion/195195
     
+    The folds are assigned on integer-coded drugs and replicates (see fold_assignment.assign_folds), and
+    saved in fold_dir so that all models trained on the same data reuse the same folds.
+    
     Args:
             df: train data - pandas dataframe containing all drugs and features.
             
@@ -67,38 +71,20 @@ def drug_stratification(df, nfold, target_cols,col_name,cpd_freq_num=40):
             cpd_freq_num: A number that is used to divide drugs/compounds into two categories i.e.
             first category consist of highly frequent drugs in the train data and the second one
             consist of rarely seen/less frequent drugs in the train data
+            
+            seed: random state of the multi-label stratified K-fold splits.
+            
+            fold_dir: directory where the folds are saved, default (None) does not save the folds.
     
     Returns:
             df: train data - pandas dataframe with a new column called 'fold', which wil be used for cross-validation
             during model training
     """
-    drug_value_ct = df['pert_iname'].value_counts()
-    drug_vc1 = drug_value_ct.loc[drug_value_ct <= cpd_freq_num].index.sort_values()
-    drug_vc2 = drug_value_ct.loc[drug_value_ct > cpd_freq_num].index.sort_values()
-    dct1 = {}; dct2 = {}
-    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=33)
-    df_drug_vc1 = df.groupby('pert_iname')[target_cols].mean().loc[drug_vc1]
-    
-    # STRATIFY DRUGS X OR LESS based on each specific drug/compound
-    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc1,df_drug_vc1[target_cols])):
-        drugs_fold = {drugs:fold for drugs in df_drug_vc1.index[idxV].values}
-        dct1.update(drugs_fold)
-        
-    # STRATIFY DRUGS X OR MORE based on the drug's replicates
-    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True)
-    df_drug_vc2 = df.loc[df.pert_iname.isin(drug_vc2)].reset_index(drop=True)
-    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc2,df_drug_vc2[target_cols])):
-        drugs_fold = {drugs:fold for drugs in df_drug_vc2[col_name][idxV].values}
-        dct2.update(drugs_fold)
-        
-    ##fold column
-    df['fold'] = df.pert_iname.map(dct1)
-    df.loc[df.fold.isna(),'fold'] = df.loc[df.fold.isna(),col_name].map(dct2)
-    df['fold'] = df['fold'].astype(int)
+    df['fold'] = get_drug_folds(df, nfold, target_cols, col_name, cpd_freq_num, seed, fold_dir)
     
     return df
     
-def normalize(trn, val, test):
+def normalize(trn, val, test, return_model=False):
     """
     Performs z-score/standard normalization on the train, test and validation data. The StandardScaler
     is fitted on the train data, and transformed on test and validation data.
@@ -107,19 +93,23 @@ def normalize(trn, val, test):
             trn: train data - pandas dataframe.
             val: validation data - pandas dataframe.
             test: test data - pandas dataframe.
+            return_model: If True, the fitted StandardScaler is also returned.
     
     Returns:
             trn_norm: normalized train data - pandas dataframe.
             val_norm: normalized validation - pandas dataframe.
             test_norm: normalized test data - pandas dataframe.
+            norm_model: the fitted StandardScaler, only if return_model is True.
     """
     norm_model = StandardScaler()
     trn_norm = pd.DataFrame(norm_model.fit_transform(trn),index = trn.index,columns = trn.columns)
     val_norm = pd.DataFrame(norm_model.transform(val),index = val.index,columns = val.columns)
     tst_norm = pd.DataFrame(norm_model.transform(test),index = test.index,columns = test.columns)
+    if return_model:
+        return trn_norm, val_norm, tst_norm, norm_model
     return trn_norm, val_norm, tst_norm
     
-def pca_features(train,validation,test,no_of_comp):
+def pca_features(train,validation,test,no_of_comp,return_model=False):
     """
     This function performs PCA (Principal Component Analysis) transformation on the train, 
     test and validation data. The PCA is fitted on the train data, and transformed on test 
@@ -130,24 +120,36 @@ def pca_features(train,validation,test,no_of_comp):
             validation: validation data - pandas dataframe.
             test: test data - pandas dataframe.
             no_of_components: Number of principal components (PCs) to extract from PCA.
+            return_model: If True, the fitted PCA is also returned.
     
     Returns:
             train_pca: train data - pandas dataframe with only PCs.
             validation_pca: validation data - pandas dataframe with only PCs.
             test_pca: test data - pandas dataframe with only PCs.
+            pca: the fitted PCA, only if return_model is True.
     """
     pca = PCA(n_components=no_of_comp, random_state=42)
     feat_new = ['pca'+ str(i) for i in range(no_of_comp)]
     train_pca = pd.DataFrame(pca.fit_transform(train),columns=feat_new)
     validation_pca = pd.DataFrame(pca.transform(validation),columns=feat_new)
     test_pca = pd.DataFrame(pca.transform(test),columns=feat_new)
+    if return_model:
+        return train_pca, validation_pca, test_pca, pca
     return(train_pca, validation_pca, test_pca)
     
-def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_comp):
+def get_preprocess_version():
+    """
+    Version of scikit-learn, the library the preprocessing transforms are fitted with, used as the version of
+    the preprocessing cache, so that the cached folds are refitted after an upgrade
+    """
+    return f"sklearn-{sklearn.__version__}"
+
+def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_comp, return_transforms=False):
     """
     This function split the train data into a K-fold subset, performs normalization on
     them and engineer new features including PCA on the train, test and validation data and 
-    finally concatenate new PCs with the existing dataframes.
+    finally concatenate new PCs with the existing dataframes. The fitted transforms of the fold
+    can be returned, to be saved with the model (see inference_bundle).
     
     Args:
             fold: fold value.
@@ -156,6 +158,7 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_comp):
             df_train_y: train data - pandas dataframe with only the Mechanism of actions (MOAs) target labels.
             df_test_x: test data - pandas dataframe with only phenotypic/morphological features.
             no_of_comp: Number of principal components (PCs) to extract from PCA.
+            return_transforms: If True, the fitted transforms of the fold are also returned.
     
     Returns:
             x_fold_train: K-fold train data with only phenotypic/morphological features and PCs - numpy array.
@@ -165,6 +168,8 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_comp):
             df_test_x: test data - pandas dataframe with only phenotypic/morphological features and PCs.
             val_idx: A list of the K-fold validation indices from the train data
             x_fold_train.shape[1]: Number of phenotypic/morphological features and PCs 
+            fold_transforms: dictionary of the fitted 'norm_model' and 'pca_model', only if return_transforms
+            is True.
     """
     trn_idx = df_train[df_train['fold'] != fold].index
     val_idx = df_train[df_train['fold'] == fold].index
@@ -184,14 +189,20 @@ def preprocess(fold, df_train, df_train_x, df_train_y, df_test_x, no_of_comp):
     df_test_x_copy = pd.concat([df_test_x_copy, x_tst_mean], axis = 1)
     
     ### -- normalize using standardization ----
-    x_fold_train, x_fold_val, df_test_x_copy = normalize(x_fold_train, x_fold_val, df_test_x_copy)
+    x_fold_train, x_fold_val, df_test_x_copy, norm_model = \
+    normalize(x_fold_train, x_fold_val, df_test_x_copy, return_model=True)
     
     ### --- add pca components to the original features ----
-    trn_fold_pca,val_fold_pca,test_pca = pca_features(x_fold_train,x_fold_val,df_test_x_copy,no_of_comp)
+    trn_fold_pca,val_fold_pca,test_pca,pca_model = \
+    pca_features(x_fold_train,x_fold_val,df_test_x_copy,no_of_comp,return_model=True)
     x_fold_train = pd.concat([x_fold_train,trn_fold_pca],axis = 1)
     x_fold_val = pd.concat([x_fold_val,val_fold_pca],axis = 1)
     df_test_x_copy  = pd.concat([df_test_x_copy,test_pca],axis = 1)
     
+    if return_transforms:
+        fold_transforms = {'add_mean': True, 'norm_model': norm_model, 'pca_model': pca_model}
+        return x_fold_train.values,y_fold_train.values, x_fold_val.values, y_fold_val.values, \
+    df_test_x_copy.values, val_idx, x_fold_train.shape[1], fold_transforms
     return x_fold_train.values,y_fold_train.values, x_fold_val.values, y_fold_val.values, df_test_x_copy.values, \
 val_idx, x_fold_train.shape[1]
 
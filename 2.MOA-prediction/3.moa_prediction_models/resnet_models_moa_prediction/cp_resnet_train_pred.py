@@ -5,12 +5,19 @@ import os
 import random
 import argparse
 
-##custom modules required
-sys.path.append('../resnet_model_helpers')
+##custom modules required, found from the location of this script so that it runs from any directory.
+##level4_cache and result_cache are shared with the exploration helpers, they only need numpy, pandas and pyarrow
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '../../../1.Data-exploration/exploration_helpers'))
+from level4_cache import read_level4_csv
+from result_cache import ResultCache
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+from inference_bundle import save_fold_transforms,save_inference_bundle
+sys.path.append(os.path.join(SCRIPT_DIR, '../resnet_model_helpers'))
 import resnet_helpers
 import resnet_utils
 from resnet_utils import resnet_model,freeze_unfreeze_model_weights
-from resnet_helpers import drug_stratification, preprocess, split_data, save_to_csv
+from resnet_helpers import drug_stratification, preprocess, get_preprocess_version, split_data, save_to_csv
 from resnet_helpers import logloss, mean_logloss, check_if_shuffle_data, model_eval_results
 
 from tensorflow.keras import layers, regularizers, Sequential, Model, backend, optimizers, metrics, losses
@@ -84,15 +91,18 @@ class cp_resnet_moa_train_prediction:
         check_if_shuffle_data(self.shuffle, model_file_name, model_dir_name, trn_pred_name, tst_pred_name)
         model_dir = os.path.join(self.data_dir, model_dir_name)
         os.makedirs(model_dir, exist_ok=True)
+        ##the preprocessed folds are cached in the data directory, and reused by all models trained on the data
+        preprocess_cache = ResultCache(os.path.join(self.data_dir, 'preprocess_cache'), version=get_preprocess_version())
+        cached_preprocess = preprocess_cache(preprocess)
         
         if self.shuffle:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_shuffle_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
         else:
-            df_train = pd.read_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
-                                   compression='gzip',low_memory = False)
-        df_test = pd.read_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
-                              compression='gzip',low_memory = False)
+            df_train = read_level4_csv(os.path.join(self.data_dir, 'train_lvl4_data.csv.gz'),
+                                       compression='gzip',low_memory = False)
+        df_test = read_level4_csv(os.path.join(self.data_dir, 'test_lvl4_data.csv.gz'),
+                                  compression='gzip',low_memory = False)
         df_targets = pd.read_csv(os.path.join(self.data_dir, 'target_labels.csv'))
         
         metadata_cols = ['Metadata_broad_sample', 'Metadata_pert_id', 'Metadata_Plate', 'Metadata_Well', 
@@ -101,14 +111,16 @@ class cp_resnet_moa_train_prediction:
         
         target_cols = df_targets.columns[1:]
         df_train_x, df_train_y, df_test_x, df_test_y = split_data(df_train, df_test, metadata_cols, target_cols)
-        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_name',cpd_freq_num=60)
+        df_train = drug_stratification(df_train,NFOLDS,target_cols,col_name='replicate_name',cpd_freq_num=60,
+                                       fold_dir=os.path.join(self.data_dir, 'fold_assignments'))
         
         oof_preds = np.zeros(df_train_y.shape)
         y_pred = np.zeros(df_test_y.shape)
         for fold in range(NFOLDS):
             
-            x_fold_trn, y_fold_trn, x_fold_val, y_fold_val, df_tst_x_copy, val_idx, no_of_feats = \
-            preprocess(fold, df_train, df_train_x, df_train_y, df_test_x,no_of_compts)
+            x_fold_trn, y_fold_trn, x_fold_val, y_fold_val, df_tst_x_copy, val_idx, no_of_feats, fold_transforms = \
+            cached_preprocess(fold, df_train, df_train_x, df_train_y, df_test_x,no_of_compts,return_transforms=True)
+            save_fold_transforms(model_dir, model_file_name, fold, fold_transforms)
             model_path = os.path.join(model_dir, model_file_name + f"_FOLD{fold}_model.h5")
             
             input_, answer5 = resnet_model(df_train_y, no_of_feats)
@@ -144,6 +156,10 @@ class cp_resnet_moa_train_prediction:
             y_pred += test_preds / NFOLDS
             print('\n')
             
+        checkpoint_paths = {(None, fold): os.path.join(model_dir, model_file_name + f"_FOLD{fold}_model.h5")
+                            for fold in range(NFOLDS)}
+        save_inference_bundle(model_dir, model_file_name, 'cp', 'resnet', df_train_x.columns.tolist(), target_cols,
+                              checkpoint_paths, shuffle=self.shuffle)
         df_oofs = pd.DataFrame(oof_preds, columns=df_train_y.columns)
         df_preds = pd.DataFrame(y_pred, columns=df_test_y.columns)
         
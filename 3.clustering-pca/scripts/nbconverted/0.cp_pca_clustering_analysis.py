@@ -23,6 +23,7 @@ from sklearn.metrics import silhouette_score
 from sklearn.metrics import davies_bouldin_score
 from sklearn.mixture import GaussianMixture as GMM
 import os
+import sys
 import pathlib
 import pandas as pd
 import numpy as np
@@ -42,6 +43,10 @@ import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
 
+##custom modules required
+sys.path.append('../1.Data-exploration/exploration_helpers')
+from result_cache import ResultCache
+
 
 # In[2]:
 
@@ -49,6 +54,10 @@ np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning)
 cp_level4_path = '../1.Data-exploration/Profiles_level4/cell_painting/cellpainting_lvl4_cpd_replicate_datasets'
 output_path = "results/cell_painting"
 
+##PCA, BIC and K-means results are cached on disk, keyed by the input data, arguments and
+##function source, so re-running the notebook after a plotting change reuses them
+result_cache = ResultCache('result_cache')
+
 
 # In[3]:
 
@@ -89,8 +98,9 @@ def extract_dose_df(df, dose_num):
 # In[6]:
 
 
-def transform_pca(df, dose_num, no_of_pcs =150):
-    """Perform PCA Analysis"""
+@result_cache
+def fit_pca(df, dose_num, no_of_pcs):
+    """Scale the data and fit the PCA"""
     scaler = StandardScaler()
     scaled_agg = scaler.fit_transform(df)
     df_scaled = pd.DataFrame(data = scaled_agg, columns = ['feat_' + str(x) for x in range(1,df.shape[1]+1)])
@@ -99,6 +109,11 @@ def transform_pca(df, dose_num, no_of_pcs =150):
     pc = pca.fit_transform(scaled_agg)
     df_pc = pd.DataFrame(data = pc, columns = ['PC' + str(x) for x in range(1,no_of_pcs+1)])
     df_pc['dose'] = dose_num
+    return pca, df_pc, df_scaled
+
+def transform_pca(df, dose_num, no_of_pcs =150):
+    """Perform PCA Analysis"""
+    pca, df_pc, df_scaled = fit_pca(df, dose_num, no_of_pcs)
     
     #Plotting the Cumulative Summation of the Explained Variance
     plt.figure(figsize=(16, 8))
@@ -126,6 +141,7 @@ def SelBest(arr:list, X:int)->list:
 # In[8]:
 
 
+@result_cache
 def calc_bic(pc_data, no_of_clusters=40):
     """
     Computes Bayesian Information Criteria scores (BIC) when Gaussian Mixture Models (GMM) is fitted on a data
@@ -164,6 +180,7 @@ def plot_bics(bics):
 # In[10]:
 
 
+@result_cache
 def calculate_score(df, no_of_clusters=40):
     """
     Assess K-means clustering using Silhoutte and Davies bouldin scores
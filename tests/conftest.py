@@ -0,0 +1,11 @@
+import os
+import sys
+
+##the helper modules are imported by their module names, as in the notebooks and scripts
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HELPER_DIRS = ['1.Data-exploration/exploration_helpers',
+               '2.MOA-prediction/1.compound_split_train_test',
+               '2.MOA-prediction/3.moa_prediction_models',
+               '2.MOA-prediction/3.moa_prediction_models/pytorch_model_helpers']
+for helper_dir in HELPER_DIRS:
+    sys.path.append(os.path.join(REPO_DIR, helper_dir))
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from correlation import iter_spearman_blocks, rank_standardize, spearman_corr
+
+def test_spearman_corr_is_the_pandas_spearman_correlation():
+    values = np.random.default_rng(0).normal(size=(30, 50))
+    values[:, 1] = values[:, 0]
+    expected = pd.DataFrame(values.T).corr(method='spearman').values
+    np.testing.assert_allclose(spearman_corr(values), expected, atol=1e-12)
+
+def test_float32_correlations_are_the_float64_ones_within_tolerance():
+    rng = np.random.default_rng(0)
+    values, other = rng.normal(size=(300, 978)), rng.normal(size=(40, 978))
+    expected = spearman_corr(values, other)
+    corr = spearman_corr(values, other, dtype='float32')
+    assert corr.dtype == np.float32
+    np.testing.assert_allclose(corr, expected, atol=1e-6)
+
+    blocks = list(iter_spearman_blocks(values, block_size=128))
+    assert [block.dtype for _, block in blocks] == [np.float32] * 3
+    np.testing.assert_allclose(np.concatenate([block for _, block in blocks]), spearman_corr(values), atol=1e-6)
+    assert rank_standardize(values, dtype='float32').dtype == np.float32
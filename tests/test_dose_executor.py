@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import dose_executor
+from dose_executor import get_dose_context, run_per_dose
+from null_scores import get_dose_null_medians
+
+def get_dose_sum(dose, values):
+    return dose + values.sum()
+
+@pytest.fixture
+def dose_inputs():
+    rng = np.random.default_rng(0)
+    inputs = {}
+    for dose in [1, 2, 3]:
+        features = rng.normal(size=(6, 20))
+        rep_names = np.array([f'rep_{num}' for num in range(6)], dtype=object)
+        inputs[dose] = (features, rep_names, {2: [['rep_0', 'rep_1'], ['rep_2', 'rep_5']]})
+    return inputs
+
+def test_spawned_workers_give_the_serial_results(dose_inputs):
+    assert get_dose_context(get_dose_null_medians).get_start_method() == 'spawn'
+    expected, _ = run_per_dose(get_dose_null_medians, dose_inputs, n_jobs=1)
+    results, timings = run_per_dose(get_dose_null_medians, dose_inputs, n_jobs=2)
+    assert results == expected
+    assert list(timings) == [1, 2, 3]
+
+def test_notebook_functions_run_in_the_current_process_without_linux_fork(monkeypatch):
+    monkeypatch.setattr(get_dose_sum, '__module__', '__main__')
+    monkeypatch.setattr(dose_executor.sys, 'platform', 'darwin')
+    assert get_dose_context(get_dose_sum) is None
+    with pytest.warns(UserWarning):
+        results, _ = run_per_dose(get_dose_sum, {1: (np.ones(3),), 2: (np.ones(3),)}, n_jobs=2)
+    assert results == {1: 4.0, 2: 5.0}
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import open_feature_store
+
+@pytest.fixture
+def level4_csv(tmp_path):
+    """Level-4 csv file of 3 compounds in 2 doses, with features that are only distinct in float64"""
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'replicate_id': [f'rep_{num}' for num in range(12)], 'dose': np.repeat([1, 2], 6),
+                       'pert_iname': np.tile(['cpd_b', 'cpd_a', 'cpd_c'], 4)})
+    features = 1 + rng.integers(0, 4, size=(12, 5)) * 1e-9
+    df = pd.concat([df, pd.DataFrame(features, columns=[f'feat_{num}' for num in range(5)])], axis=1)
+    file_path = str(tmp_path / 'level4.csv')
+    df.to_csv(file_path, index=False)
+    return file_path, df
+
+def open_store(file_path, metadata_cols=('replicate_id', 'dose', 'pert_iname'), **kwargs):
+    return open_feature_store(file_path, 'dose', 'replicate_id', list(metadata_cols), **kwargs)
+
+def test_store_keeps_the_csv_features(level4_csv):
+    file_path, df = level4_csv
+    store = open_store(file_path)
+    assert store.features.dtype == np.float64
+    for dose in [1, 2]:
+        df_dose = store.get_dose_metadata(dose)
+        expected = df.set_index('replicate_id').loc[df_dose['replicate_id'], store.feature_cols].values
+        np.testing.assert_array_equal(store.get_dose_features(dose), expected)
+        assert len(np.unique(store.get_dose_features(dose))) > 1
+    assert store.get_cpd_features(1, 'cpd_a').shape == (2, 5)
+
+def test_store_is_rebuilt_for_another_layout(level4_csv):
+    file_path, _ = level4_csv
+    open_store(file_path)
+    features_path = os.path.join(os.path.dirname(file_path), 'level4_store', 'features.npy')
+    os.utime(features_path, (0, 0))
+    open_store(file_path)
+    assert os.path.getmtime(features_path) == 0
+
+    store = open_store(file_path, metadata_cols=('replicate_id', 'dose', 'pert_iname', 'feat_0'))
+    assert os.path.getmtime(features_path) > 0
+    assert 'feat_0' not in store.feature_cols
+
+def test_store_is_rebuilt_if_its_files_do_not_match_its_index(level4_csv):
+    file_path, _ = level4_csv
+    open_store(file_path)
+    features_path = os.path.join(os.path.dirname(file_path), 'level4_store', 'features.npy')
+    np.save(features_path, np.zeros((3, 5)))
+    store = open_store(file_path)
+    assert store.features.shape == (12, 5)
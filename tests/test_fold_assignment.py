@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+from iterstrat.ml_stratifiers import MultilabelStratifiedKFold
+
+from fold_assignment import get_drug_folds
+
+TARGET_COLS = [f'moa_{num}' for num in range(6)]
+
+def drug_stratification_baseline(df, nfold, target_cols, col_name, cpd_freq_num):
+    """The dictionary-based drug_stratification of pytorch_helpers, with the frequent-drug split seeded too"""
+    drug_value_ct = df['pert_iname'].value_counts()
+    drug_vc1 = drug_value_ct.loc[drug_value_ct <= cpd_freq_num].index.sort_values()
+    drug_vc2 = drug_value_ct.loc[drug_value_ct > cpd_freq_num].index.sort_values()
+    dct1 = {}; dct2 = {}
+    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=33)
+    df_drug_vc1 = df.groupby('pert_iname')[target_cols].mean().loc[drug_vc1]
+    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc1,df_drug_vc1[target_cols])):
+        dct1.update({drugs:fold for drugs in df_drug_vc1.index[idxV].values})
+    skf = MultilabelStratifiedKFold(n_splits=nfold, shuffle=True, random_state=33)
+    df_drug_vc2 = df.loc[df.pert_iname.isin(drug_vc2)].reset_index(drop=True)
+    for fold,(idxT,idxV) in enumerate(skf.split(df_drug_vc2,df_drug_vc2[target_cols])):
+        dct2.update({drugs:fold for drugs in df_drug_vc2[col_name][idxV].values})
+    fold = df.pert_iname.map(dct1)
+    fold[fold.isna()] = df.loc[fold.isna(), col_name].map(dct2)
+    return fold.astype(int).values
+
+def get_train_data():
+    """Replicates of 40 rare drugs (2-6 replicates) and 4 frequent drugs (30 replicates), in shuffled order"""
+    rng = np.random.default_rng(0)
+    drug_sizes = {**{f'rare_{num}': 2 + num % 5 for num in range(40)}, **{f'freq_{num}': 30 for num in range(4)}}
+    drugs = [drug for drug, size in drug_sizes.items() for _ in range(size)]
+    drug_targets = {drug: rng.integers(0, 2, len(TARGET_COLS)) for drug in drug_sizes}
+    df = pd.DataFrame([drug_targets[drug] for drug in drugs], columns=TARGET_COLS)
+    df.insert(0, 'pert_iname', drugs)
+    df.insert(1, 'replicate_id', [f'rep_{num}' for num in range(len(df))])
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+def test_folds_match_the_dictionary_based_stratification():
+    df = get_train_data()
+    folds = get_drug_folds(df, 5, TARGET_COLS, 'replicate_id', 10)
+    expected = drug_stratification_baseline(df, 5, TARGET_COLS, 'replicate_id', 10)
+    rare = df['pert_iname'].str.startswith('rare').values
+    np.testing.assert_array_equal(folds[rare], expected[rare])
+    np.testing.assert_array_equal(folds, expected)
+    ##all the replicates of a rare drug are in the same fold
+    assert (df[rare].assign(fold=folds[rare]).groupby('pert_iname')['fold'].nunique() == 1).all()
+
+def test_saved_folds_are_read_back(tmp_path):
+    df = get_train_data()
+    folds = get_drug_folds(df, 5, TARGET_COLS, 'replicate_id', 10, fold_dir=str(tmp_path))
+    fold_files = list(tmp_path.iterdir())
+    assert len(fold_files) == 1
+    np.testing.assert_array_equal(get_drug_folds(df, 5, TARGET_COLS, 'replicate_id', 10, fold_dir=str(tmp_path)),
+                                  folds)
+    ##a changed fold file is returned as is, i.e. the folds are not recomputed
+    df_folds = pd.read_csv(fold_files[0])
+    pd.DataFrame({'replicate_id': df_folds['replicate_id'], 'fold': (df_folds['fold'] + 1) % 5}).to_csv(
+        fold_files[0], index=False)
+    np.testing.assert_array_equal(get_drug_folds(df, 5, TARGET_COLS, 'replicate_id', 10, fold_dir=str(tmp_path)),
+                                  (folds + 1) % 5)
+    assert list(tmp_path.iterdir()) == fold_files
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from incremental_scores import update_cpd_medianscores
+from replicate_scores import get_cpd_medianscores
+
+METADATA_COLS = ['replicate_name', 'plate', 'well', 'dose', 'pert_iname']
+ID_COLS = ['plate', 'well', 'pert_iname', 'dose']
+
+def make_level4(rng, plates):
+    """Level-4 profiles of 6 compounds on the given plates, replicate names are positional as in cell painting"""
+    rows = []
+    for plate in plates:
+        for well, (cpd_num, dose) in enumerate((cpd_num, dose) for cpd_num in range(6) for dose in range(1, 7)):
+            rows.append({'plate': plate, 'well': f'W{well:03d}', 'dose': dose, 'pert_iname': f'cpd_{cpd_num}'})
+    df = pd.DataFrame(rows)
+    features = rng.normal(size=(len(df), 20))
+    return pd.concat([df, pd.DataFrame(features, columns=[f'feat_{num}' for num in range(20)])], axis=1)
+
+def with_replicate_names(df):
+    df = df.reset_index(drop=True)
+    df.insert(0, 'replicate_name', ['replicate_' + str(row) for row in range(len(df))])
+    return df
+
+def test_update_cpd_medianscores_reuses_shifted_replicates(tmp_path):
+    rng = np.random.default_rng(0)
+    state_path = str(tmp_path / 'state.pickle')
+    df = with_replicate_names(make_level4(rng, ['P1', 'P2', 'P3']))
+    result, updated = update_cpd_medianscores(df, 'dose', ID_COLS, METADATA_COLS, state_path)
+    expected = get_cpd_medianscores(df, 'dose', METADATA_COLS, n_jobs=1)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=0, atol=1e-12)
+    assert updated == [f'cpd_{cpd_num}' for cpd_num in range(6)]
+
+    ##dropping the first plate shifts all the positional replicate names, but no group needs a recomputation
+    df_dropped = with_replicate_names(df[df['plate'] != 'P1'].drop('replicate_name', axis=1))
+    result, updated = update_cpd_medianscores(df_dropped, 'dose', ID_COLS, METADATA_COLS, state_path)
+    expected = get_cpd_medianscores(df_dropped, 'dose', METADATA_COLS, n_jobs=1)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=0, atol=1e-12)
+    assert updated == [f'cpd_{cpd_num}' for cpd_num in range(6)]
+    result, updated = update_cpd_medianscores(df_dropped, 'dose', ID_COLS, METADATA_COLS, state_path)
+    assert updated == []
+
+def test_update_cpd_medianscores_rejects_duplicate_ids(tmp_path):
+    rng = np.random.default_rng(1)
+    df = make_level4(rng, ['P1', 'P2'])
+    df.loc[df['plate'] == 'P2', 'plate'] = 'P1'
+    with pytest.raises(ValueError, match='unique id'):
+        update_cpd_medianscores(with_replicate_names(df), 'dose', ID_COLS, METADATA_COLS,
+                                str(tmp_path / 'state.pickle'))
@@ -0,0 +1,79 @@
+import os
+import pickle
+from statistics import median
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from correlation import spearman_corr
+from feature_store import open_feature_store
+from level4_pipeline import run_level4_pipeline, save_level4_results
+from replicate_scores import get_cpd_medianscores
+from signature_strength import compute_SS_activity_score, get_dmso_activity_percentile
+
+METADATA_COLS = ['replicate_id', 'Metadata_broad_sample', 'pert_id', 'dose', 'pert_idose',
+                 'pert_iname', 'moa', 'sig_id', 'det_plate', 'det_well']
+
+@pytest.fixture
+def level4_file(tmp_path):
+    """Level-4 csv file of 8 compounds with 2 or 3 replicates in each of the doses 1-6, and DMSO on 4 plates"""
+    rng = np.random.default_rng(0)
+    rows = [{'pert_iname': f'cpd_{num}', 'dose': dose, 'det_plate': f'plate_{rep}'}
+            for num in range(8) for dose in range(1, 7) for rep in range(2 + num % 2)]
+    rows += [{'pert_iname': 'DMSO', 'dose': 0, 'det_plate': f'plate_{num % 4}'} for num in range(14)]
+    df = pd.DataFrame(rows)
+    df['replicate_id'] = [f'rep_{num}' for num in range(len(df))]
+    for col in ['Metadata_broad_sample', 'pert_id', 'pert_idose', 'moa', 'sig_id', 'det_well']:
+        df[col] = 'x'
+    df = pd.concat([df[METADATA_COLS], pd.DataFrame(rng.normal(scale=1.5, size=(len(df), 30)),
+                                                    columns=[f'feat_{num}' for num in range(30)])], axis=1)
+    file_path = os.path.join(str(tmp_path), 'L1000_level4_cpd_replicates.csv.gz')
+    df.to_csv(file_path, index=False, compression='gzip')
+    return file_path
+
+def test_dmso_percentile_matches_the_plate_loop(level4_file):
+    df = pd.read_csv(level4_file)
+    df_dmso = df[df['pert_iname'] == 'DMSO']
+    num_feats = df.shape[1] - len(METADATA_COLS)
+    dmso_scores = []
+    for plate in df_dmso['det_plate'].unique():
+        plt_replicates = df_dmso[df_dmso['det_plate'] == plate].drop(METADATA_COLS, axis=1)
+        plt_rep_corr = spearman_corr(plt_replicates.values.astype('float64'))
+        median_score = median(list(plt_rep_corr[np.triu_indices(len(plt_rep_corr), k=1)]))
+        df_plt_reps = abs((plt_replicates * np.sqrt(plt_replicates.shape[0])).T)
+        ss_norm = df_plt_reps[df_plt_reps >= 2.0].stack().count() / len(df_plt_reps.columns)
+        dmso_scores.append(np.sqrt(abs(median_score) * ss_norm / num_feats))
+    assert get_dmso_activity_percentile(df_dmso, 'det_plate', METADATA_COLS, num_feats) == \
+        pytest.approx(np.percentile(dmso_scores, 95), abs=1e-12)
+
+def test_runner_saves_the_notebook_artifacts(level4_file, tmp_path):
+    feature_store = open_feature_store(level4_file, 'dose', 'replicate_id', METADATA_COLS, compression='gzip')
+    level4_results = run_level4_pipeline(feature_store, 'dose', 'replicate_id', METADATA_COLS, 'det_plate',
+                                         rand_num=5, n_jobs=1)
+    df_med_scores = level4_results['median_scores']
+    expected = get_cpd_medianscores(pd.read_csv(level4_file), 'dose', METADATA_COLS, n_jobs=1).drop(['DMSO'])
+    pd.testing.assert_frame_equal(df_med_scores.drop(['no_of_replicates'], axis=1), expected)
+    assert df_med_scores['no_of_replicates'].tolist() == [2 + num % 2 for num in range(8)]
+    assert level4_results['p_values'].index.tolist() == df_med_scores.index.tolist()
+    df_cpd_ss, df_activity = compute_SS_activity_score(pd.read_csv(level4_file), expected.loc[df_med_scores.index],
+                                                       'dose', METADATA_COLS, 30)
+    pd.testing.assert_frame_equal(level4_results['signature_strength'], df_cpd_ss)
+    pd.testing.assert_frame_equal(level4_results['activity_score'], df_activity)
+
+    data_dir, results_dir = str(tmp_path / 'data'), str(tmp_path / 'results')
+    save_level4_results(level4_results, 'L1000', data_dir, results_dir)
+    assert sorted(os.listdir(data_dir)) == ['L1000_all_scores.csv', 'L1000_dmso_95_percentile_TAS.pickle',
+                                            'cpd_replicate_median_scores.csv', 'cpd_replicate_p_values.csv',
+                                            'null_dist_medians_per_dose.pickle', 'null_distribution.pickle']
+    assert os.listdir(results_dir) == ['median_score_per_compound_L1000.tsv.gz']
+    df_all_scores = pd.read_csv(os.path.join(data_dir, 'L1000_all_scores.csv'))
+    assert df_all_scores.columns.tolist() == ['cpd', 'dose', 'replicate_correlation', 'signature_strength', 'TAS']
+    assert len(df_all_scores) == 8 * 6
+    with open(os.path.join(data_dir, 'null_dist_medians_per_dose.pickle'), 'rb') as handle:
+        assert [len(medians) for medians in pickle.load(handle).values()] == [2 * 5] * 6
+
+def test_store_doses_match_the_dataframe_in_worker_processes(level4_file):
+    feature_store = open_feature_store(level4_file, 'dose', 'replicate_id', METADATA_COLS, compression='gzip')
+    expected = get_cpd_medianscores(pd.read_csv(level4_file), 'dose', METADATA_COLS, n_jobs=1)
+    pd.testing.assert_frame_equal(get_cpd_medianscores(feature_store, 'dose', METADATA_COLS, n_jobs=2), expected)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+from model_export import export_torchscript, predict_stacked_checkpoints, stack_ensemble
+from pytorch_utils import CNN_Model, SimpleNN_Model
+
+NUM_FEATURES = 30
+NUM_TARGETS = 5
+
+def make_trained_model(Model, hidden_size, seed):
+    """A model with random batch norm statistics and weight norm gains, as left by training"""
+    torch.manual_seed(seed)
+    model = Model(num_features=NUM_FEATURES, num_targets=NUM_TARGETS, hidden_size=hidden_size)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm1d):
+                module.running_mean.normal_(0, 0.5)
+                module.running_var.uniform_(0.5, 2)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.normal_(0, 0.2)
+        for name, param in model.named_parameters():
+            if name.endswith('weight_g'):
+                param.mul_(torch.empty_like(param).uniform_(0.5, 1.5))
+    return model.eval()
+
+@pytest.mark.parametrize('Model, hidden_size', [(SimpleNN_Model, 64), (CNN_Model, 2048)])
+def test_stacked_predictions_match_the_eager_models(Model, hidden_size):
+    num_folds, num_seeds = 3, 2
+    fold_models = [[make_trained_model(Model, hidden_size, seed=fold * num_seeds + seed) for seed in range(num_seeds)]
+                   for fold in range(num_folds)]
+    x_folds = torch.from_numpy(np.random.default_rng(0).normal(size=(num_folds, 17, NUM_FEATURES)).astype(np.float32))
+    with torch.inference_mode():
+        expected = torch.stack([model(x_folds[fold]).sigmoid() for fold, models in enumerate(fold_models)
+                                for model in models]).mean(0)
+        stacked_model = stack_ensemble(fold_models)
+        torch.testing.assert_close(stacked_model(x_folds), expected, rtol=0, atol=1e-5)
+        ##the compiled model also takes any number of profiles
+        scripted_model = export_torchscript(stacked_model)
+        torch.testing.assert_close(scripted_model(x_folds), expected, rtol=0, atol=1e-5)
+        torch.testing.assert_close(scripted_model(x_folds[:, :3]), expected[:3], rtol=0, atol=1e-5)
+
+@pytest.mark.parametrize('Model, hidden_size, seeds', [(SimpleNN_Model, 64, [0, 1]), (CNN_Model, 2048, [None])])
+def test_checkpoint_predictions_match_the_eager_models(tmp_path, Model, hidden_size, seeds):
+    num_folds = 3
+    rng = np.random.default_rng(1)
+    x_folds = {fold: rng.normal(size=(11, NUM_FEATURES)) for fold in range(num_folds)}
+    checkpoint_paths, expected = {}, []
+    for fold in range(num_folds):
+        for num, seed in enumerate(seeds):
+            model = make_trained_model(Model, hidden_size, seed=fold * len(seeds) + num)
+            checkpoint_paths[(seed, fold)] = str(tmp_path / f"model_{seed}_{fold}.pth")
+            torch.save(model.state_dict(), checkpoint_paths[(seed, fold)])
+            with torch.inference_mode():
+                expected.append(model(torch.from_numpy(x_folds[fold].astype(np.float32))).sigmoid().numpy())
+    model_params = dict(num_features=NUM_FEATURES, num_targets=NUM_TARGETS, hidden_size=hidden_size)
+    ##the test set is scored in batches, the last batch is partial
+    predictions = predict_stacked_checkpoints(Model, model_params, checkpoint_paths, x_folds, batch_size=4)
+    assert predictions.dtype == np.float64
+    np.testing.assert_allclose(predictions, np.mean(expected, axis=0), rtol=0, atol=1e-5)
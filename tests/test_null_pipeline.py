@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from null_pipeline import get_null_medians_per_dose, get_replicates_classes_per_dose, get_shard_path
+from null_pipeline import run_null_pipeline
+
+METADATA_COLS = ['replicate_id', 'dose', 'pert_iname']
+
+@pytest.fixture
+def null_inputs():
+    """Level-4 profiles of 12 compounds with 2 or 3 replicates in each of the doses 1-2 (and DMSO as dose 0)"""
+    rng = np.random.default_rng(0)
+    rows = [{'replicate_id': f'cpd_{num}_dose_{dose}_rep_{rep}', 'dose': dose, 'pert_iname': f'cpd_{num}'}
+            for num in range(12) for dose in range(3) for rep in range(2 + num % 2)]
+    df = pd.DataFrame(rows)
+    df = pd.concat([df, pd.DataFrame(rng.normal(size=(len(df), 20)), columns=[f'feat_{num}' for num in range(20)])],
+                   axis=1)
+    df_cpds = pd.DataFrame({'no_of_replicates': [2 + num % 2 for num in range(12)]},
+                           index=[f'cpd_{num}' for num in range(12)])
+    cpds_replicates = {cpd:[df['replicate_id'][(df['pert_iname'] == cpd) & (df['dose'] == dose)].tolist()
+                            for dose in [1, 2]] for cpd in df_cpds.index}
+    class_dict = get_replicates_classes_per_dose(df_cpds, cpds_replicates, [1, 2])
+    return df, class_dict, cpds_replicates
+
+def run_pipeline(df, class_dict, cpds_replicates, shard_dir, n_jobs=1):
+    return run_null_pipeline(df, class_dict, [1, 2], cpds_replicates, 'dose', 'replicate_id', METADATA_COLS,
+                             shard_dir, rand_num=10, seed=1903, n_jobs=n_jobs)
+
+def test_null_medians_are_the_spearman_medians(null_inputs):
+    df, class_dict, cpds_replicates = null_inputs
+    null_reps, null_medians = run_pipeline(*null_inputs, None)
+    df_dose = df[df['dose'] == 2].set_index('replicate_id')
+    for reps, median_score in zip(null_reps[3][1], null_medians[3][1]):
+        corr = df_dose.loc[reps].drop(['dose', 'pert_iname'], axis=1).T.corr(method='spearman').values
+        assert median_score == pytest.approx(np.median(corr[np.triu_indices(len(reps), k=1)]), abs=1e-12)
+
+def test_pool_and_shards_give_the_same_null_distribution(null_inputs, tmp_path):
+    expected = run_pipeline(*null_inputs, None)
+    assert run_pipeline(*null_inputs, str(tmp_path), n_jobs=2) == expected
+    assert run_pipeline(*null_inputs, str(tmp_path)) == expected
+
+def test_shards_of_other_data_are_recomputed(null_inputs, tmp_path):
+    df, class_dict, cpds_replicates = null_inputs
+    run_pipeline(df, class_dict, cpds_replicates, str(tmp_path))
+    shard_path = get_shard_path(str(tmp_path), 1, 2)
+    os.utime(shard_path, (0, 0))
+    run_pipeline(df, class_dict, cpds_replicates, str(tmp_path))
+    assert os.path.getmtime(shard_path) == 0
+
+    df_changed = df.copy()
+    df_changed.loc[df_changed['dose'] == 1, 'feat_0'] += 1
+    changed = run_pipeline(df_changed, class_dict, cpds_replicates, str(tmp_path))
+    assert os.path.getmtime(shard_path) > 0
+    assert changed == run_pipeline(df_changed, class_dict, cpds_replicates, None)
+
+def test_only_the_missing_cells_are_recomputed(null_inputs, tmp_path):
+    expected = run_pipeline(*null_inputs, str(tmp_path))
+    for dose, replicate_class in [(1, 2), (1, 3), (2, 2)]:
+        os.utime(get_shard_path(str(tmp_path), dose, replicate_class), (0, 0))
+    os.remove(get_shard_path(str(tmp_path), 2, 3))
+    assert run_pipeline(*null_inputs, str(tmp_path), n_jobs=2) == expected
+    assert os.path.getmtime(get_shard_path(str(tmp_path), 2, 3)) > 0
+    for dose, replicate_class in [(1, 2), (1, 3), (2, 2)]:
+        assert os.path.getmtime(get_shard_path(str(tmp_path), dose, replicate_class)) == 0
+
+def test_null_medians_per_dose_pool_the_replicate_classes(null_inputs):
+    _, null_medians = run_pipeline(*null_inputs, None)
+    dose_null_medians = get_null_medians_per_dose(null_medians, [1, 2])
+    assert dose_null_medians[2] == null_medians[2][1] + null_medians[3][1]
+    assert len(dose_null_medians[1]) == 2 * 10
@@ -0,0 +1,63 @@
+from collections import Counter
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from null_sampler import draw_random_replicates, get_dose_replicate_map, get_null_distribution_replicates
+
+def valid_replicate_sets(cpd_reps, no_of_replicates, class_reps=()):
+    """All sets of replicates, without the sets with a class replicate and two replicates of the same compound"""
+    rep_cpd = {rep:cpd for cpd, reps in cpd_reps.items() for rep in reps}
+    return [frozenset(reps) for reps in combinations(sorted(rep_cpd), no_of_replicates)
+            if not (set(reps) & set(class_reps) and len({rep_cpd[rep] for rep in reps}) < no_of_replicates)]
+
+def draw_single_lists(cpd_reps, no_of_replicates, num_draws, class_reps=None):
+    """Frequencies of the sets of replicates of num_draws independent single-list draws"""
+    rep_layout = get_dose_replicate_map({cpd:[reps] for cpd, reps in cpd_reps.items()}, 1)
+    rng = np.random.default_rng(1903)
+    return Counter(frozenset(draw_random_replicates(*rep_layout, no_of_replicates, 1, rng, class_reps)[0])
+                   for _ in range(num_draws))
+
+@pytest.mark.parametrize('cpd_reps, no_of_replicates, class_reps', [
+    ({'A':['a1', 'a2', 'a3', 'a4', 'a5', 'a6'], 'B':['b1'], 'C':['c1']}, 2, None),
+    ({'A':['a1', 'a2', 'a3'], 'B':['b1', 'b2'], 'C':['c1'], 'D':['d1', 'd2']}, 3, None),
+    ({'A':['a1', 'a2', 'a3'], 'B':['b1', 'b2'], 'C':['c1'], 'D':['d1', 'd2']}, 2, ['b1', 'b2']),
+    ({'A':['a1', 'a2', 'a3'], 'B':['b1', 'b2'], 'C':['c1'], 'D':['d1', 'd2']}, 3, ['a1', 'c1']),
+])
+def test_lists_are_uniform_over_the_valid_replicate_sets(cpd_reps, no_of_replicates, class_reps):
+    num_draws = 20000
+    valid_sets = valid_replicate_sets(cpd_reps, no_of_replicates, class_reps or ())
+    counts = draw_single_lists(cpd_reps, no_of_replicates, num_draws, class_reps)
+    assert set(counts) <= set(valid_sets)
+    expected = 1 / len(valid_sets)
+    ##every frequency within 5 standard deviations of the uniform frequency
+    tolerance = 5 * np.sqrt(expected * (1 - expected) / num_draws)
+    for reps in valid_sets:
+        assert abs(counts[reps] / num_draws - expected) < tolerance
+
+def test_lists_follow_the_rejection_rule_of_the_notebooks():
+    rng = np.random.default_rng(0)
+    cpd_reps = {f'cpd_{num}':[f'cpd_{num}_rep_{rep}' for rep in range(rng.integers(1, 5))] for num in range(15)}
+    class_reps = cpd_reps['cpd_0'] + cpd_reps['cpd_1']
+    rep_layout = get_dose_replicate_map({cpd:[reps] for cpd, reps in cpd_reps.items()}, 1)
+    replicate_list = draw_random_replicates(*rep_layout, 3, 200, rng, class_reps)
+    rep_cpd = {rep:cpd for cpd, reps in cpd_reps.items() for rep in reps}
+    assert len({frozenset(reps) for reps in replicate_list}) == 200
+    for reps in replicate_list:
+        assert len(set(reps)) == 3
+        ##rejected only if both conditions hold, as in get_random_replicates
+        assert not (set(reps) & set(class_reps) and len({rep_cpd[rep] for rep in reps}) < 3)
+
+def test_too_few_replicates_raise():
+    rep_layout = get_dose_replicate_map({'A':[['a1', 'a2']], 'B':[['b1']]}, 1)
+    with pytest.raises(ValueError):
+        draw_random_replicates(*rep_layout, 4, 1, np.random.default_rng(0), ['b1'])
+
+def test_null_distribution_is_reproducible():
+    cpd_reps = {f'cpd_{num}':[[f'cpd_{num}_dose_{dose}_rep_{rep}' for rep in range(3)] for dose in (1, 2)]
+                for num in range(10)}
+    class_dict = {3:[[rep for cpd in ['cpd_0', 'cpd_1'] for rep in cpd_reps[cpd][dose]] for dose in range(2)]}
+    null_reps = get_null_distribution_replicates(class_dict, [1, 2], cpd_reps, rand_num=50)
+    assert null_reps == get_null_distribution_replicates(class_dict, [1, 2], cpd_reps, rand_num=50)
+    assert [len(reps) for reps in null_reps[3]] == [50, 50]
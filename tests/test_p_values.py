@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from null_sampler import draw_random_replicates, get_dose_replicate_map, get_duplicate_lists
+from p_values import calc_p_values, get_null_p_values
+
+def test_p_values_match_the_baseline_comparison():
+    rng = np.random.default_rng(0)
+    null_medians = np.round(rng.normal(size=100000), 3)
+    actual_medians = np.concatenate((null_medians[:50], rng.normal(size=50), [-10, 10]))
+    expected = np.array([np.sum(null_medians >= actual) / len(null_medians) for actual in actual_medians])
+    np.testing.assert_allclose(calc_p_values(null_medians, actual_medians, p_correction=False), expected, rtol=0, atol=1e-15)
+    np.testing.assert_allclose(calc_p_values(null_medians, actual_medians),
+                               (expected * len(null_medians) + 1) / (len(null_medians) + 1), rtol=0, atol=1e-15)
+
+def test_null_p_values_per_size_class():
+    df_med = pd.DataFrame({'dose_1': [0.5, 0.1, 0.9], 'dose_2': [0.2, 0.3, 0.4], 'no_of_replicates': [2, 3, 2]},
+                          index=['cpd_c', 'cpd_a', 'cpd_b'])
+    null_medians = {2: [[0.0, 0.6, 0.8], [0.1, 0.2, 0.3]], 3: [[0.05, 0.2, 0.3], [0.3, 0.3, 0.9]]}
+    p_vals = get_null_p_values(null_medians, [1, 2], df_med, 'no_of_replicates', p_correction=False)
+    assert list(p_vals) == ['cpd_a', 'cpd_b', 'cpd_c']
+    assert p_vals == {'cpd_a': [pytest.approx(2 / 3), 1.0], 'cpd_b': [0.0, 0.0], 'cpd_c': [pytest.approx(2 / 3), pytest.approx(2 / 3)]}
+
+def test_large_null_distribution_is_drawn_in_bounded_batches():
+    rng = np.random.default_rng(0)
+    cpd_reps = {f'cpd_{num}':[[f'cpd_{num}_rep_{rep}' for rep in range(rng.integers(1, 6))]] for num in range(300)}
+    rep_layout = get_dose_replicate_map(cpd_reps, 1)
+    replicate_list = draw_random_replicates(*rep_layout, 4, 100000, rng, max_batch_size=4096)
+    assert len(replicate_list) == 100000
+    assert get_duplicate_lists({4: [replicate_list]}, [1]) == {}
+
+def test_duplicate_lists_are_found_in_any_order():
+    null_reps = {2: [[['a', 'b'], ['c', 'd'], ['b', 'a']], [['a', 'c'], ['b', 'd']]], 3: [[['a', 'b', 'c']], []]}
+    assert get_duplicate_lists(null_reps, [1, 2]) == {2: [[['a', 'b'], ['b', 'a']]]}
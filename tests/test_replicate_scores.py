@@ -0,0 +1,72 @@
+from statistics import median
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from correlation import rank_standardize
+from replicate_scores import get_cpd_medianscores, group_median_scores
+
+METADATA_COLS = ['replicate_id', 'dose', 'pert_iname']
+
+def baseline_median_score(cpds_list, df):
+    """get_median_score of the baseline median score notebooks"""
+    cpds_median_score = {}
+    for cpd in cpds_list:
+        cpd_replicates = df[df['pert_iname'] == cpd].drop(METADATA_COLS, axis = 1)
+        cpd_replicates_corr = cpd_replicates.astype('float64').T.corr(method = 'spearman').values
+        if len(cpd_replicates_corr) == 1:
+            median_val = 1
+        else:
+            median_val = median(list(cpd_replicates_corr[np.triu_indices(len(cpd_replicates_corr), k = 1)]))
+        cpds_median_score[cpd] = median_val
+    return cpds_median_score
+
+def baseline_cpd_medianscores(df):
+    """get_cpd_medianscores (with check_compounds) of the baseline median score notebooks"""
+    dose_list = list(set(df['dose'].unique().tolist()))[1:7]
+    for dose in dose_list:
+        df_dose = df[df['dose'] == dose].copy()
+        cpds_median_score = baseline_median_score(df_dose['pert_iname'].unique().tolist(), df_dose)
+        for cpd in df['pert_iname'].unique().tolist():
+            if cpd not in cpds_median_score:
+                cpds_median_score[cpd] = np.nan
+        sorted_med_score = {key:value for key, value in sorted(cpds_median_score.items(), key=lambda item: item[0])}
+        if dose == 1:
+            df_cpd_med_score = pd.DataFrame.from_dict(sorted_med_score, orient='index', columns = ['dose_1'])
+        else:
+            df_cpd_med_score['dose_' + str(dose)] = sorted_med_score.values()
+    return df_cpd_med_score
+
+@pytest.fixture
+def df_level4():
+    """Level-4 profiles of 12 compounds with 0 to 5 replicates per dose (doses 0-6), with tied feature values"""
+    rng = np.random.default_rng(0)
+    rows = []
+    for cpd_num in range(12):
+        for dose in range(7):
+            for rep in range(rng.integers(0, 6)):
+                rows.append({'replicate_id': f'rep_{cpd_num}_{dose}_{rep}', 'dose': dose,
+                             'pert_iname': f'cpd_{cpd_num:02d}'})
+    df = pd.DataFrame(rows)
+    features = np.round(rng.normal(size=(len(df), 30)), 1)
+    return pd.concat([df, pd.DataFrame(features, columns=[f'feat_{num}' for num in range(30)])], axis=1)
+
+def test_group_median_scores_matches_pandas_spearman(df_level4):
+    features = df_level4.drop(METADATA_COLS, axis=1).values
+    cpd_codes, cpds = pd.factorize(df_level4['pert_iname'])
+    medians = group_median_scores(rank_standardize(features), cpd_codes.astype(np.int64), len(cpds) + 1)
+    for code, cpd in enumerate(cpds):
+        corr = df_level4.loc[cpd_codes == code].drop(METADATA_COLS, axis=1).T.corr(method='spearman').values
+        expected = 1 if len(corr) == 1 else np.median(corr[np.triu_indices(len(corr), k=1)])
+        assert medians[code] == pytest.approx(expected, abs=1e-12)
+    assert np.isnan(medians[-1])
+
+def test_get_cpd_medianscores_matches_baseline(df_level4):
+    expected = baseline_cpd_medianscores(df_level4)
+    result = get_cpd_medianscores(df_level4, 'dose', METADATA_COLS, n_jobs=1)
+    pd.testing.assert_frame_equal(result, expected.astype('float64'), check_exact=False, rtol=0, atol=1e-12)
+
+def test_get_cpd_medianscores_is_the_same_in_parallel(df_level4):
+    pd.testing.assert_frame_equal(get_cpd_medianscores(df_level4, 'dose', METADATA_COLS, n_jobs=2),
+                                  get_cpd_medianscores(df_level4, 'dose', METADATA_COLS, n_jobs=1))
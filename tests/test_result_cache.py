@@ -0,0 +1,49 @@
+import sys
+
+import numpy as np
+
+from result_cache import ResultCache
+
+HELPER_SOURCE = '''
+def scale(values):
+    return values * {factor}
+'''
+
+CACHED_SOURCE = '''
+from cache_helper_module import scale
+
+def get_scaled_sum(values):
+    return scale(values).sum()
+'''
+
+def import_modules(tmp_path, monkeypatch, factor):
+    """Writes a cached function module and the helper module it calls, and imports them from scratch"""
+    (tmp_path / 'cache_helper_module.py').write_text(HELPER_SOURCE.format(factor=factor))
+    (tmp_path / 'cached_module.py').write_text(CACHED_SOURCE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    for name in ['cache_helper_module', 'cached_module']:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import cached_module
+    return cached_module
+
+def test_key_changes_with_the_helper_modules_and_version(tmp_path, monkeypatch):
+    values = np.arange(10.0)
+    cached_module = import_modules(tmp_path, monkeypatch, factor=2)
+    cache = ResultCache(str(tmp_path / 'cache'), helper_modules=('cache_helper_module',))
+    key = cache.get_key(cached_module.get_scaled_sum, (values,), {})
+    assert cache(cached_module.get_scaled_sum)(values) == 90
+    assert ResultCache(str(tmp_path / 'cache'), helper_modules=('cache_helper_module',), version='2').get_key(
+        cached_module.get_scaled_sum, (values,), {}) != key
+
+    ##a change in the helper module invalidates the result, the function itself did not change
+    cached_module = import_modules(tmp_path, monkeypatch, factor=3)
+    assert cache.get_key(cached_module.get_scaled_sum, (values,), {}) != key
+    assert cache(cached_module.get_scaled_sum)(values) == 135
+
+def test_feature_store_is_not_imported_for_plain_functions(tmp_path, monkeypatch):
+    for name in ['result_cache', 'feature_store']:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import result_cache
+    cache = result_cache.ResultCache(str(tmp_path / 'cache'))
+    cache.get_key(np.sum, (np.arange(3.0),), {})
+    assert 'feature_store' not in sys.modules
@@ -0,0 +1,73 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from split_compounds import create_cpd_moa_df, sort_moas, split_cpds_moas
+
+def split_cpds_moas_baseline(cpd_moas_dict, train_ratio=0.8, test_ratio=0.2):
+    """The dataframe-based split_cpds_moas before the compound state was kept in numpy arrays"""
+    moa_list = sort_moas(cpd_moas_dict)
+    df = create_cpd_moa_df(cpd_moas_dict)
+
+    random.seed(333)
+    for moa in moa_list:
+        df_moa = df[df['moa'] == moa].reset_index(drop=True)
+        no_cpd = df_moa.shape[0]
+
+        if no_cpd == 1:
+            n_trn, n_tst = 1, 0
+        else:
+            n_trn, n_tst = np.floor(no_cpd*train_ratio), np.ceil(no_cpd*test_ratio),
+
+        n_tst_mk = sum(df_moa.test)
+        n_trn_mk = sum(df_moa.train)
+        moa_mk = df_moa[df_moa['marked']].copy()
+        moa_not_mk = df_moa[~df_moa['marked']].copy()
+        trn_needed = int(n_trn - n_trn_mk)
+        tst_needed = int(n_tst - n_tst_mk)
+        n_cpds_needed = trn_needed + tst_needed
+
+        trn_needed = max(trn_needed, 0)
+        tst_needed = max(tst_needed, 0)
+        trn_flg = list(np.concatenate((np.tile(True, trn_needed), np.tile(False, tst_needed))))
+        trn_flg = random.sample(trn_flg, n_cpds_needed)
+        tst_flg = [not boolean for boolean in trn_flg]
+        moa_not_mk.train = trn_flg
+        moa_not_mk.test = tst_flg
+        if moa_not_mk.shape[0] > 0:
+            moa_not_mk.marked = True
+        df_moa = pd.concat([moa_not_mk, moa_mk], axis=0, ignore_index=True)
+        df_other_moa = df[df['moa'] != moa].reset_index(drop=True)
+        df_otrs_mk = df_other_moa[df_other_moa['marked']].reset_index(drop=True)
+        df_otrs_not_mk= df_other_moa[~df_other_moa['marked']].reset_index(drop=True)
+        df_otrs_not_mk = df_otrs_not_mk[['pert_iname', 'moa']].merge(moa_not_mk.drop(['moa'], axis=1),
+                                                                     on=['pert_iname'], how='left').fillna(False)
+
+        df = pd.concat([df_moa, df_otrs_mk, df_otrs_not_mk], axis=0, ignore_index=True)
+        ##marked is cast as well: the object column left by fillna can not be inverted with pandas 3
+        df[['train', 'test', 'marked']] = df[['train', 'test', 'marked']].apply(lambda x: x.astype(bool))
+
+    return df
+
+def make_cpd_moas(seed, n_cpds=120, n_moas=25):
+    """Compounds with one to three MOAs, the MOAs are drawn with very different frequencies"""
+    rng = np.random.default_rng(seed)
+    moa_weights = rng.pareto(1.0, n_moas) + 0.05
+    moa_weights /= moa_weights.sum()
+    cpd_moas = {}
+    for cpd_num in range(n_cpds):
+        n_cpd_moas = rng.choice([1, 2, 3], p=[0.7, 0.2, 0.1])
+        moas = rng.choice(n_moas, size=n_cpd_moas, replace=False, p=moa_weights)
+        cpd_moas[f'cpd_{cpd_num}'] = '|'.join(f'moa_{moa}' for moa in moas)
+    return cpd_moas
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_split_matches_the_baseline_split(seed):
+    cpd_moas = make_cpd_moas(seed)
+    expected = split_cpds_moas_baseline(cpd_moas)
+    result = split_cpds_moas(cpd_moas)
+    ##same pairs in the same order, with the same train/test flags drawn from the seed 333
+    pd.testing.assert_frame_equal(result, expected)
+    assert result['test'].any()
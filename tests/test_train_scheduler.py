@@ -0,0 +1,47 @@
+import functools
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+from train_scheduler import run_seed_fold_jobs
+
+N_ROWS = 8
+
+class FoldTrainer:
+    """Stand-in for the training classes of the scripts, its bound method is pickled to the spawned workers"""
+    def __init__(self, scale):
+        self.scale = scale
+
+    def model_train_pred(self, fold, seed, fold_data, offset):
+        oof = np.zeros(N_ROWS)
+        oof[fold_data['val_idx']] = self.scale * (seed + 1) + offset
+        return oof, np.arange(3.0) * seed + fold
+
+def prepare_fold(fold, prepared):
+    prepared.append(fold)
+    return {'val_idx': np.arange(fold, N_ROWS, 4)}
+
+def test_spawned_jobs_match_the_serial_jobs(tmp_path):
+    train_func = functools.partial(FoldTrainer(2.0).model_train_pred, offset=0.5)
+    prepared = []
+    fold_func = functools.partial(prepare_fold, prepared=prepared)
+    serial = run_seed_fold_jobs(train_func, 4, str(tmp_path / 'serial'), [0, 1, 2], n_jobs=1, verbose=False,
+                                fold_func=fold_func)
+    spawned = run_seed_fold_jobs(train_func, 4, str(tmp_path / 'spawned'), [0, 1, 2], n_jobs=2, verbose=False,
+                                 fold_func=fold_func)
+    ##every fold is prepared once per run, not once per seed
+    assert prepared == [0, 1, 2, 3] * 2
+    np.testing.assert_array_equal(serial[0], spawned[0])
+    np.testing.assert_array_equal(serial[1], spawned[1])
+    np.testing.assert_allclose(serial[0], np.full(N_ROWS, (2.0 * 1 + 0.5 + 2.0 * 2 + 0.5 + 2.0 * 3 + 0.5) / 3))
+
+def test_jobs_without_test_predictions(tmp_path):
+    def train_func(fold, seed, fold_data):
+        oof = np.zeros(N_ROWS)
+        oof[fold_data['val_idx']] = seed + 1
+        return oof, None
+    oofs, predictions = run_seed_fold_jobs(train_func, 4, str(tmp_path), [0, 1], n_jobs=1, verbose=False,
+                                           fold_func=functools.partial(prepare_fold, prepared=[]))
+    assert predictions is None
+    np.testing.assert_allclose(oofs, np.full(N_ROWS, 1.5))